@@ -1,12 +1,25 @@
 import prow.gis.data as gisdata
 import logging
+import hashlib
+import os
+import uuid
 import prow.utils as u
 
 logger = logging.getLogger(__name__)
 
-def get_intersections(sdb_conn, regions_table='nuts2006', grid_table='merra_grid', reg_proj=3035, grid_proj=4326):
+# Bump to invalidate cached intersections after changes to the calculation
+INTERSECTION_CACHE_VERSION = 1
+
+# Ways of calculating intersections, see get_intersections
+BACKENDS = ['spatialite','numpy']
+
+def get_intersections(sdb_conn, regions_table='nuts2006', grid_table='merra_grid', reg_proj=3035, grid_proj=4326, stat_level=2, cache=True, workers=1, connect=None, backend='spatialite', verify_cache=False):
     """
-    Calculate area of intersections between regions and grid cells.
+    Calculate area of intersections between regions and grid cells. Results 
+    are cached in a file next to the spatial database, keyed by the settings 
+    and a cheap key of each table (see table_key), and reused when nothing 
+    has changed. Cache files also hold a hash of the table contents (see 
+    table_fingerprint), checked against the tables if verify_cache is set.
 
     Args:
         sdb_conn: connection object to spatial database
@@ -14,16 +27,78 @@ def get_intersections(sdb_conn, regions_table='nuts2006', grid_table='merra_grid
         grid_table: name of table containing grid geometries (default 'merra_grid')
         reg_proj: projection SRID for regions' projection (default 3035 (European LAEA))
         grid_proj: projection SRID for grid's projection (default 4326 (lat/long))
+        stat_level: NUTS level of regions (value of STAT_LEVL_, default 2)
+        cache: use and update the intersection cache (default True)
+        workers: number of processes for partitioned calculation (default 1)
+        connect: gis.data.ConnectionFactory for the spatial database, 
+            required if workers > 1
+        backend: 'spatialite' to intersect geometries in the database, or 
+            'numpy' for the analytic overlay in overlay.grid_overlay, which 
+            needs no spatialite extension (default 'spatialite')
+        verify_cache: hash the table contents and recalculate if they differ 
+            from those of the cached intersections, which reads both tables 
+            (default False)
 
     Returns:
         dict: areas of intersecting grid cells for each region
             e.g. {'reg1': {'grid_cell1': area1, 'grid_cell2': area1, ...}, ...}
     """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown intersection backend '{}'.".format(backend))
+    cache_path = None
+    if cache:
+        cache_path = intersection_cache_path(sdb_conn,regions_table,grid_table,
+                                             reg_proj,grid_proj,stat_level,backend)
+    cached = None
+    if cache_path is not None and os.path.exists(cache_path):
+        logger.info('Reading cached intersections from {}.'.format(cache_path))
+        cached = read_intersection_cache(cache_path)
+        if verify_cache and cached[3] != tables_fingerprint(sdb_conn,grid_table,regions_table):
+            logger.warning('Cached intersections in {} are stale, recalculating.'.format(cache_path))
+            os.remove(cache_path)
+            cached = None
+    if cached is not None:
+        gids,rids,overlaps = cached[:3]
+    elif backend == 'numpy':
+        import prow.gis.overlay
+        if int(grid_proj) not in prow.gis.overlay.GEOGRAPHIC_SRIDS:
+            raise ValueError('The numpy backend needs a long/lat grid, not SRID {}.'.format(grid_proj))
+        gids,rids,overlaps = prow.gis.overlay.grid_overlay(sdb_conn,regions_table,
+                                                           grid_table,stat_level)
+    elif workers > 1:
+        gids,rids,overlaps = partitioned_intersections(sdb_conn,connect,regions_table,
+                                                       grid_table,reg_proj,stat_level,
+                                                       workers)
+    else:
+        gids,rids,overlaps = query_intersections(sdb_conn,regions_table,grid_table,
+                                                 reg_proj,grid_proj,stat_level)
+    if cached is None and cache_path is not None:
+        logger.info('Caching intersections in {}.'.format(cache_path))
+        write_intersection_cache(cache_path,gids,rids,overlaps,
+                                 tables_fingerprint(sdb_conn,grid_table,regions_table))
+
+    logger.debug("Creating dictionary.")
+    return intersections_dict(gids,rids,overlaps)
+
+
+def query_intersections(sdb_conn, regions_table='nuts2006', grid_table='merra_grid', reg_proj=3035, grid_proj=4326, stat_level=2):
+    """
+    Calculate area of intersections between regions and grid cells in the 
+    spatial database.
+
+    Args:
+        as for get_intersections
+
+    Returns:
+        tuple: arrays of grid cell ids, region ids and overlapping areas
+    """
+    import numpy as np
+
     sql = """SELECT gid, rid,SUM(AREA(ST_Intersection(rgeom,ggeom))) AS overlap
 FROM 
 (SELECT TRANSFORM(r.geometry,:1) AS rgeom,TRANSFORM(g.geometry,:1) as ggeom,g.id AS gid,r.NUTS_ID AS rid
     FROM {grid_table} AS g, {regions_table} as r  
-    WHERE r.STAT_LEVL_=2 AND g.ROWID IN (
+    WHERE r.STAT_LEVL_=:3 AND g.ROWID IN (
             SELECT ROWID 
             FROM SpatialIndex
             WHERE f_table_name = {grid_table} 
@@ -36,29 +111,290 @@ ORDER BY gid""".format(grid_table=u.quote_identifier(grid_table),regions_table=u
 
     logger.info("Calculating grid/regions intersections from spatial data.")
     logger.debug("SQL:\n"+sql)
-    result = c.execute(sql, (reg_proj,grid_proj))
+    result = c.execute(sql, (reg_proj,grid_proj,stat_level)).fetchall()
+    if not result:
+        return np.empty(0,dtype=np.int64),np.empty(0,dtype=str),np.empty(0)
+
+    gids,rids,overlaps = zip(*result)
+    return np.array(gids,dtype=np.int64),np.array(rids),np.array(overlaps,dtype=float)
+
+
+def partitioned_intersections(sdb_conn, connect, regions_table='nuts2006', grid_table='merra_grid', reg_proj=3035, stat_level=2, workers=2, batch_size=16):
+    """
+    Calculate area of intersections between regions and grid cells with 
+    regions split into batches, each batch run on its own connection in a 
+    process pool. The grid is transformed to the regions' projection once, 
+    into a work table with a spatial index that is dropped afterwards.
+
+    Args:
+        sdb_conn: connection object to spatial database
+        connect: gis.data.ConnectionFactory for the spatial database, used 
+            read-only by the workers and writable for the work table
+        regions_table, grid_table, reg_proj, stat_level: as for 
+            get_intersections
+        workers: number of processes
+        batch_size: number of regions per batch
+
+    Returns:
+        tuple: arrays of grid cell ids, region ids and overlapping areas
+    """
+    import multiprocessing
+    import numpy as np
+
+    if connect is None:
+        raise ValueError('A connection factory is needed for partitioned intersections.')
+
+    region_ids = [row[0] for row in sdb_conn.execute(
+        'SELECT NUTS_ID FROM {} WHERE STAT_LEVL_=? ORDER BY NUTS_ID'.format(
+            u.quote_identifier(regions_table)),(stat_level,))]
+    batches = [region_ids[i:i+batch_size] for i in xrange(0,len(region_ids),batch_size)]
+
+    writer = connect.writable()
+    with writer.connection() as conn:
+        work_table = transform_grid(conn,grid_table,reg_proj)
+    try:
+        logger.info('Calculating intersections for {} regions in {} batches with {} workers.'.format(
+            len(region_ids),len(batches),workers))
+        args = [(work_table,regions_table,reg_proj,stat_level,batch) for batch in batches]
+        pool = multiprocessing.Pool(workers,_init_intersection_worker,(connect,))
+        try:
+            results = []
+            for num,result in enumerate(pool.imap_unordered(_intersect_region_batch,args),1):
+                results.append(result)
+                logger.debug('Finished {} of {} batches.'.format(num,len(batches)))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        with writer.connection() as conn:
+            gisdata.drop_spatial_table(conn,work_table)
+        writer.close()
+
+    results = [result for result in results if result]
+    if not results:
+        return np.empty(0,dtype=np.int64),np.empty(0,dtype=str),np.empty(0)
+    gids,rids,overlaps = zip(*[row for result in results for row in result])
+    gids = np.array(gids,dtype=np.int64)
+    order = np.argsort(gids,kind='mergesort')
+    return gids[order],np.array(rids)[order],np.array(overlaps,dtype=float)[order]
+
+
+def transform_grid(sdb_conn,grid_table,proj):
+    """
+    Copy grid geometries transformed to another projection into a work table 
+    with a spatial index. The work table has a name unique to the process and 
+    call, so that concurrent runs on the same database do not drop each 
+    other's tables, and is dropped again if it cannot be completed. The 
+    caller drops it when done.
+
+    Args:
+        sdb_conn: connection object to spatial database
+        grid_table: name of table containing grid geometries
+        proj: SRID to transform to
+
+    Returns:
+        str: name of work table
+    """
+    work_table = 'tmp_{}_{}_{}_{}'.format(grid_table,int(proj),os.getpid(),uuid.uuid4().hex[:8])
+    esc_work_table = u.quote_identifier(work_table)
+    logger.info('Transforming {} to SRID {} in {}.'.format(grid_table,proj,work_table))
+    complete = False
+    try:
+        sdb_conn.execute('CREATE TABLE {} AS SELECT id,TRANSFORM(geometry,?) AS geometry FROM {}'.format(
+            esc_work_table,u.quote_identifier(grid_table)),(int(proj),))
+        sdb_conn.execute('SELECT RecoverGeometryColumn(?,?,?,?,?)',
+                         (work_table,'geometry',int(proj),'POLYGON','XY'))
+        sdb_conn.execute('SELECT CreateSpatialIndex(?,?)',(work_table,'geometry'))
+        sdb_conn.commit()
+        complete = True
+    finally:
+        if not complete:
+            sdb_conn.rollback()
+            gisdata.drop_spatial_table(sdb_conn,work_table)
+    return work_table
+
+
+# Connection of an intersection worker process
+_worker_conn = None
+
+def _init_intersection_worker(connect):
+    """Open the spatial database connection of a worker process."""
+    global _worker_conn
+    _worker_conn = connect()
+
+def _intersect_region_batch(args):
+    """Intersections of a batch of regions with a transformed grid table."""
+    work_table,regions_table,reg_proj,stat_level,region_ids = args
+    sql = """SELECT g.id AS gid, r.rid,SUM(AREA(ST_Intersection(r.rgeom,g.geometry))) AS overlap
+FROM
+(SELECT TRANSFORM(geometry,?) AS rgeom,NUTS_ID AS rid
+    FROM {regions_table}
+    WHERE STAT_LEVL_=? AND NUTS_ID IN ({params})) AS r, {work_table} AS g
+WHERE g.ROWID IN (
+        SELECT ROWID
+        FROM SpatialIndex
+        WHERE f_table_name = {work_table_str}
+            AND search_frame = r.rgeom)
+    AND ST_Intersects(g.geometry,r.rgeom)
+GROUP BY r.rid,g.id""".format(regions_table=u.quote_identifier(regions_table),
+                              work_table=u.quote_identifier(work_table),
+                              work_table_str="'{}'".format(work_table.replace("'","''")),
+                              params=','.join(['?']*len(region_ids)))
+    return _worker_conn.execute(sql,[int(reg_proj),stat_level]+list(region_ids)).fetchall()
+
+
+def intersections_dict(gids,rids,overlaps):
+    """
+    Nested dictionary of intersection areas, as returned by get_intersections.
+
+    Args:
+        gids: grid cell ids
+        rids: region ids
+        overlaps: overlapping areas
+
+    Returns:
+        dict: areas of intersecting grid cells for each region
+    """
+    import numpy as np
 
-    logger.debug("Creating dictionary.")
     intersections = u.multilevel_dict()
-    for gid,rid,overlap in result:
+    for gid,rid,overlap in zip(np.asarray(gids).tolist(),np.asarray(rids).tolist(),
+                               np.asarray(overlaps).tolist()):
         intersections[rid][gid] = overlap
-
     return intersections
 
 
-def create_grid_polygons(x,y):
+def table_key(sdb_conn,table):
     """
-    Creates a list of grid polygons (rectangles) in well-known text (WKT) format from evenly spaced x and y vectors.
+    Cheap key of the state of a table, read without scanning it in Python: 
+    its schema and the version token kept by gis.data.track_table. Tables 
+    that are not tracked are keyed by SQL aggregates of their row ids and 
+    column values, which miss edits that keep these (e.g. a moved vertex or 
+    renamed id of the same length), so a warning is logged.
+
+    Args:
+        sdb_conn: connection object to spatial database
+        table: name of table
+
+    Returns:
+        tuple: key
+    """
+    schema = sdb_conn.execute("SELECT sql FROM sqlite_master WHERE type='table' "
+                              "AND lower(name)=lower(?)",(table,)).fetchone()
+    version = gisdata.table_version(sdb_conn,table)
+    if version is not None:
+        return (schema,version)
+
+    logger.warning('Table {} is not tracked, edits that keep its size may go unnoticed '
+                   'by the intersection cache (track it with prep-gis, or verify the '
+                   'cache).'.format(table))
+    esc_table = u.quote_identifier(table)
+    columns = [row[1] for row in sdb_conn.execute('PRAGMA table_info({})'.format(esc_table))]
+    aggregates = ['COUNT(*)','MAX(ROWID)']+['TOTAL(LENGTH({0})),TOTAL({0})'.format(
+        u.quote_identifier(column)) for column in columns]
+    return (schema,)+tuple(sdb_conn.execute('SELECT {} FROM {}'.format(
+        ','.join(aggregates),esc_table)).fetchone())
+
+
+def tables_fingerprint(sdb_conn,grid_table,regions_table):
+    """Content fingerprints of the grid and regions tables, see table_fingerprint."""
+    return '{} {}'.format(table_fingerprint(sdb_conn,grid_table),
+                          table_fingerprint(sdb_conn,regions_table))
+
+
+def table_fingerprint(sdb_conn,table,batch_size=2**12):
+    """
+    Fingerprint of the contents of a table: a hash of all columns of all rows 
+    in row id order, so that any edit (geometries, ids, levels) is noticed. 
+    One scan of the table in Python, cheaper than calculating intersections 
+    but too slow to check on every cache read (see table_key).
+
+    Args:
+        sdb_conn: connection object to spatial database
+        table: name of table
+        batch_size: number of rows fetched at a time
+
+    Returns:
+        str: hex digest
+    """
+    fingerprint = hashlib.sha1()
+    cursor = sdb_conn.execute('SELECT ROWID,* FROM {} ORDER BY ROWID'.format(
+        u.quote_identifier(table)))
+    rows = cursor.fetchmany(batch_size)
+    while rows:
+        for row in rows:
+            # Geometry blobs are hashed separately to keep the row repr short
+            fingerprint.update(repr(tuple(hashlib.sha1(value).hexdigest()
+                                          if isinstance(value,buffer) else value
+                                          for value in row)))
+        rows = cursor.fetchmany(batch_size)
+    return fingerprint.hexdigest()
+
+
+def intersection_cache_path(sdb_conn, regions_table, grid_table, reg_proj, grid_proj, stat_level, backend='spatialite'):
+    """
+    Path of the intersection cache file for the given tables and settings, 
+    next to the database file.
+
+    Returns:
+        str: path to cache file (None for in-memory databases)
+    """
+    db_path = [row[2] for row in sdb_conn.execute('PRAGMA database_list') if row[1]=='main']
+    if not db_path or not db_path[0]:
+        return None
+
+    key = repr((INTERSECTION_CACHE_VERSION,
+                grid_table,table_key(sdb_conn,grid_table),
+                regions_table,table_key(sdb_conn,regions_table),
+                int(reg_proj),int(grid_proj),stat_level,backend))
+    logger.debug('Intersection cache key: {}'.format(key))
+    return '{}.intersections-{}.npz'.format(db_path[0],hashlib.sha1(key).hexdigest()[:16])
+
+
+def write_intersection_cache(path,gids,rids,overlaps,tables=''):
+    """
+    Save intersections to cache file, via a temporary file, with the 
+    fingerprint of the tables they were calculated from.
+    """
+    import numpy as np
+
+    tmp_path = '{}.{}.tmp.npz'.format(path,os.getpid())
+    np.savez_compressed(tmp_path,gids=gids,rids=rids,overlaps=overlaps,
+                        tables=np.array(tables))
+    try:
+        os.rename(tmp_path,path)
+    except OSError:
+        # Written by another process in the meantime
+        os.remove(tmp_path)
+
+
+def read_intersection_cache(path):
+    """
+    Read intersections from cache file as arrays of gids, rids and overlaps, 
+    and the fingerprint of the tables (None if not saved).
+    """
+    import numpy as np
+
+    with np.load(path) as cached:
+        tables = str(cached['tables']) if 'tables' in cached else None
+        return cached['gids'],cached['rids'],cached['overlaps'],tables
+
+
+def grid_spacing(x,y):
+    """
+    Check that x and y vectors are evenly spaced and return the spacing.
 
     Args:
         x (1d numpy array): vector of x-values
         y (1d numpy array): vector of y-values
 
     Returns:
-        list: grid polygons in WKT format
+        tuple: spacing in x and y
     """
     import numpy as np
-    import pdb
 
     xdiff = np.diff(x)
     if np.std(xdiff)>1e-10:
@@ -71,6 +407,23 @@ def create_grid_polygons(x,y):
     dy = np.mean(ydiff)
 
     logger.debug('Spacing is ({},{})'.format(dx,dy))
+    return dx,dy
+
+
+def create_grid_polygons(x,y):
+    """
+    Creates a list of grid polygons (rectangles) in well-known text (WKT) format from evenly spaced x and y vectors.
+
+    Args:
+        x (1d numpy array): vector of x-values
+        y (1d numpy array): vector of y-values
+
+    Returns:
+        list: grid polygons in WKT format
+    """
+    import numpy as np
+
+    dx,dy = grid_spacing(x,y)
     xmatr,ymatr = np.meshgrid(x,y)
 
     rows = []
@@ -83,6 +436,81 @@ def create_grid_polygons(x,y):
     return rows
 
 
+# Little-endian well-known binary (WKB) polygon with one ring of five points
+WKB_POLYGON_DTYPE = [('order','u1'),('type','<u4'),('num_rings','<u4'),
+                     ('num_points','<u4'),('coords','<f8',(10,))]
+GRID_DTYPE = [('row','<i8'),('col','<i8'),('long','<f8'),('lat','<f8'),
+              ('wkb',WKB_POLYGON_DTYPE)]
+
+def create_grid_wkb(x,y,row_offset=0):
+    """
+    Creates grid polygons (rectangles) as little-endian WKB in a structured 
+    array, vectorized over all cells.
+
+    Args:
+        x (1d numpy array): vector of x-values
+        y (1d numpy array): vector of y-values
+        row_offset (int): row number of the first y-value
+
+    Returns:
+        numpy.ndarray: structured array with row, col, long, lat and wkb 
+            fields, in row-major order
+    """
+    import numpy as np
+
+    x,y = np.asarray(x,dtype=float),np.asarray(y,dtype=float)
+    dx,dy = grid_spacing(x,y)
+    return _grid_wkb(x,y,dx,dy,row_offset)
+
+
+def _grid_wkb(x,y,dx,dy,row_offset=0):
+    """Structured array of WKB grid cells for given x, y and spacing."""
+    import numpy as np
+
+    grid = np.empty((len(y),len(x)),dtype=GRID_DTYPE)
+    grid['row'] = (np.arange(len(y))+row_offset)[:,np.newaxis]
+    grid['col'] = np.arange(len(x))[np.newaxis,:]
+    grid['long'] = x[np.newaxis,:]
+    grid['lat'] = y[:,np.newaxis]
+
+    wkb = grid['wkb']
+    wkb['order'] = 1
+    wkb['type'] = 3
+    wkb['num_rings'] = 1
+    wkb['num_points'] = 5
+    x1,x2 = grid['long']-dx/2.,grid['long']+dx/2.
+    y1,y2 = grid['lat']-dy/2.,grid['lat']+dy/2.
+    coords = wkb['coords']
+    # Same ring as the WKT polygons: (x1 y1,x1 y2,x2 y2,x2 y1,x1 y1)
+    for k,(xc,yc) in enumerate([(x1,y1),(x1,y2),(x2,y2),(x2,y1),(x1,y1)]):
+        coords[...,2*k] = xc
+        coords[...,2*k+1] = yc
+
+    return grid.ravel()
 
 
+def iter_grid_wkb(x,y,band_rows=64):
+    """
+    Generate grid rows (row, col, long, lat, wkb) for insertion with 
+    GeomFromWKB, building the polygons vectorized in bands of latitude rows 
+    so that memory use stays small for fine grids.
+
+    Args:
+        x (1d numpy array): vector of x-values
+        y (1d numpy array): vector of y-values
+        band_rows (int): number of latitude rows built at a time
+
+    Yields:
+        tuple: row, col, long, lat and WKB polygon as buffer
+    """
+    import numpy as np
 
+    x,y = np.asarray(x,dtype=float),np.asarray(y,dtype=float)
+    dx,dy = grid_spacing(x,y)
+    for start in xrange(0,len(y),band_rows):
+        band = _grid_wkb(x,y[start:start+band_rows],dx,dy,start)
+        raw = band['wkb'].tobytes()
+        size = band.dtype['wkb'].itemsize
+        for k,(i,j,x_ij,y_ij) in enumerate(zip(band['row'].tolist(),band['col'].tolist(),
+                                                band['long'].tolist(),band['lat'].tolist())):
+            yield i,j,x_ij,y_ij,buffer(raw,k*size,size)
@@ -1,4 +1,7 @@
 import pysqlite2.dbapi2 as sqlite
+from contextlib import contextmanager
+from itertools import islice
+import time
 import os
 import logging
 import prow.utils as u
@@ -8,6 +11,10 @@ logger = logging.getLogger(__name__)
 GEOM_COL_TYPES = ['POLYGON','MULTIPOLYGON','POINT']
 OTHER_COL_TYPES = ['REAL','INTEGER','TEXT','BLOB']
 
+# Metadata table with a version token per tracked table, see track_table
+VERSIONS_TABLE = 'prow_table_versions'
+VERSION_TRIGGERS = [('ins','INSERT'),('upd','UPDATE'),('del','DELETE')]
+
 def copy_geoms(to_conn,to_table,from_db,from_tables,geom_col='geometry',
                 calc_area_col='shape_area',**kwargs):
     """
@@ -51,14 +58,112 @@ def drop_table(conn,table):
     conn.execute(sql)
 
 
-def connect_spatial_db(path,dll_path):
+def drop_spatial_table(conn,table,geom_col='geometry'):
+    """
+    Drop a spatial table together with its spatial index and metadata.
+
+    Args:
+        conn: database connection object
+        table: name of table to drop
+        geom_col: name of geometry column
+    """
+    registered = conn.execute('SELECT COUNT(*) FROM geometry_columns '
+                              'WHERE lower(f_table_name)=lower(?)',(table,)).fetchone()[0]
+    if registered:
+        logger.debug('Discarding geometry column of {}.'.format(table))
+        conn.execute('SELECT DisableSpatialIndex(?,?)',(table,geom_col))
+        conn.execute('DROP TABLE IF EXISTS {}'.format(
+            u.quote_identifier('idx_{}_{}'.format(table,geom_col))))
+        conn.execute('SELECT DiscardGeometryColumn(?,?)',(table,geom_col))
+    drop_table(conn,table)
+    conn.commit()
+
+
+def track_table(conn,table):
+    """
+    Keep a version token of a table in VERSIONS_TABLE, renewed by triggers on
+    every insert, update and delete, so that changes to the table can be 
+    noticed without reading it (see table_version). Call after bulk loads, 
+    as the triggers fire once per row.
+
+    Args:
+        conn: database connection object
+        table: name of table to track
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS {} (table_name TEXT PRIMARY KEY, '
+                 'version TEXT)'.format(u.quote_identifier(VERSIONS_TABLE)))
+    literal = "'{}'".format(table.replace("'","''"))
+    for suffix,event in VERSION_TRIGGERS:
+        trigger = u.quote_identifier('{}_{}_{}'.format(VERSIONS_TABLE,table,suffix))
+        conn.execute('DROP TRIGGER IF EXISTS {}'.format(trigger))
+        conn.execute('CREATE TRIGGER {} AFTER {} ON {} BEGIN UPDATE {} '
+                     'SET version=lower(hex(randomblob(8))) WHERE table_name={}; END'.format(
+                         trigger,event,u.quote_identifier(table),
+                         u.quote_identifier(VERSIONS_TABLE),literal))
+    conn.execute('INSERT OR REPLACE INTO {} VALUES (?,lower(hex(randomblob(8))))'.format(
+        u.quote_identifier(VERSIONS_TABLE)),(table,))
+    conn.commit()
+    logger.info('Tracking changes to table {}.'.format(table))
+
+
+def table_version(conn,table):
+    """
+    Version token of a table tracked with track_table.
+
+    Args:
+        conn: database connection object
+        table: name of table
+
+    Returns:
+        str: version token, None if the table is not tracked (or was dropped 
+            and created again since, which drops its triggers)
+    """
+    triggers = ['{}_{}_{}'.format(VERSIONS_TABLE,table,suffix) for suffix,_ in VERSION_TRIGGERS]
+    count = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='trigger' "
+                         "AND name IN ({})".format(','.join('?'*len(triggers))),
+                         triggers).fetchone()[0]
+    if count < len(triggers):
+        return None
+    row = conn.execute('SELECT version FROM {} WHERE table_name=?'.format(
+        u.quote_identifier(VERSIONS_TABLE)),(table,)).fetchone()
+    return row[0] if row else None
+
+
+def has_spatial_metadata(conn):
+    """
+    Check if a db already has spatial metadata tables.
+
+    Args:
+        conn: database connection object
+    """
+    count = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' "
+                         "AND name IN ('geometry_columns','spatial_ref_sys')").fetchone()[0]
+    return count == 2
+
+def set_readonly(conn,mmap_size=2**28):
+    """
+    Make a connection query-only and let it read the db file through memory 
+    mapped I/O, which the OS shares between processes reading the same file.
+
+    Args:
+        conn: database connection object
+        mmap_size: maximum number of bytes to memory map
+    """
+    conn.execute('PRAGMA query_only=ON')
+    conn.execute('PRAGMA mmap_size={}'.format(int(mmap_size)))
+
+def connect_spatial_db(path,dll_path,readonly=False,mmap_size=2**28):
     """
     Connect to a spatial db and init metadata (if not existing).
 
     Args:
         path: path to db file
         dll_path: path to mod_spatialite.dll
+        readonly: open a query-only connection, see set_readonly
+        mmap_size: bytes to memory map for read-only connections
     """
+    if readonly and not os.path.exists(path):
+        raise IOError("No database at '{}'.".format(path))
     logger.debug("Connecting to db at '{}'".format(path))
     conn = sqlite.connect(path)
     conn.enable_load_extension(True)
@@ -69,13 +174,102 @@ def connect_spatial_db(path,dll_path):
     with u.addpath(dll_path):
         conn.load_extension('mod_spatialite.dll')
 
-    logger.info("Initializing spatial metadata.")
-    conn.execute("BEGIN ;")
-    conn.execute('SELECT InitSpatialMetaData()')
-    conn.execute("COMMIT ;")
+    if has_spatial_metadata(conn):
+        logger.debug("Spatial metadata exists.")
+    elif readonly:
+        raise ValueError("No spatial metadata in '{}'.".format(path))
+    else:
+        logger.info("Initializing spatial metadata.")
+        conn.execute("BEGIN ;")
+        conn.execute('SELECT InitSpatialMetaData()')
+        conn.execute("COMMIT ;")
+
+    if readonly:
+        set_readonly(conn,mmap_size)
+    return conn
+
+def connect_db(path,readonly=False,mmap_size=2**28):
+    """
+    Connect to a db without loading the spatialite extension, e.g. for the 
+    numpy intersection backend, which reads geometry blobs directly.
 
+    Args:
+        path: path to db file
+        readonly: open a query-only connection, see set_readonly
+        mmap_size: bytes to memory map for read-only connections
+    """
+    if not os.path.exists(path):
+        raise IOError("No database at '{}'.".format(path))
+    logger.debug("Connecting to db at '{}' without spatialite".format(path))
+    conn = sqlite.connect(path)
+    if readonly:
+        set_readonly(conn,mmap_size)
     return conn
 
+class ConnectionFactory(object):
+    """
+    Creates connections to one db with fixed settings and keeps a pool of 
+    idle connections for reuse. Factories can be pickled (without their 
+    pool) and passed to worker processes, which then open their own 
+    connections.
+    """
+    def __init__(self,path,dll_path=None,readonly=False,spatialite=True,
+                 mmap_size=2**28,shared_cache=True):
+        """
+        Args:
+            path: path to db file
+            dll_path: path to mod_spatialite.dll
+            readonly: open query-only connections
+            spatialite: load the spatialite extension
+            mmap_size: bytes to memory map for read-only connections
+            shared_cache: share the page cache between connections in a 
+                process, if supported by the sqlite module
+        """
+        self.path = path
+        self.dll_path = dll_path
+        self.readonly = readonly
+        self.spatialite = spatialite
+        self.mmap_size = mmap_size
+        self.shared_cache = shared_cache
+        self._pool = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = []
+        return state
+
+    def __call__(self):
+        """Open a new connection."""
+        if self.shared_cache and hasattr(sqlite,'enable_shared_cache'):
+            sqlite.enable_shared_cache(True)
+        if self.spatialite:
+            return connect_spatial_db(self.path,self.dll_path,self.readonly,self.mmap_size)
+        return connect_db(self.path,self.readonly,self.mmap_size)
+
+    def writable(self):
+        """Factory for writable connections with otherwise the same settings."""
+        return ConnectionFactory(self.path,self.dll_path,False,self.spatialite,
+                                 self.mmap_size,self.shared_cache)
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager lending a connection from the pool, or a new one if 
+        none is idle. Uncommitted changes are rolled back on return.
+        """
+        conn = self._pool.pop() if self._pool else self()
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+            self._pool.append(conn)
+
+    def close(self):
+        """Close all idle connections."""
+        while self._pool:
+            self._pool.pop().close()
+
+
 def create_spatial_table(conn,tbl_name,srid,geom_type,other_cols=None,geom_col='geometry'):
     """
     Create a spatial table.
@@ -125,6 +319,112 @@ def create_spatial_table(conn,tbl_name,srid,geom_type,other_cols=None,geom_col='
     conn.execute(sql)
 
 
+@contextmanager
+def bulk_load_pragmas(conn,journal_mode='MEMORY',synchronous='OFF',cache_size_mb=256):
+    """
+    Context manager setting pragmas for fast bulk loading, restoring the 
+    previous settings afterwards. Not crash safe while active.
+
+    Args:
+        conn: database connection object
+        journal_mode: journal mode during load
+        synchronous: synchronous setting during load
+        cache_size_mb: page cache size in MB during load
+    """
+    def set_pragmas(pragmas):
+        # Pragmas may not be changed inside a transaction
+        conn.commit()
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None
+        for name,value in pragmas:
+            conn.execute('PRAGMA {}={}'.format(name,value))
+        conn.isolation_level = isolation_level
+
+    previous = [(name,conn.execute('PRAGMA {}'.format(name)).fetchone()[0])
+                    for name in ['journal_mode','synchronous','cache_size']]
+    logger.debug('Pragmas before bulk load: {}'.format(previous))
+    set_pragmas([('journal_mode',journal_mode),('synchronous',synchronous),
+                 ('cache_size',-1024*int(cache_size_mb))])
+    try:
+        yield
+    finally:
+        set_pragmas(previous)
+
+def spatial_index_enabled(conn,table,geom_col='geometry'):
+    """
+    Check if a geometry column has a spatial index.
+
+    Args:
+        conn: database connection object
+        table: name of table
+        geom_col: name of geometry column
+    """
+    row = conn.execute('SELECT spatial_index_enabled FROM geometry_columns '
+                       'WHERE lower(f_table_name)=lower(?) AND lower(f_geometry_column)=lower(?)',
+                       (table,geom_col)).fetchone()
+    return bool(row and row[0])
+
+def bulk_insert(conn,table,columns,rows,geom_col='geometry',srid=4326,
+                geom_format='WKB',batch_size=100000,spatial_index=True):
+    """
+    Insert rows with a geometry into a spatial table in large transactions. 
+    An existing spatial index is dropped during the load, and the index is 
+    (re)built once all rows are inserted. Use together with 
+    bulk_load_pragmas for best speed.
+
+    Args:
+        conn: database connection object
+        table: name of table
+        columns: names of non-geometry columns
+        rows: iterable of tuples with values for columns followed by geometry
+        geom_col: name of geometry column
+        srid: SRID of geometries
+        geom_format: 'WKB' (binary) or 'WKT' (text) geometries
+        batch_size: number of rows per transaction
+        spatial_index: create spatial index after loading
+
+    Returns:
+        int: number of inserted rows
+    """
+    geom_fcn = {'WKB': 'GeomFromWKB','WKT': 'GeomFromText'}[geom_format.upper()]
+    esc_table = u.quote_identifier(table)
+    col_str = ','.join(map(u.quote_identifier,list(columns)+[geom_col]))
+    params = ','.join(['?']*len(columns)+['{}(?,{})'.format(geom_fcn,int(srid))])
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(esc_table,col_str,params)
+    logger.debug("Bulk insert SQL:\n   '{}'".format(sql))
+
+    if spatial_index_enabled(conn,table,geom_col):
+        logger.info('Dropping spatial index on {} during load.'.format(esc_table))
+        conn.execute('SELECT DisableSpatialIndex(?,?)',(table,geom_col))
+        conn.execute('DROP TABLE IF EXISTS {}'.format(
+            u.quote_identifier('idx_{}_{}'.format(table,geom_col))))
+        conn.commit()
+
+    rows = iter(rows)
+    count = 0
+    start = time.time()
+    cur = conn.cursor()
+    while True:
+        batch = list(islice(rows,batch_size))
+        if not batch:
+            break
+        cur.executemany(sql,batch)
+        conn.commit()
+        count += len(batch)
+        logger.debug('Inserted {} rows ({:.0f} rows/s).'.format(
+            count,count/max(time.time()-start,1e-9)))
+    elapsed = time.time()-start
+    logger.info('Inserted {} rows into {} in {:.1f} s ({:.0f} rows/s).'.format(
+        count,esc_table,elapsed,count/max(elapsed,1e-9)))
+
+    if spatial_index:
+        logger.info('Creating spatial index on {}.'.format(esc_table))
+        start = time.time()
+        conn.execute('SELECT CreateSpatialIndex(?,?)',(table,geom_col))
+        conn.commit()
+        logger.info('Created spatial index in {:.1f} s.'.format(time.time()-start))
+
+    return count
 
 
 if __name__ == '__main__':
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Analytic overlay of region polygons on a regular lat/long grid, in plain
+NumPy and without the spatialite extension.
+
+Coordinates are mapped to a cylindrical equal-area projection of the GRS80
+ellipsoid, where grid cells stay rectangles and areas are preserved. The
+area of a polygon within each cell then follows from Green's theorem,
+summing contributions of polygon edges split at the grid lines.
+"""
+import numpy as np
+import struct
+import logging
+import prow.utils as u
+
+logger = logging.getLogger(__name__)
+
+# GRS80 semi-major axis and eccentricity (as used by ETRS89 and EPSG:3035)
+GRS80_A = 6378137.
+GRS80_E = np.sqrt(2./298.257222101-(1./298.257222101)**2)
+
+# SRIDs of geographic (long/lat) coordinate systems handled by the overlay
+GEOGRAPHIC_SRIDS = (4326,4258)
+# ETRS89 Lambert azimuthal equal-area (EPSG:3035): centre long/lat, false
+# easting and northing
+LAEA_SRID = 3035
+LAEA_CENTRE = (10.,52.)
+LAEA_FALSE_ORIGIN = (4321000.,3210000.)
+
+def _authalic_q(lats):
+    """Authalic latitude function q of the GRS80 ellipsoid, see Snyder (1987), eq. 3-12."""
+    e = GRS80_E
+    sin_lat = np.sin(np.radians(np.clip(lats,-90.,90.)))
+    return (1.-e**2)*(sin_lat/(1.-(e*sin_lat)**2)
+                      -np.log((1.-e*sin_lat)/(1.+e*sin_lat))/(2.*e))
+
+def equal_area_coordinates(longs,lats):
+    """
+    Project long/lat to a cylindrical equal-area projection of the GRS80
+    ellipsoid, in metres.
+
+    Args:
+        longs (array): longitudes in degrees
+        lats (array): latitudes in degrees
+
+    Returns:
+        tuple: x and y arrays
+    """
+    return GRS80_A*np.radians(longs),GRS80_A*_authalic_q(lats)/2.
+
+def laea_to_geographic(x,y):
+    """
+    Inverse of the ETRS89 Lambert azimuthal equal-area projection
+    (EPSG:3035), see EPSG Guidance Note 7-2, method 9820.
+
+    Args:
+        x (array): eastings in metres
+        y (array): northings in metres
+
+    Returns:
+        tuple: longitude and latitude arrays in degrees
+    """
+    e = GRS80_E
+    lon0,lat0 = np.radians(LAEA_CENTRE)
+    q_p,q_0 = _authalic_q(90.),_authalic_q(LAEA_CENTRE[1])
+    beta0 = np.arcsin(q_0/q_p)
+    r_q = GRS80_A*np.sqrt(q_p/2.)
+    d = GRS80_A*np.cos(lat0)/np.sqrt(1.-(e*np.sin(lat0))**2)/(r_q*np.cos(beta0))
+
+    dx = np.asarray(x,dtype=float)-LAEA_FALSE_ORIGIN[0]
+    dy = np.asarray(y,dtype=float)-LAEA_FALSE_ORIGIN[1]
+    rho = np.hypot(dx/d,d*dy)
+    c = 2.*np.arcsin(np.clip(rho/(2.*r_q),-1.,1.))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        beta = np.where(rho>0,np.arcsin(np.cos(c)*np.sin(beta0)
+                                        +d*dy*np.sin(c)*np.cos(beta0)/rho),beta0)
+    lat = (beta+(e**2/3.+31.*e**4/180.+517.*e**6/5040.)*np.sin(2.*beta)
+           +(23.*e**4/360.+251.*e**6/3780.)*np.sin(4.*beta)
+           +761.*e**6/45360.*np.sin(6.*beta))
+    lon = lon0+np.arctan2(dx*np.sin(c),
+                          d*rho*np.cos(beta0)*np.cos(c)-d**2*dy*np.sin(beta0)*np.sin(c))
+    return np.degrees(lon),np.degrees(lat)
+
+def read_spatialite_geometry(blob):
+    """
+    Read polygons from a geometry in SpatiaLite's internal BLOB format.
+
+    Args:
+        blob: POLYGON or MULTIPOLYGON geometry blob (uncompressed, any
+            dimension model)
+
+    Returns:
+        tuple: SRID and list of polygons, each a list of rings as (n,2)
+            arrays of x and y, exterior ring first
+    """
+    data = str(blob)
+    if len(data) < 44 or data[0] != '\x00' or data[38] != '\x7c' or data[-1] != '\xfe':
+        raise ValueError('Not a SpatiaLite geometry blob.')
+    endian = '<' if data[1] == '\x01' else '>'
+    srid,geom_type = struct.unpack_from(endian+'i',data,2)[0],struct.unpack_from(endian+'i',data,39)[0]
+
+    def read_polygon(pos,geom_type):
+        if geom_type >= 1000000 or geom_type%1000 != 3:
+            raise ValueError('Unsupported geometry type {}.'.format(geom_type))
+        dims = {0: 2, 1: 3, 2: 3, 3: 4}[geom_type//1000]
+        num_rings = struct.unpack_from(endian+'i',data,pos)[0]
+        pos += 4
+        rings = []
+        for _ in xrange(num_rings):
+            num_points = struct.unpack_from(endian+'i',data,pos)[0]
+            pos += 4
+            coords = np.frombuffer(data,dtype=endian+'f8',count=num_points*dims,
+                                   offset=pos).reshape(num_points,dims)
+            rings.append(coords[:,:2].astype(float))
+            pos += 8*num_points*dims
+        return rings,pos
+
+    if geom_type%1000 == 6 and geom_type < 1000000:
+        num_polygons = struct.unpack_from(endian+'i',data,43)[0]
+        pos = 47
+        polygons = []
+        for _ in xrange(num_polygons):
+            if data[pos] != '\x69':
+                raise ValueError('Invalid entity in SpatiaLite MULTIPOLYGON.')
+            rings,pos = read_polygon(pos+5,struct.unpack_from(endian+'i',data,pos+1)[0])
+            polygons.append(rings)
+    else:
+        rings,pos = read_polygon(43,geom_type)
+        polygons = [rings]
+    return srid,polygons
+
+def read_grid(conn,grid_table='merra_grid'):
+    """
+    Read a regular lat/long grid created by create-grid from its row, col,
+    long and lat columns.
+
+    Args:
+        conn: database connection object (no spatialite needed)
+        grid_table: name of table containing grid
+
+    Returns:
+        tuple: cell edges in longitude and latitude (both increasing) and
+            (lat,long) array of cell ids (-1 for missing cells)
+    """
+    import prow.gis.calculations as calc
+
+    sql = 'SELECT id,row,col,long,lat FROM {}'.format(u.quote_identifier(grid_table))
+    cells = np.array(conn.execute(sql).fetchall(),dtype=float)
+    if not len(cells):
+        raise ValueError('Grid table {} is empty.'.format(grid_table))
+    rows,cols = cells[:,1].astype(np.int64),cells[:,2].astype(np.int64)
+    ids = np.full((rows.max()+1,cols.max()+1),-1,dtype=np.int64)
+    ids[rows,cols] = cells[:,0]
+    x = np.full(ids.shape[1],np.nan)
+    y = np.full(ids.shape[0],np.nan)
+    x[cols] = cells[:,3]
+    y[rows] = cells[:,4]
+    if np.isnan(x).any() or np.isnan(y).any():
+        raise ValueError('Grid table {} has missing rows or columns.'.format(grid_table))
+
+    dx,dy = calc.grid_spacing(x,y)
+    if dx < 0:
+        x,ids,dx = x[::-1],ids[:,::-1],-dx
+    if dy < 0:
+        y,ids,dy = y[::-1],ids[::-1],-dy
+    x_edges = np.append(x-dx/2.,x[-1]+dx/2.)
+    y_edges = np.clip(np.append(y-dy/2.,y[-1]+dy/2.),-90.,90.)
+    return x_edges,y_edges,ids
+
+def polygon_cell_areas(rings,x_edges,y_edges):
+    """
+    Area of a polygon within each cell of a rectangular grid.
+
+    The polygon's edges are split where they cross grid lines. By Green's
+    theorem, a piece with horizontal extent dx in column i and row r adds
+    -dx*(mean y - lower edge of r) to cell (r,i) and -dx*(height of j) to
+    each cell (j,i) below it, with exterior rings counter-clockwise and holes
+    clockwise. Pieces above the grid add to all its rows.
+
+    Args:
+        rings (list): rings of a polygon (or of several non-overlapping
+            polygons) as (n,2) arrays of x and y
+        x_edges (1d array): increasing x-values of cell edges
+        y_edges (1d array): increasing y-values of cell edges
+
+    Returns:
+        tuple: row and column indices of cells and areas within them
+    """
+    starts,ends = [],[]
+    for ring in rings:
+        ring = np.asarray(ring,dtype=float)
+        if len(ring) < 3:
+            continue
+        if not np.array_equal(ring[0],ring[-1]):
+            ring = np.vstack([ring,ring[:1]])
+        starts.append(ring[:-1])
+        ends.append(ring[1:])
+    if not starts:
+        return np.empty(0,dtype=np.int64),np.empty(0,dtype=np.int64),np.empty(0)
+    p0,p1 = np.vstack(starts),np.vstack(ends)
+
+    # Candidate cells from bounding box
+    lo,hi = np.minimum(p0,p1).min(axis=0),np.maximum(p0,p1).max(axis=0)
+    c0 = max(np.searchsorted(x_edges,lo[0],'right')-1,0)
+    c1 = min(np.searchsorted(x_edges,hi[0],'left'),len(x_edges)-1)
+    r0 = max(np.searchsorted(y_edges,lo[1],'right')-1,0)
+    r1 = min(np.searchsorted(y_edges,hi[1],'left'),len(y_edges)-1)
+    if c0 >= c1 or r0 >= r1 or hi[1] <= y_edges[0]:
+        return np.empty(0,dtype=np.int64),np.empty(0,dtype=np.int64),np.empty(0)
+    xe,ye = x_edges[c0:c1+1],y_edges[r0:r1+1]
+    num_rows,num_cols = len(ye)-1,len(xe)-1
+
+    # Split edges where they cross grid lines: parameters t along each edge
+    edge_idx,t = [np.arange(len(p0)).repeat(2)],[np.tile([0.,1.],len(p0))]
+    for dim,edges in [(0,xe),(1,ye)]:
+        a,b = p0[:,dim],p1[:,dim]
+        first = np.searchsorted(edges,np.minimum(a,b),'right')
+        count = np.searchsorted(edges,np.maximum(a,b),'left')-first
+        count = np.maximum(count,0)
+        idx = np.arange(len(p0)).repeat(count)
+        # Index of each crossed line: first line of the edge plus running number
+        line = first.repeat(count)+np.arange(count.sum())-(np.cumsum(count)-count).repeat(count)
+        edge_idx.append(idx)
+        t.append((edges[line]-a[idx])/(b[idx]-a[idx]))
+    edge_idx,t = np.concatenate(edge_idx),np.concatenate(t)
+    order = np.lexsort((t,edge_idx))
+    edge_idx,t = edge_idx[order],t[order]
+
+    # Pieces between consecutive split points of the same edge
+    same = edge_idx[1:] == edge_idx[:-1]
+    idx,ta,tb = edge_idx[:-1][same],t[:-1][same],t[1:][same]
+    delta = p1[idx]-p0[idx]
+    dx = delta[:,0]*(tb-ta)
+    mid_x = p0[idx,0]+delta[:,0]*(ta+tb)/2.
+    mean_y = p0[idx,1]+delta[:,1]*(ta+tb)/2.
+
+    col = np.searchsorted(xe,mid_x,'right')-1
+    row = np.minimum(np.searchsorted(ye,mean_y,'right')-1,num_rows)
+    keep = (col>=0) & (col<num_cols) & (row>=0) & (dx!=0)
+    col,row,dx,mean_y = col[keep],row[keep],dx[keep],mean_y[keep]
+
+    heights = np.diff(ye)
+    # Contribution to the cell of each piece
+    inside = row<num_rows
+    areas = np.bincount(row[inside]*num_cols+col[inside],
+                        weights=-dx[inside]*(mean_y[inside]-ye[row[inside]]),
+                        minlength=num_rows*num_cols).reshape(num_rows,num_cols)
+    # bincount gives integers when no piece is inside the rows
+    areas = areas.astype(float)
+    # Contributions to cells below each piece, from sums of dx above each row
+    dx_sums = np.bincount(row*num_cols+col,weights=dx,
+                          minlength=(num_rows+1)*num_cols).reshape(num_rows+1,num_cols)
+    dx_above = np.cumsum(dx_sums[::-1],axis=0)[::-1][1:]
+    areas -= dx_above*heights[:,np.newaxis]
+
+    rows,cols = np.nonzero(areas > 1e-9*heights[:,np.newaxis]*np.diff(xe))
+    return rows+r0,cols+c0,areas[rows,cols]
+
+def oriented_rings(polygons):
+    """
+    Rings of polygons with exterior rings counter-clockwise and holes
+    clockwise, as needed by polygon_cell_areas.
+
+    Args:
+        polygons (list): polygons as lists of rings, exterior ring first
+
+    Returns:
+        list: reoriented rings
+    """
+    rings = []
+    for polygon in polygons:
+        for k,ring in enumerate(polygon):
+            x,y = ring[:,0],ring[:,1]
+            signed_area = np.dot(x,np.roll(y,-1))-np.dot(np.roll(x,-1),y)
+            if (signed_area > 0) != (k == 0):
+                ring = ring[::-1]
+            rings.append(ring)
+    return rings
+
+def grid_overlay(conn, regions_table='nuts2006', grid_table='merra_grid', stat_level=2):
+    """
+    Calculate area of intersections between regions and grid cells without
+    spatialite. The grid must be regular and created by create-grid, regions
+    in long/lat or in EPSG:3035 (as created by gis.data.copy_geoms). Vertices
+    of EPSG:3035 regions are projected back to long/lat, keeping edges
+    straight between them, which is negligible for densely digitised
+    boundaries. Areas are in square metres on the GRS80 ellipsoid, as in an
+    equal-area projection such as EPSG:3035. Cells only touching a region
+    are left out.
+
+    Args:
+        conn: database connection object (no spatialite needed)
+        regions_table: name of table containing region geometries
+        grid_table: name of table containing grid
+        stat_level: NUTS level of regions (value of STAT_LEVL_)
+
+    Returns:
+        tuple: arrays of grid cell ids, region ids and overlapping areas
+    """
+    x_edges,y_edges,ids = read_grid(conn,grid_table)
+    x_edges,y_edges = equal_area_coordinates(x_edges,y_edges)
+
+    sql = 'SELECT NUTS_ID,geometry FROM {} WHERE STAT_LEVL_=? ORDER BY NUTS_ID'.format(
+        u.quote_identifier(regions_table))
+    gids,rids,overlaps = [],[],[]
+    num_regions = 0
+    for rid,blob in conn.execute(sql,(stat_level,)):
+        srid,polygons = read_spatialite_geometry(blob)
+        if srid not in GEOGRAPHIC_SRIDS+(LAEA_SRID,):
+            raise ValueError('Region {} has SRID {}, need one of {}.'.format(
+                rid,srid,GEOGRAPHIC_SRIDS+(LAEA_SRID,)))
+        rings = []
+        for ring in oriented_rings(polygons):
+            longs,lats = ring[:,0],ring[:,1]
+            if srid == LAEA_SRID:
+                longs,lats = laea_to_geographic(longs,lats)
+            x,y = equal_area_coordinates(longs,lats)
+            rings.append(np.column_stack([x,y]))
+        rows,cols,areas = polygon_cell_areas(rings,x_edges,y_edges)
+        cell_ids = ids[rows,cols]
+        valid = cell_ids>=0
+        gids.append(cell_ids[valid])
+        rids.append(np.repeat(rid,np.count_nonzero(valid)))
+        overlaps.append(areas[valid])
+        num_regions += 1
+    logger.info('Overlaid {} regions on {} grid cells.'.format(num_regions,ids.size))
+
+    if not gids:
+        return np.empty(0,dtype=np.int64),np.empty(0,dtype=str),np.empty(0)
+    gids,rids,overlaps = np.concatenate(gids),np.concatenate(rids),np.concatenate(overlaps)
+    order = np.argsort(gids,kind='mergesort')
+    return gids[order],rids[order],overlaps[order]
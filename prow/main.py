@@ -2,6 +2,9 @@
 import click
 import logging, logging.config
 import windpower.tradewind
+import windpower.merra
+import windpower.windio
+import windpower.pipeline
 import os
 
 logger = logging.getLogger(__name__)
@@ -12,6 +15,17 @@ POWER_CURVES = {
     'tw_offshore': windpower.tradewind.offshore_future
 }
 
+def check_dll_path(dll_path,backend):
+    """Check that the spatialite DLL folder exists unless the numpy backend is used."""
+    if backend != 'numpy' and not os.path.isdir(dll_path):
+        raise click.BadParameter('Directory "{}" does not exist.'.format(dll_path),
+                                 param_hint="'--dll-path'")
+
+def unique(values):
+    """Values of a sequence without repetitions, in order of first appearance."""
+    seen = set()
+    return [v for v in values if not (v in seen or seen.add(v))]
+
 @click.group(help='process weather data to calculate vRES production and potential')
 @click.option('--debug',is_flag=True,help='Show debug messages.')
 def cli(debug):
@@ -23,55 +37,141 @@ def cli(debug):
 @cli.command('wind-production',help='calculate vRES production from weather data')
 @click.option('--source','-s',type=click.Path(exists=True,file_okay=False),required=True)
 @click.option('--dest','-d',type=click.Path(exists=True,file_okay=False),required=True)
-@click.option('--powercurve','-pc',type=click.Choice(POWER_CURVES.keys()),default='tw_lowland')
-@click.option('--extrap-method','-ex',type=click.Choice(['powerlaw','loglaw']),default='powerlaw')
-@click.option('--hubheight','-z',type=float,default=100.)
+@click.option('--powercurve','-pc',type=click.Choice(POWER_CURVES.keys()),default=('tw_lowland',),multiple=True,
+                help='power curve (repeat for several)')
+@click.option('--extrap-method','-ex',type=click.Choice(sorted(windpower.merra.EXTRAPOLATORS.keys())),default=('powerlaw',),multiple=True,
+                help='extrapolation method (repeat for several)')
+@click.option('--hubheight','-z',type=float,default=(100.,),multiple=True,
+                help='hub height (repeat for several)')
 @click.option('--datasource','-ds',
-                type=click.Choice(['merra','merra2']),
+                type=click.Choice(sorted(windpower.pipeline.DATASOURCES.keys())),
                 default='merra',
                 help='the origin of the data')
-def wind_production(dest,datasource,powercurve,extrap_method,hubheight,**kwargs):
-    kwargs['powercurve'] = POWER_CURVES[powercurve]
-
-    if 'merra' in datasource:
-        import windpower.merra
-        import h5py
-        extrapolator = windpower.merra.EXTRAPOLATORS[extrap_method]
-        kwargs['extrapolate'] = extrapolator(hubheight)
-
+@click.option('--chunk-size','-c',
+                type=int,
+                default=0,
+                help='number of time steps to process at a time (0 for whole year)')
+@click.option('--workers','-w',
+                type=int,
+                default=1,
+                help='number of years to process in parallel')
+@click.option('--out-dtype',
+                type=click.Choice(windpower.windio.OUTPUT_DTYPES),
+                default='float64',
+                help='storage type of output (int16 is scaled)')
+@click.option('--out-layout',
+                type=click.Choice(windpower.windio.OUTPUT_LAYOUTS),
+                default='contiguous',
+                help='chunk output for reading time steps or site series')
+@click.option('--compression',
+                type=click.Choice(windpower.windio.OUTPUT_COMPRESSION),
+                default='none',
+                help='output compression filter')
+@click.option('--compression-level',
+                type=click.IntRange(0,9),
+                default=4,
+                help='gzip compression level')
+@click.option('--stats/--no-stats',
+                default=True,
+                help='cache per-site statistics in output files')
+@click.option('--histogram/--no-histogram',
+                default=False,
+                help='save per-site histograms of hub height wind speed')
+@click.option('--incremental',
+                is_flag=True,
+                help='skip outputs that are up to date with their source and settings')
+@click.option('--prefetch-depth',
+                type=click.IntRange(0,None),
+                default=0,
+                help='slabs queued between reader, main and writer processes (0 to read and write in the main process)')
+@click.option('--threads','-t',
+                type=click.IntRange(0,None),
+                default=0,
+                help='threads evaluating each slab in cache-sized tiles (0 for whole slabs)')
+@click.option('--tile-size',
+                type=click.IntRange(1,None),
+                default=2**15,
+                help='grid cells times time steps per tile')
+@click.option('--sites-from',
+                type=click.Path(exists=True,dir_okay=False),
+                default=None,
+                help='compute only sites with fractions in an areas/classes file (or in a mask file)')
+@click.option('--bbox',
+                type=float,
+                nargs=4,
+                default=None,
+                help='compute only sites in a box: south north west east (degrees)')
+def wind_production(source,dest,datasource,powercurve,extrap_method,hubheight,chunk_size,workers,
+                    out_dtype,out_layout,compression,compression_level,stats,histogram,
+                    incremental,prefetch_depth,threads,tile_size,sites_from,bbox):
+    if datasource in windpower.pipeline.DATASOURCES:
+        storage = {'dtype': out_dtype,'layout': out_layout,
+                   'compression': compression,'compression_level': compression_level}
         logger.info('Processing wind data from {}.'.format(datasource.upper()))
-        for year,lats,longs,time,ws_z,wp_output in windpower.merra.production(**kwargs):
-            outfile_path = os.path.join(dest,
-                                        'windpower_output.{}.{}.{}m.{}.{}.hdf5'.format(datasource,
-                                                                                        extrap_method,
-                                                                                        int(hubheight),
-                                                                                        powercurve,
-                                                                                        year))
-            logger.debug('Trying to open h5 file {}.'.format(outfile_path))
-            with h5py.File(outfile_path,'w') as outfile:
-                logger.info('Saving to file {}.'.format(outfile_path))
-                outfile['longitude'] = longs
-                outfile['latitude'] = lats
-                outfile['time'] = time
-                outfile['ws_{}m'.format(int(hubheight))] = ws_z
-                outfile['wp_output'] = wp_output
+        powercurves = [(name,POWER_CURVES[name]) for name in unique(powercurve)]
+        jobs = windpower.pipeline.production_jobs(source,dest,datasource,powercurves,
+            unique(extrap_method),unique(hubheight),chunk_size,storage,stats,histogram,
+            prefetch_depth,threads,tile_size,sites_from,bbox or None)
+        if incremental:
+            jobs = windpower.pipeline.pending_jobs(jobs)
+        windpower.pipeline.run(jobs,workers)
     else:
         logger.error('Unknown data source!')
 
 
-@cli.command('prep-gis',help='preparatory GIS calculations')
+@cli.command('mean-output-from-histogram',help='calculate mean output per site from wind speed histograms')
+@click.option('--source','-s',
+                help='wind production file(s) with histograms, averaged together',
+                type=click.Path(exists=True,dir_okay=False),
+                multiple=True,
+                required=True)
+@click.option('--dest','-d',
+                help='file to save mean output',
+                type=click.Path(dir_okay=False),
+                required=True)
+@click.option('--powercurve','-pc',
+                help='power curve (repeat for several, all if not given)',
+                type=click.Choice(POWER_CURVES.keys()),
+                multiple=True)
+@click.option('--wind-key','-wk',
+                help='key of hub height wind speed (e.g. ws_100m)',
+                type=str,
+                default=None)
+def mean_output_from_histogram(source,dest,powercurve,wind_key):
+    import h5py
+    import numpy as np
+    import time as timer
+
+    names = unique(powercurve) or sorted(POWER_CURVES.keys())
+    start = timer.time()
+    lats,longs,means = windpower.windio.mean_output_from_histograms(sorted(source),
+        {name: POWER_CURVES[name] for name in names},wind_key)
+    logger.info('Evaluated {} power curves for {} sites in {:.2f} s.'.format(
+        len(names),lats.size*longs.size,timer.time()-start))
+
+    logger.info('Saving mean output to {}.'.format(dest))
+    with h5py.File(dest,'w') as outfile:
+        outfile['latitude'] = lats
+        outfile['longitude'] = longs
+        for name in names:
+            logger.info('Mean output for {}: {:.4f}.'.format(name,np.mean(means[name])))
+            outfile['mean_output/{}'.format(name)] = means[name]
+
+
+@cli.command('prep-gis',help='track grid and region tables so that cached intersections are reused without reading them')
 @click.option('--spatial-db','-s',type=click.Path(exists=True,dir_okay=False),required=True)
-@click.option('--dll-path','-dp',type=click.Path(exists=True,file_okay=False),required=True,default=r'D:\venvs\weather-data\DLLs')
-def prepare_gis(spatial_db,dll_path,**kwargs):
-    # import gis.calculations
-    # import gis.data
-    # import windpower.classes
-
-    # logger.info('Calculating intersections between grid and regions.')
-    # conn,gis.data.connect_spatial_db('C:/data_tmp/gis/test-gis.sqlite',dll_path)
-    # intersections = gis.calculations.get_intersections(conn,**kwargs)
-    # print intersections
-    logger.error('Not implemented!')
+@click.option('--table','-t',
+                help='table to track (repeat for several)',
+                type=str,
+                multiple=True,
+                default=('merra_grid','nuts2006'))
+def prepare_gis(spatial_db,table):
+    import gis.data
+
+    conn = gis.data.connect_db(spatial_db)
+    for name in unique(table):
+        gis.data.track_table(conn,name)
+    conn.close()
 
 @cli.command('create-grid',help='create spatial grid and save to db')
 @click.option('--lat-long-file','-l',type=click.Path(exists=True,dir_okay=False),required=True)
@@ -87,21 +187,17 @@ def create_grid(lat_long_file,spatial_db,dll_path,**kwargs):
     with h5py.File(lat_long_file,'r') as f:
         y,x = f['latitude'][:],f['longitude'][:]
 
-    logger.info('Creating grid polygons.')
-    polys = gis.calculations.create_grid_polygons(x,y)
-
     logger.info('Creating db table.')
     conn = gis.data.connect_spatial_db(spatial_db,dll_path)
     gis.data.drop_table(conn,'grid')
     gis.data.create_spatial_table(conn,'grid',4326,'POLYGON',
         other_cols=[('row','INTEGER'),('col','INTEGER'),('long','REAL'),('lat','REAL')])
 
-    logger.info('Inserting polygons.')
-    cur = conn.cursor()
-    sql = "INSERT INTO grid (row,col,long,lat,geometry) VALUES (?,?,?,?,GeomFromText(?,4326))"
-    logger.debug("SQL:\n"+sql)
-    cur.executemany(sql,polys)
-    conn.commit()
+    logger.info('Creating and inserting grid polygons.')
+    polys = gis.calculations.iter_grid_wkb(x,y)
+    with gis.data.bulk_load_pragmas(conn):
+        gis.data.bulk_insert(conn,'grid',['row','col','long','lat'],polys,srid=4326)
+    gis.data.track_table(conn,'grid')
     conn.close()
 
 
@@ -111,21 +207,40 @@ def create_grid(lat_long_file,spatial_db,dll_path,**kwargs):
                 type=click.Path(exists=True,dir_okay=False),
                 required=True)
 @click.option('--source','-s',
-                help='path to wind production folder',
-                type=click.Path(exists=True,file_okay=False),
+                help='path to wind production file (repeat for a multi-year mean)',
+                type=click.Path(exists=True,dir_okay=False),
+                multiple=True,
                 required=True)
 @click.option('--dest','-d',
                 help='directory to save wind class data',
                 type=click.Path(exists=True,file_okay=False),
                 required=True)
 @click.option('--dll-path','-dp',
-                help='path to spatialite extension DLLs',
-                type=click.Path(exists=True,file_okay=False),
+                help='path to spatialite extension DLLs (not needed with numpy backend)',
+                type=click.Path(file_okay=False),
                 default=r'D:\venvs\weather-data\DLLs')
 @click.option('--wind-key','-wk',
                 help='key to read wind production data from file',
                 type=str,
                 default='wp_output')
+@click.option('--stat-level',
+                help='NUTS level of regions',
+                type=int,
+                default=2)
+@click.option('--cache/--no-cache',
+                help='reuse cached grid/region intersections',
+                default=True)
+@click.option('--verify-cache',
+                help='hash the tables to check cached intersections (reads both tables)',
+                is_flag=True)
+@click.option('--workers','-w',
+                help='number of processes for calculating intersections',
+                type=int,
+                default=1)
+@click.option('--backend',
+                help='calculate intersections with spatialite or analytically with numpy',
+                type=click.Choice(['spatialite','numpy']),
+                default='spatialite')
 def create_classes(spatial_db,dll_path,source,dest,wind_key,**kwargs):
     import gis.calculations
     import gis.data
@@ -134,13 +249,22 @@ def create_classes(spatial_db,dll_path,source,dest,wind_key,**kwargs):
     import re
     import os
 
-    # Extract input settings from filename
-    source_base = os.path.basename(source)
-    input_settings = re.match(r'[^.]+\.(?P<fn>.+)\.hdf',source_base).group('fn')
+    check_dll_path(dll_path,kwargs['backend'])
+
+    # Extract input settings from filename(s), with year range if several
+    source = sorted(source)
+    settings = [re.match(r'[^.]+\.(?P<fn>.+)\.hdf',os.path.basename(s)).group('fn')
+                    for s in source]
+    input_settings = settings[0]
+    if len(settings) > 1:
+        input_settings = '{}-{}'.format(settings[0],settings[-1].rsplit('.',1)[-1])
 
     logger.info('Calculating intersections between grid and regions.')
-    conn = gis.data.connect_spatial_db(spatial_db,dll_path)
-    intersections = gis.calculations.get_intersections(conn,**kwargs)
+    db = gis.data.ConnectionFactory(spatial_db,dll_path,readonly=True,
+                                    spatialite=kwargs['backend']!='numpy')
+    with db.connection() as conn:
+        intersections = gis.calculations.get_intersections(conn,connect=db,**kwargs)
+    db.close()
 
     logger.info('Construct classes and calculate areas for each region.')
     logger.debug('Reading wind production data from file.')
@@ -175,8 +299,8 @@ def create_classes(spatial_db,dll_path,source,dest,wind_key,**kwargs):
                 type=click.Path(exists=False,dir_okay=False),
                 required=True)
 @click.option('--dll-path','-dp',
-                help='path to spatialite extension DLLs',
-                type=click.Path(exists=True,file_okay=False),
+                help='path to spatialite extension DLLs (not needed with numpy backend)',
+                type=click.Path(file_okay=False),
                 default=r'D:\venvs\weather-data\DLLs')
 @click.option('--grid-table','-gt',
                 help='name of table containing grid',
@@ -186,21 +310,156 @@ def create_classes(spatial_db,dll_path,source,dest,wind_key,**kwargs):
                 help='name of table containing regions',
                 type=str,
                 default='nuts2006')
+@click.option('--stat-level',
+                help='NUTS level of regions',
+                type=int,
+                default=2)
+@click.option('--cache/--no-cache',
+                help='reuse cached grid/region intersections',
+                default=True)
+@click.option('--verify-cache',
+                help='hash the tables to check cached intersections (reads both tables)',
+                is_flag=True)
+@click.option('--workers','-w',
+                help='number of processes for calculating intersections',
+                type=int,
+                default=1)
+@click.option('--backend',
+                help='calculate intersections with spatialite or analytically with numpy',
+                type=click.Choice(['spatialite','numpy']),
+                default='spatialite')
 def calc_areas(spatial_db,dll_path,dest,**kwargs):
     import gis.calculations
     import gis.data
     import windpower.classes
     import windpower.windio
 
+    check_dll_path(dll_path,kwargs['backend'])
     logger.info('Calculating intersections between grid and regions.')
-    conn = gis.data.connect_spatial_db(spatial_db,dll_path)
-    intersections = gis.calculations.get_intersections(conn,**kwargs)
+    db = gis.data.ConnectionFactory(spatial_db,dll_path,readonly=True,
+                                    spatialite=kwargs['backend']!='numpy')
+    with db.connection() as conn:
+        intersections = gis.calculations.get_intersections(conn,connect=db,**kwargs)
+    db.close()
 
     logger.info('Creating area matrices.')
     site_areas,site_fractions = windpower.classes.site_areas_fractions(intersections)
     windpower.windio.write_areas_to_file(dest,site_areas,site_fractions)
 
 
+@cli.command('region-production',help='aggregate wind production to regions')
+@click.option('--source','-s',
+                help='path to wind production file (repeat to concatenate years)',
+                type=click.Path(exists=True,dir_okay=False),
+                multiple=True,
+                required=True)
+@click.option('--fractions','-f',
+                help='site fractions from calc-areas or create-classes',
+                type=click.Path(exists=True,dir_okay=False),
+                required=True)
+@click.option('--dest','-d',
+                help='file to save regional production',
+                type=click.Path(dir_okay=False),
+                required=True)
+@click.option('--wind-key','-wk',
+                help='key to read wind production data from file',
+                type=str,
+                default='wp_output')
+@click.option('--chunk-size','-c',
+                help='number of time steps to process at a time',
+                type=click.IntRange(1,None),
+                default=720)
+def region_production(source,fractions,dest,wind_key,chunk_size):
+    import windpower.regions
+
+    logger.info('Reading site fractions from {}.'.format(fractions))
+    site_fractions = windpower.regions.read_fractions(fractions)
+    windpower.regions.region_production(source,site_fractions,dest,wind_key,chunk_size)
+    logger.info('Saved regional production to {}.'.format(dest))
+
+
+@cli.command('transpose',help='build a site-major store of wind production series')
+@click.option('--source','-s',
+                help='wind production file (repeat for several years)',
+                type=click.Path(exists=True,dir_okay=False),
+                multiple=True,
+                required=True)
+@click.option('--dest','-d',
+                help='file to save site-major store',
+                type=click.Path(dir_okay=False),
+                required=True)
+@click.option('--wind-key','-wk',
+                help='dataset to include (repeat for several, wp_output and hub height wind speed if not given)',
+                type=str,
+                multiple=True)
+@click.option('--compression',
+                type=click.Choice(windpower.windio.OUTPUT_COMPRESSION),
+                default='none',
+                help='compression filter')
+@click.option('--compression-level',
+                type=click.IntRange(0,9),
+                default=4,
+                help='gzip compression level')
+def transpose(source,dest,wind_key,compression,compression_level):
+    windpower.windio.transpose_production(source,dest,unique(wind_key) or None,
+                                          compression,compression_level)
+    logger.info('Saved site-major store to {}.'.format(dest))
+
+
+@cli.command('stitch',help='stitch wind production files into one multi-year file')
+@click.option('--source','-s',
+                help='wind production file (repeat for several years)',
+                type=click.Path(exists=True,dir_okay=False),
+                multiple=True,
+                required=True)
+@click.option('--dest','-d',
+                help='file to save stitched virtual datasets',
+                type=click.Path(dir_okay=False),
+                required=True)
+@click.option('--wind-key','-wk',
+                help='dataset to include (repeat for several, wp_output and hub height wind speed if not given)',
+                type=str,
+                multiple=True)
+def stitch(source,dest,wind_key):
+    windpower.windio.stitch_production(source,dest,unique(wind_key) or None)
+    logger.info('Saved stitched file to {}.'.format(dest))
+
+
+@cli.command('aggregate',help='resample wind production to daily/monthly means, climatology and quantiles')
+@click.option('--source','-s',
+                help='wind production file (repeat for several years)',
+                type=click.Path(exists=True,dir_okay=False),
+                multiple=True,
+                required=True)
+@click.option('--dest','-d',
+                help='file to save aggregates',
+                type=click.Path(dir_okay=False),
+                required=True)
+@click.option('--wind-key','-wk',
+                help='dataset to aggregate (repeat for several)',
+                type=str,
+                default=('wp_output',),
+                multiple=True)
+@click.option('--quantile','-q',
+                help='quantile level of duration curves (repeat for several)',
+                type=click.FloatRange(0,1),
+                multiple=True)
+@click.option('--bins',
+                help='histogram bins for approximate quantiles',
+                type=click.IntRange(1,None),
+                default=100)
+@click.option('--time-units',
+                help="units of time steps if not in the files (e.g. 'hours since 1980-01-01')",
+                type=str,
+                default=None)
+def aggregate(source,dest,wind_key,quantile,bins,time_units):
+    import windpower.aggregate
+
+    quantiles = sorted(set(quantile)) or windpower.aggregate.QUANTILES
+    windpower.aggregate.aggregate(source,dest,unique(wind_key),quantiles,bins,time_units)
+    logger.info('Saved aggregates to {}.'.format(dest))
+
+
 @cli.command(help='create some helpful plots')
 @click.option('--source','-s',type=click.Path(exists=True,dir_okay=False),required=True)
 @click.option('--savefile','-f',type=click.Path(dir_okay=False),required=False)
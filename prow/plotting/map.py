@@ -3,6 +3,7 @@ from mpl_toolkits.basemap import Basemap
 import numpy as np
 import h5py
 import logging
+import prow.windpower.windio as windio
 
 logger = logging.getLogger(__name__)
 
@@ -58,18 +59,29 @@ def plt_from_file(fpath,key,plottype,timestep):
     """
 
     logger.info("Plotting {} of {} from {}".format(plottype,key,fpath))
-    with h5py.File(fpath) as f:
+    with h5py.File(fpath,'r') as f:
         lat,lon = np.meshgrid(f['latitude'][:],f['longitude'][:])
         try:
             k1,k2 = key
-            data = np.sqrt(np.square(f[k1])+np.square(f[k2]))
+            read = lambda sl: np.sqrt(np.square(windio.read_dataset(f[k1],sl))+
+                                      np.square(windio.read_dataset(f[k2],sl)))
+            def mean():
+                # In blocks, the file may hold many years (see windio.stitch_production)
+                total = np.zeros(f[k1].shape[1:])
+                for t_sl,lat_sl in windio.iter_time_blocks(f[k1]):
+                    total[lat_sl] += read((t_sl,lat_sl)).sum(axis=0)
+                return grid(total/f[k1].shape[0])
         except (TypeError,ValueError):
-            k, = key
-            data = f[k]
+            k1, = key
+            read = lambda sl: windio.read_dataset(f[k1],sl)
+            mean = lambda: windio.time_mean(fpath,k1)
+        # Files with a site mask hold (time,sites) datasets
+        sites = windio.read_sites(f,k1)
+        grid = lambda data: data if sites is None else windio.to_grid(data,sites,lat.T.shape)
         if plottype=='mean':
-            fig,ax = plt_map(lon.T,lat.T,np.mean(data,axis=0))
+            fig,ax = plt_map(lon.T,lat.T,mean())
         elif plottype=='timestep':
-            fig,ax = plt_map(lon.T,lat.T,data[timestep,:,:])
+            fig,ax = plt_map(lon.T,lat.T,grid(read(timestep)))
         else:
             logger.error('Unknown plot type!')
     
@@ -1,11 +1,11 @@
-import netCDF4 as nc
 import numpy as np
-import datetime as dt
 import pandas as pd
 import matplotlib.pyplot as plt
 from mpl_toolkits.basemap import Basemap
 
 import windpower.tradewind as tw
+import windpower.era as era
+import windpower.windio as windio
 
 LAEA_EUROPE = {'width':3600000,'height':4500000,'projection':'laea',
                     'lat_ts':0,'lat_0':54,'lon_0':8.5}
@@ -22,21 +22,18 @@ def plt_map(lon,lat,data):
     plt.colorbar( orientation='horizontal', pad=0.05)
 
 infile = r'E:\data\weather\ecmwf\u-v_lvl59_reanalysis_2012.netcdf'
-data = nc.Dataset(infile,'r')
+data = era.open_file(infile)
 
 # Create time index based on data in file
-base_time = dt.datetime.strptime('1900-01-01 00:00','%Y-%m-%d %H:%M')
-actual_time =  [base_time + dt.timedelta(hours=t) for t in data.variables['time']]
-time_idx = pd.to_datetime(actual_time).to_period(freq='H')
+lats,longs,time = era.read_coordinates(data)
+time_idx = pd.DatetimeIndex(windio.decode_time(time,era.read_time_units(data))).to_period(freq='H')
 
 # Create lat/long meshgrid
-lat,lon = np.meshgrid(data.variables['latitude'][:],data.variables['longitude'][:])
+lat,lon = np.meshgrid(lats,longs)
 
-u = data.variables['u'][:,:,:]
-v = data.variables['v'][:,:,:]
 print data.variables.keys()
 
-abs_ws = np.sqrt(np.square(u)+np.square(v))
+abs_ws = era.abs_wind_speed(data,'u','v')
 print abs_ws.shape
 
 plt_map(lon.T,lat.T,np.mean(tw.offshore_future(abs_ws),axis=0))
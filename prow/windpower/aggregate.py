@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming temporal aggregation of wind production output: daily and monthly
+means, mean diurnal profiles per month (month by hour climatology) and
+approximate per-site quantiles (duration curves) from fixed-bin histograms,
+computed together while streaming over the data.
+
+Sites are processed in blocks sized so that the climatology and histograms
+of a block fit in a memory budget, and each block streams through the time
+series of all files in slabs, so the data is read once per block of sites:
+in one pass if the accumulators of all sites fit the budget. With several
+blocks, chunked (e.g. compressed) sources are first staged uncompressed in
+(sites,time) layout, so that each source chunk is decompressed only once.
+Daily and monthly means are written as soon as a period is complete.
+"""
+import numpy as np
+import logging
+import os
+import windio
+from sitestats import SiteHistogram
+
+logger = logging.getLogger(__name__)
+
+# Quantile levels of duration curves
+QUANTILES = [0.01,0.05,0.1,0.25,0.5,0.75,0.9,0.95,0.99]
+# Upper edge of quantile histograms (values above go to an overflow bin)
+HISTOGRAM_MAX = {
+    'wp_output': 1.,
+    'ws': 40.
+}
+# Approximate memory for per-site accumulators of one block of sites
+MEMORY_BYTES = 2**28
+# Resampling periods, as datetime64 units
+PERIODS = [('daily','D'),('monthly','M')]
+
+class PeriodMeans(object):
+    """
+    Means over consecutive periods (e.g. days) of slabs arriving in time
+    order, written to a (period,...) dataset as each period completes. Only
+    the sum of the current period is kept between slabs.
+    """
+    def __init__(self,ds,index):
+        """
+        Args:
+            ds (h5py.Dataset): output dataset with periods as first axis
+            index (tuple): index of the block of sites after the period axis
+        """
+        self.ds = ds
+        self.index = index
+        self.current = None
+        self.total = None
+        self.count = 0
+
+    def add(self,periods,data):
+        """
+        Add a time slab.
+
+        Args:
+            periods (numpy.ndarray): non-decreasing period of each time step
+            data (numpy.ndarray): time slab with time as first axis
+        """
+        if not len(periods):
+            return
+        if np.any(np.diff(periods)<0) or (self.current is not None and periods[0]<self.current):
+            raise ValueError('Time steps are not in order.')
+        starts = np.flatnonzero(np.r_[True,periods[1:]!=periods[:-1]])
+        totals = np.add.reduceat(data,starts,axis=0,dtype=np.float64)
+        counts = np.diff(np.r_[starts,len(periods)])
+        ids = periods[starts]
+        if self.current == ids[0]:
+            totals[0] += self.total
+            counts[0] += self.count
+        elif self.current is not None:
+            self._write([self.current],self.total[np.newaxis],[self.count])
+        if len(ids) > 1:
+            self._write(ids[:-1],totals[:-1],counts[:-1])
+        self.current,self.total,self.count = ids[-1],totals[-1],counts[-1]
+
+    def close(self):
+        """Write the last period."""
+        if self.current is not None:
+            self._write([self.current],self.total[np.newaxis],[self.count])
+            self.current = None
+
+    def _write(self,ids,totals,counts):
+        counts = np.asarray(counts,dtype=float).reshape((-1,)+(1,)*(totals.ndim-1))
+        means = totals/counts
+        ids = np.asarray(ids)
+        if ids[-1]-ids[0] == len(ids)-1:
+            self.ds[(slice(ids[0],ids[-1]+1),)+self.index] = means
+        else:
+            for period,mean in zip(ids,means):
+                self.ds[(period,)+self.index] = mean
+
+def histogram_edges(key,bins):
+    """
+    Edges of quantile histograms for a dataset: output between 0 and 1, wind
+    speeds between 0 and 40 m/s.
+
+    Args:
+        key (str): dataset key
+        bins (int): number of regular bins
+
+    Returns:
+        numpy.ndarray: bin edges
+    """
+    upper = HISTOGRAM_MAX['ws' if key.startswith('ws_') else key]
+    return np.linspace(0.,upper,bins+1)
+
+def _block_shape(index,shape):
+    """Shape of a block of sites given by slices of the site axes."""
+    return tuple(len(xrange(*sl.indices(n))) for sl,n in zip(index,shape))
+
+def aggregate(sources,dest,keys=('wp_output',),quantiles=QUANTILES,bins=100,
+              time_units=None,memory_bytes=MEMORY_BYTES,block_bytes=windio.BLOCK_BYTES):
+    """
+    Aggregate wind production output over time, with memory use bounded by
+    memory_bytes and block_bytes. The data is read once per block of sites
+    that fits memory_bytes (see module docstring). For each key, dest gets
+
+    - daily/<key>, monthly/<key>: means per day and month (UTC), with the
+      dates in daily/time and monthly/time
+    - climatology/<key>: mean per month of year and hour of day (12,24,...)
+    - quantiles/<key>: approximate quantiles at the levels in
+      quantiles/levels, see sitestats.SiteHistogram.quantiles
+
+    with the sites axes of the source (lat,lon, or sites for files with a
+    site mask).
+
+    Args:
+        sources (list): wind production hdf5 files in time order when sorted
+            (e.g. one per year, or a stitched file)
+        dest (str): path to output hdf5 file
+        keys (list): datasets to aggregate
+        quantiles (list): quantile levels between 0 and 1
+        bins (int): number of histogram bins for quantiles
+        time_units (str): units of time steps, overriding those of the files
+            (see windio.decode_time)
+        memory_bytes (int): approximate memory for accumulators of a block
+            of sites; fewer blocks mean fewer passes over the data
+        block_bytes (int): approximate size of time slabs read at a time
+    """
+    import h5py
+
+    sources = sorted(sources)
+    if not sources:
+        raise ValueError('No source files given.')
+    files = [h5py.File(source,'r') for source in sources]
+    try:
+        sites = windio.common_sites(files,keys[0])
+        times = [windio.read_time(f,time_units) for f in files]
+        first,last = min(t[0] for t in times),max(t[-1] for t in times)
+        labels = {}
+        for name,unit in PERIODS:
+            start,stop = first.astype('datetime64[{}]'.format(unit)),last.astype('datetime64[{}]'.format(unit))
+            labels[name] = np.arange(start,stop+1)
+        logger.info('Aggregating {} files from {} to {}.'.format(len(files),first,last))
+
+        with h5py.File(dest,'w') as outfile:
+            outfile['latitude'] = files[0]['latitude'][:]
+            outfile['longitude'] = files[0]['longitude'][:]
+            if sites is not None:
+                outfile[windio.SITES_KEY] = sites
+            for name,_ in PERIODS:
+                outfile['{}/time'.format(name)] = np.datetime_as_string(labels[name]).astype(str)
+            outfile['quantiles/levels'] = np.asarray(quantiles,dtype=float)
+            for key in keys:
+                _aggregate_key(files,times,key,outfile,labels,quantiles,bins,
+                               memory_bytes,block_bytes)
+    finally:
+        for f in files:
+            f.close()
+
+def _aggregate_key(files,times,key,outfile,labels,quantiles,bins,memory_bytes,block_bytes):
+    """Aggregate one dataset of all files into outfile, see aggregate."""
+    import h5py
+
+    shape = files[0][key].shape
+    site_shape = shape[1:]
+    out = {}
+    for name,_ in PERIODS:
+        out[name] = outfile.create_dataset('{}/{}'.format(name,key),
+            shape=(len(labels[name]),)+site_shape,dtype=np.float32,chunks=True,
+            fillvalue=np.nan)
+    clim_ds = outfile.create_dataset('climatology/{}'.format(key),
+        shape=(12,24)+site_shape,dtype=np.float32,chunks=True,fillvalue=np.nan)
+    clim_ds.attrs['dim1'] = 'month'
+    clim_ds.attrs['dim2'] = 'hour'
+    quantile_ds = outfile.create_dataset('quantiles/{}'.format(key),
+        shape=(len(quantiles),)+site_shape,dtype=np.float32,fillvalue=np.nan)
+    edges = histogram_edges(key,bins)
+
+    # Period of each time step, relative to the first period
+    steps = []
+    for time in times:
+        step = {}
+        for name,unit in PERIODS:
+            step[name] = (time.astype('datetime64[{}]'.format(unit))-labels[name][0]).astype(np.int64)
+        month = time.astype('datetime64[M]')
+        hour = (time-time.astype('datetime64[D]')).astype('timedelta64[h]').astype(np.int64)
+        step['clim'] = (month.astype(np.int64)%12)*24+hour
+        steps.append(step)
+
+    # Steps of all files concatenated
+    steps = {name: np.concatenate([step[name] for step in steps]) for name in steps[0]}
+    src = [f[key] for f in files]
+    offsets = np.cumsum([0]+[ds.shape[0] for ds in src])
+
+    # Histogram counts and sums, climatology sums
+    site_bytes = len(edges)*16+12*24*8
+    blocks = list(windio.cell_blocks(shape,1,site_bytes,memory_bytes))
+    stage_file = None
+    if len(blocks) > 1:
+        logger.info('Aggregating {} in {} passes, one per block of sites.'.format(key,len(blocks)))
+        if any(ds.chunks is not None for ds in src):
+            # Chunks would be read and decompressed again in every pass
+            stage_path = '{}.{}.stage.tmp'.format(outfile.filename,os.getpid())
+            logger.info('Staging {} uncompressed in {}.'.format(key,stage_path))
+            stage_file = h5py.File(stage_path,'w')
+    try:
+        stage = None
+        if stage_file is not None:
+            stage = stage_file.create_dataset(key,shape=site_shape+(int(offsets[-1]),),
+                                              dtype=src[0].dtype)
+            windio.stage_sources(src,offsets,stage,block_bytes)
+
+        for index,start,stop in blocks:
+            block_shape = _block_shape(index,site_shape)
+            logger.debug('Aggregating {} for sites {} to {}.'.format(key,start,stop))
+            resamplers = {name: PeriodMeans(out[name],index) for name,_ in PERIODS}
+            hist = SiteHistogram(block_shape,edges)
+            clim_total = np.zeros((12*24,)+block_shape)
+            clim_count = np.zeros(12*24,dtype=np.int64)
+
+            num_steps = max(block_bytes//(max(stop-start,1)*8),1)
+            for t_sl,data in _time_slabs(src,offsets,stage,index,num_steps):
+                for name,_ in PERIODS:
+                    resamplers[name].add(steps[name][t_sl],data)
+                hist.update(data)
+
+                # Sum time steps by month and hour
+                clim = steps['clim'][t_sl]
+                order = np.argsort(clim,kind='mergesort')
+                clim = clim[order]
+                starts = np.flatnonzero(np.r_[True,clim[1:]!=clim[:-1]])
+                clim_total[clim[starts]] += np.add.reduceat(data[order],starts,axis=0,
+                                                            dtype=np.float64)
+                clim_count += np.bincount(clim,minlength=12*24)
+                del data
+
+            for resampler in resamplers.values():
+                resampler.close()
+            with np.errstate(divide='ignore',invalid='ignore'):
+                clim_mean = clim_total/clim_count.reshape((-1,)+(1,)*len(block_shape))
+            clim_ds[(slice(None),slice(None))+index] = clim_mean.reshape((12,24)+block_shape)
+            quantile_ds[(slice(None),)+index] = hist.quantiles(quantiles)
+    finally:
+        if stage_file is not None:
+            stage_file.close()
+            os.remove(stage_path)
+
+def _time_slabs(src,offsets,stage,index,num_steps):
+    """
+    Decoded time slabs of a block of sites of source datasets concatenated
+    in time, read from the staging dataset if given.
+
+    Yields:
+        tuple: slice of the concatenated time axis, (time,...) slab
+    """
+    if stage is not None:
+        for t_start in xrange(0,stage.shape[-1],num_steps):
+            t_sl = slice(t_start,min(t_start+num_steps,stage.shape[-1]))
+            block = np.moveaxis(stage[index+(t_sl,)],-1,0)
+            yield t_sl,windio.decode(src[0],np.ascontiguousarray(block))
+        return
+    for ds,offset in zip(src,offsets):
+        for t_start in xrange(0,ds.shape[0],num_steps):
+            t_stop = min(t_start+num_steps,ds.shape[0])
+            yield (slice(offset+t_start,offset+t_stop),
+                   windio.read_dataset(ds,(slice(t_start,t_stop),)+index))
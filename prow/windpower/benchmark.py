@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the wind power kernels. Run as a script, e.g.
+
+    python prow/windpower/benchmark.py extrapolation powercurve
+"""
+import numpy as np
+import timeit
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+def synthetic_merra(shape=(24,91,144),dtype=np.float32,seed=0):
+    """
+    Create random MERRA-like displacement heights and wind speeds.
+
+    Args:
+        shape (tuple): shape of the (time,lat,lon) blocks
+        dtype: data type of the blocks
+        seed (int): seed for the random generator
+
+    Returns:
+        tuple: h, ws10 and ws50 arrays
+    """
+    rs = np.random.RandomState(seed)
+    h = (rs.rand(*shape)*30.).astype(dtype)
+    ws10 = (rs.rand(*shape)*15.).astype(dtype)
+    ws50 = (ws10*(1.+rs.rand(*shape)*0.5)).astype(dtype)
+    return h,ws10,ws50
+
+def best_time(fcn,repeat=3):
+    """Best wall time in seconds of repeat calls to fcn."""
+    return min(timeit.repeat(fcn,number=1,repeat=repeat))
+
+def bench_extrapolation(shape=(24,91,144),z=100.):
+    """
+    Compare np.vectorize and array extrapolation engines in merra.
+
+    Args:
+        shape (tuple): shape of the (time,lat,lon) blocks
+        z (float): hub height
+
+    Returns:
+        dict: timings and speedup for each extrapolation law
+    """
+    import merra
+
+    h,ws10,ws50 = synthetic_merra(shape)
+    results = {}
+    for law in ['loglaw','powerlaw']:
+        scalar = merra.EXTRAPOLATORS[law+'-vectorize'](z)
+        array = merra.EXTRAPOLATORS[law](z)
+
+        with np.errstate(all='ignore'):
+            expected = scalar(h,ws10,ws50)
+        actual = array(h,ws10,ws50)
+        valid = np.isfinite(expected)
+        if not np.allclose(actual[valid],expected[valid],rtol=1e-4,atol=1e-4):
+            raise ValueError('Array engine for {} differs from scalar version.'.format(law))
+
+        with np.errstate(all='ignore'):
+            t_scalar = best_time(lambda: scalar(h,ws10,ws50),repeat=1)
+        t_array = best_time(lambda: array(h,ws10,ws50))
+        results[law] = {'vectorize': t_scalar,'array': t_array,
+                        'speedup': t_scalar/t_array}
+        logger.info('{}: vectorize {:.3f} s, array {:.4f} s, speedup {:.0f}x ({} cells)'.format(
+            law,t_scalar,t_array,t_scalar/t_array,h.size))
+    return results
+
+def bench_powercurve(shape=(24,361,576)):
+    """
+    Compare interp1d and lookup table power curves in tradewind, for float32 
+    and float64 wind speeds, with and without an output buffer.
+
+    Args:
+        shape (tuple): shape of the wind speed block
+
+    Returns:
+        dict: timings and speedup for each power curve and dtype
+    """
+    import tradewind
+
+    rs = np.random.RandomState(0)
+    ws64 = rs.rand(*shape)*40.-2.
+    results = {}
+    for key in sorted(tradewind.output_percent.keys()):
+        for dtype in [np.float32,np.float64]:
+            ws = ws64.astype(dtype)
+            out = np.empty_like(ws)
+            expected = tradewind.output_fcn[key](ws)
+            actual = tradewind.power(ws,key)
+            if not np.allclose(actual,expected,rtol=1e-5,atol=1e-6):
+                raise ValueError('Lookup power curve {} differs from interp1d.'.format(key))
+
+            t_interp = best_time(lambda: tradewind.output_fcn[key](ws))
+            t_lookup = best_time(lambda: tradewind.power(ws,key))
+            t_buffer = best_time(lambda: tradewind.power(ws,key,out=out))
+            name = '{}/{}'.format(key,np.dtype(dtype).name)
+            results[name] = {'interp1d': t_interp,'lookup': t_lookup,
+                             'lookup_out': t_buffer,'speedup': t_interp/t_buffer}
+            logger.info('{}: interp1d {:.3f} s, lookup {:.3f} s, lookup with buffer {:.3f} s, speedup {:.1f}x ({} cells)'.format(
+                name,t_interp,t_lookup,t_buffer,t_interp/t_buffer,ws.size))
+    return results
+
+BENCHMARKS = {
+    'extrapolation': bench_extrapolation,
+    'powercurve': bench_powercurve,
+}
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s [%(levelname)-8s] %(message)s",
+                        datefmt="%H:%M:%S")
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
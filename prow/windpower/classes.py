@@ -1,14 +1,56 @@
-import prow.utils as u
+from collections import namedtuple
+import numpy as np
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Sparse site fractions: matrix is num_sites by num_regions*num_classes with 
+# column region_idx*num_classes+class_idx
+SiteFractions = namedtuple('SiteFractions',['matrix','sites','regions','classes'])
+
+def sparse_site_areas(site_areas):
+    """
+    Convert areas for each site in each region to a sparse matrix.
+
+    Args:
+        site_areas (dict): areas for each site in each region 
+            e.g. {'reg1': {site_idx: area1, ...}, ...}
+
+    Returns:
+        tuple: num_sites by num_regions CSR matrix of areas, sorted site 
+            indices (rows) and sorted regions (columns)
+    """
+    import scipy.sparse as sp
+
+    regions = sorted(site_areas.keys())
+    num_entries = sum(len(areas) for areas in site_areas.itervalues())
+    site_ids = np.empty(num_entries,dtype=np.int64)
+    region_idx = np.empty(num_entries,dtype=np.int64)
+    areas = np.empty(num_entries,dtype=float)
+
+    pos = 0
+    for j,region in enumerate(regions):
+        items = site_areas[region].items()
+        n = len(items)
+        site_ids[pos:pos+n] = np.fromiter((k for k,_ in items),dtype=np.int64,count=n)
+        areas[pos:pos+n] = np.fromiter((a for _,a in items),dtype=float,count=n)
+        region_idx[pos:pos+n] = j
+        pos += n
+
+    sites,site_idx = np.unique(site_ids,return_inverse=True)
+    area_matrix = sp.coo_matrix((areas,(site_idx,region_idx)),
+                                shape=(len(sites),len(regions))).tocsr()
+    logger.debug('Area matrix has {} sites, {} regions and {} non-zeros.'.format(
+        area_matrix.shape[0],area_matrix.shape[1],area_matrix.nnz))
+    return area_matrix,sites,regions
+
 def class_areas(site_areas,
                 annual_utilization,
                 class_limits=[0.35,0.3,0.25,0.2,0.175,0.15,0.125,0.1]):
     """
     Calculate areas per wind power class based on site areas, wind power 
-    production and limits for utilization per class.
+    production and limits for utilization per class. A site belongs to the 
+    class with lower limit lb and upper limit ub if lb < utilization <= ub.
 
     Args:
         site_areas (dict): areas for each site in each region 
@@ -19,45 +61,52 @@ def class_areas(site_areas,
 
     Returns:
         tuple: areas for classes (per region), utilization factor for classes 
-            (per region), and weights for each site (per region and class)
+            (per region), and weights for each site (per region and class) as 
+            SiteFractions
     """
     import pandas as pd
-
-    # Create DataFrame from areas num_sites x num_regs
-    logger.debug('Convert area dict to DataFrame.')
-    area_df = pd.DataFrame.from_dict(site_areas)
-    num_regs = area_df.shape[1]
-    logger.debug('Area DF has {} sites and {} regions.'.format(*area_df.shape))
-
-    # Create dataframe with utilization factors
-    logger.debug('Construct utilization DataFrame.')
-    u_series = pd.Series(annual_utilization)
-    u_df = pd.concat([u_series]*num_regs,axis=1)
-    u_df.columns = area_df.columns
-
-    u_df = u_df.loc[area_df.index,:]
+    import scipy.sparse as sp
+
+    logger.debug('Convert area dict to sparse matrix.')
+    area_matrix,sites,regions = sparse_site_areas(site_areas)
+    area_matrix.data[~(area_matrix.data>0)] = 0
+    area_matrix.eliminate_zeros()
+    num_sites = len(sites)
+
+    logger.debug('Assign sites to classes.')
+    # Classes ordered by decreasing lower limit, the last class is (0,lowest]
+    lower_limits = sorted(class_limits,reverse=True)+[0.0]
+    num_classes = len(lower_limits)
+    utilization = np.asarray(annual_utilization,dtype=float)[sites]
+    bins = lower_limits[::-1]+[1.0]
+    site_class = num_classes-np.digitize(utilization,bins,right=True)
+    valid = (site_class>=0) & (site_class<num_classes)
+    logger.debug('{} of {} sites are in a class.'.format(np.count_nonzero(valid),num_sites))
+
+    valid_sites = np.flatnonzero(valid)
+    membership = sp.csr_matrix((np.ones(len(valid_sites)),(valid_sites,site_class[valid])),
+                               shape=(num_sites,num_classes))
+    util_membership = sp.csr_matrix((utilization[valid],(valid_sites,site_class[valid])),
+                                    shape=(num_sites,num_classes))
 
     logger.debug('Calculate areas in each class for each region.')
-    pad_class_limits = [1.0]+class_limits+[0.0]
-    class_areas = pd.DataFrame(index=area_df.columns,
-                                columns=pad_class_limits[1:])
-    class_utils = pd.DataFrame(index=area_df.columns,
-                                columns=pad_class_limits[1:])
-    site_fractions_dict = {}
-     # = pd.Panel(items=area_df.columns,
-     #                            major_axis=area_df.index,
-     #                            minor_axis=pad_class_limits[1:])
-    for ub,lb in u.pairwise(pad_class_limits):
-        selection = ((area_df>0) & (u_df>lb) & (u_df<ub)).dropna()
-        logger.debug('For class {} select {} elements.'.format(lb,
-            selection.sum().sum()))
-
-        class_areas[lb] = area_df[selection].sum()
-        site_fractions_dict[lb] = area_df[selection]/class_areas[lb]
-        # Area-weighted mean for class utilization 
-        class_utils[lb] = (u_df[selection]*area_df[selection]).sum()/class_areas[lb]
-
-    site_fractions = pd.Panel.from_dict(site_fractions_dict,orient='minor')
+    region_areas = area_matrix.T.tocsr()
+    areas = region_areas.dot(membership).toarray()
+    # Area-weighted mean for class utilization 
+    with np.errstate(divide='ignore',invalid='ignore'):
+        utils = region_areas.dot(util_membership).toarray()/areas
+
+    logger.debug('Calculate site fractions.')
+    entries = area_matrix.tocoo()
+    keep = valid[entries.row]
+    rows,cols,vals = entries.row[keep],entries.col[keep],entries.data[keep]
+    classes = site_class[rows]
+    fractions = sp.csr_matrix((vals/areas[cols,classes],(rows,cols*num_classes+classes)),
+                              shape=(num_sites,len(regions)*num_classes))
+
+    class_areas = pd.DataFrame(areas,index=regions,columns=lower_limits)
+    class_utils = pd.DataFrame(utils,index=regions,columns=lower_limits)
+    site_fractions = SiteFractions(fractions,sites,regions,lower_limits)
 
     return class_areas,class_utils,site_fractions
 
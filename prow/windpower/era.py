@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+Data source for ECMWF reanalysis (ERA5-style) NetCDF files with wind
+components at 10 and 100 m above the surface ('u10', 'v10', 'u100', 'v100')
+on a (time,latitude,longitude) grid, one file per year.
+
+Variables are read in time slabs aligned to the chunking of the file and
+unpacked (scale_factor, add_offset, fill values as NaN) to float32 in place,
+instead of going through the masked float64 arrays of netCDF4. Time steps
+are left numeric with their CF units (see read_time_units), to be decoded
+all at once with windio.decode_time.
+"""
+import numpy as np
+from extrapolation import log_law,power_law,log_law_profile,power_law_profile
+from merra import time_slabs
+import merra
+import logging
+import os
+import glob
+import re
+
+logger = logging.getLogger(__name__)
+
+# Heights of the wind components above the surface
+LOWER_HEIGHT = 10.0
+UPPER_HEIGHT = 100.0
+# Keys of the eastward and northward components at the lower and upper height
+WIND_KEYS = ['u10','v10','u100','v100']
+# Accepted names of coordinate variables, in order of preference
+COORDINATE_KEYS = {
+    'latitude': ['latitude','lat'],
+    'longitude': ['longitude','lon'],
+    'time': ['time','valid_time']
+}
+# File name patterns of source files
+SOURCE_PATTERNS = ['*.nc','*.nc4','*.netcdf']
+# Calendars that numpy datetime64 decodes correctly
+CALENDARS = ['standard','gregorian','proleptic_gregorian']
+
+def vectorize_era_log_law(z):
+    """
+    Create 'vectorized' version of log law extrapolation taking matrices of h,
+    v10 and v100 and returning extrapolated wind speed at z.
+
+    Args:
+        z (float): height above ground to extrapolate wind speed to
+    """
+    return np.vectorize(lambda h,v10,v100: log_law(z,h,(LOWER_HEIGHT-h,v10),
+                                                   (UPPER_HEIGHT-h,v100)))
+
+def vectorize_era_power_law(z):
+    """
+    Create 'vectorized' version of power law extrapolation taking matrices of
+    h, v10 and v100 and returning extrapolated wind speed at z.
+
+    Args:
+        z (float): height above ground to extrapolate wind speed to
+    """
+    return np.vectorize(lambda h,v10,v100: power_law(z,h,(LOWER_HEIGHT-h,v10),
+                                                     (UPPER_HEIGHT-h,v100)))
+
+def era_log_profile(h,v10,v100):
+    """
+    Log law wind profile for blocks of ERA data through the wind speeds at 10
+    and 100 m above the surface.
+
+    Args:
+        h (array): displacement height (zero for ERA data)
+        v10 (array): wind speed 10 m above surface
+        v100 (array): wind speed 100 m above surface
+
+    Returns:
+        function: profile(z,out=None) giving extrapolated wind speed at z
+    """
+    return log_law_profile(h,(LOWER_HEIGHT-h,v10),(UPPER_HEIGHT-h,v100))
+
+def era_power_profile(h,v10,v100):
+    """
+    Power law wind profile for blocks of ERA data, as era_log_profile.
+
+    Args:
+        h (array): displacement height (zero for ERA data)
+        v10 (array): wind speed 10 m above surface
+        v100 (array): wind speed 100 m above surface
+
+    Returns:
+        function: profile(z,out=None) giving extrapolated wind speed at z
+    """
+    return power_law_profile(h,(LOWER_HEIGHT-h,v10),(UPPER_HEIGHT-h,v100))
+
+def _array_extrapolator(profile):
+    """Array extrapolator to height z from a profile function."""
+    def extrapolator(z):
+        def extrapolate(h,v10,v100,out=None):
+            return profile(h,v10,v100)(z,out=out)
+        return extrapolate
+    return extrapolator
+
+# Profiles sharing terms between hub heights, for the array engines
+PROFILES = {
+    'loglaw': era_log_profile,
+    'powerlaw': era_power_profile
+}
+
+# Same methods as for MERRA, the np.vectorize versions for reference
+EXTRAPOLATORS = {
+    'loglaw': _array_extrapolator(era_log_profile),
+    'powerlaw': _array_extrapolator(era_power_profile),
+    'loglaw-vectorize': vectorize_era_log_law,
+    'powerlaw-vectorize': vectorize_era_power_law
+}
+
+def source_files(source):
+    """
+    Find NetCDF source files in a folder and extract the year of each file
+    (the last group of four digits in the file name).
+
+    Args:
+        source (str): path to folder with source data files
+
+    Returns:
+        list: sorted (year, path) tuples
+    """
+    regex_y = re.compile(r'(?<!\d)(\d{4})(?!\d)')
+    files = sorted(set(f for pattern in SOURCE_PATTERNS
+                         for f in glob.glob(os.path.join(source,pattern))))
+    logger.debug('Searching through {} files in {}.'.format(len(files),source))
+    if not files:
+        logger.warning('No source files found in {}!'.format(source))
+
+    years = {}
+    for f in files:
+        found = regex_y.findall(os.path.basename(f))
+        if not found:
+            raise ValueError('Could not extract year from {}.'.format(f))
+        year = found[-1]
+        if year in years:
+            raise ValueError('Several source files for {}: {} and {}.'.format(
+                year,years[year],f))
+        years[year] = f
+    return sorted(years.items())
+
+def open_file(path):
+    """
+    Open a NetCDF source file for reading, with automatic masking and scaling
+    turned off (see read_variable).
+
+    Args:
+        path (str): path to file
+
+    Returns:
+        netCDF4.Dataset: the open file, usable as a context manager
+    """
+    import netCDF4
+
+    infile = netCDF4.Dataset(path,'r')
+    infile.set_auto_maskandscale(False)
+    return infile
+
+def _variable(infile,name):
+    """Coordinate variable of an open file by any of its accepted names."""
+    for key in COORDINATE_KEYS[name]:
+        if key in infile.variables:
+            return infile.variables[key]
+    raise KeyError('No {} variable in {}.'.format(name,infile.filepath()))
+
+def read_coordinates(infile):
+    """
+    Read latitudes, longitudes and time from an open ERA file. Time steps are
+    numeric, see read_time_units.
+
+    Args:
+        infile (netCDF4.Dataset): open source file
+
+    Returns:
+        tuple: latitudes, longitudes, time
+    """
+    lats = np.asarray(_variable(infile,'latitude')[:])
+    longs = np.asarray(_variable(infile,'longitude')[:])
+    time = np.asarray(_variable(infile,'time')[:])
+    return lats,longs,time
+
+def read_time_units(infile):
+    """
+    Units of the time steps of an open ERA file (e.g. 'hours since 1900-01-01
+    00:00:00.0'), see windio.decode_time.
+
+    Args:
+        infile (netCDF4.Dataset): open source file
+
+    Returns:
+        str: units, or None if the file does not say
+    """
+    time = _variable(infile,'time')
+    calendar = getattr(time,'calendar','standard').lower()
+    if calendar not in CALENDARS:
+        raise ValueError("Cannot decode time steps in calendar '{}'.".format(calendar))
+    return getattr(time,'units',None)
+
+def slab_steps(var,chunk_size=None):
+    """
+    Number of time steps per slab: chunk_size rounded up to whole chunks of
+    the variable along time, so that no chunk is read (and decompressed) for
+    more than one slab.
+
+    Args:
+        var (netCDF4.Variable): (time,lat,lon) variable
+        chunk_size (int): requested number of time steps per slab (all if
+            None or 0)
+
+    Returns:
+        int: number of time steps per slab (0 for all)
+    """
+    chunking = var.chunking()
+    if not chunk_size or chunking == 'contiguous':
+        return chunk_size
+    steps = int(chunking[0])
+    aligned = -(-chunk_size//steps)*steps
+    if aligned != chunk_size:
+        logger.debug('Reading slabs of {} instead of {} time steps to align with chunks.'.format(
+            aligned,chunk_size))
+    return aligned
+
+def unpack(var,raw):
+    """
+    Unpack raw values of a variable in place where possible: missing values
+    become NaN and packed integers are scaled with scale_factor and
+    add_offset, to float32 (or the float type of the variable).
+
+    Args:
+        var (netCDF4.Variable): variable the values were read from
+        raw (numpy.ndarray): raw values
+
+    Returns:
+        numpy.ndarray: unpacked values
+    """
+    attrs = var.ncattrs()
+    missing = [var.getncattr(key) for key in ['_FillValue','missing_value'] if key in attrs]
+    invalid = None
+    for value in missing:
+        invalid = (raw==value) if invalid is None else invalid | (raw==value)
+
+    dtype = raw.dtype if raw.dtype.kind == 'f' else np.dtype(np.float32)
+    data = raw.astype(dtype,copy=False)
+    if 'scale_factor' in attrs:
+        data *= dtype.type(var.getncattr('scale_factor'))
+    if 'add_offset' in attrs:
+        data += dtype.type(var.getncattr('add_offset'))
+    if invalid is not None:
+        data[invalid] = np.nan
+    return data
+
+def read_variable(infile,key,sl=slice(None),sites=None):
+    """
+    Read and unpack a time slab of a (time,lat,lon) variable, for selected
+    sites only if sites is given.
+
+    Args:
+        infile (netCDF4.Dataset): open source file
+        key (str): key of variable
+        sl (slice): time slab to read
+        sites (sites.SiteSelection): sites to read (all if None)
+
+    Returns:
+        numpy.ndarray: (time,lat,lon) array, or (time,sites) for selected sites
+    """
+    var = infile.variables[key]
+    if var.ndim != 3:
+        raise ValueError('Expected (time,lat,lon) variable {}, got dimensions {}.'.format(
+            key,var.dimensions))
+    raw = np.asarray(var[sl]) if sites is None else sites.read(var,sl)
+    return unpack(var,raw)
+
+def abs_wind_speed(infile,u_key,v_key,sl=slice(None),sites=None):
+    """
+    Read wind components for a time slab and calculate absolute wind speed,
+    reusing the array of the first component for the result.
+
+    Args:
+        infile (netCDF4.Dataset): open source file
+        u_key (str): key of eastward wind component
+        v_key (str): key of northward wind component
+        sl (slice): time slab to read
+        sites (sites.SiteSelection): sites to read (all if None)
+
+    Returns:
+        numpy.ndarray: absolute wind speed for the slab
+    """
+    ws = read_variable(infile,u_key,sl,sites)
+    np.square(ws,out=ws)
+    v = read_variable(infile,v_key,sl,sites)
+    np.square(v,out=v)
+    ws += v
+    del v
+    return np.sqrt(ws,out=ws)
+
+def iter_time_slabs(infile,chunk_size=None):
+    """Chunk-aligned time slabs of the wind components of an open file."""
+    var = infile.variables[WIND_KEYS[0]]
+    return time_slabs(var.shape[0],slab_steps(var,chunk_size))
+
+def _zero_height(like):
+    """Zero displacement height broadcasting against a slab."""
+    return np.zeros((1,)*like.ndim,dtype=like.dtype)
+
+def read_slab(infile,sl,sites=None):
+    """
+    Read absolute wind speeds at 10 and 100 m for a time slab of an open ERA
+    file, with a zero displacement height.
+
+    Args:
+        infile (netCDF4.Dataset): open source file
+        sl (slice): time slab to read
+        sites (sites.SiteSelection): sites to read, as (time,sites) arrays
+            (the whole grid if None)
+
+    Returns:
+        tuple: h, ws10 and ws100 arrays
+    """
+    logger.debug('Reading variables for time steps {} to {}.'.format(sl.start,sl.stop))
+    u_lower,v_lower,u_upper,v_upper = WIND_KEYS
+    abs_ws10 = abs_wind_speed(infile,u_lower,v_lower,sl,sites)
+    abs_ws100 = abs_wind_speed(infile,u_upper,v_upper,sl,sites)
+    return _zero_height(abs_ws10),abs_ws10,abs_ws100
+
+def iter_raw_slabs(infile,chunk_size=None,sites=None):
+    """
+    Read an open ERA file one time slab at a time, see read_slab.
+
+    Args:
+        infile (netCDF4.Dataset): open source file
+        chunk_size (int): number of time steps per slab (all if None or 0),
+            rounded up to whole chunks
+        sites (sites.SiteSelection): sites to read (the whole grid if None)
+
+    Yields:
+        tuple: time slice, h, ws10 and ws100 arrays
+    """
+    for sl in iter_time_slabs(infile,chunk_size):
+        yield (sl,)+read_slab(infile,sl,sites)
+
+def iter_component_slabs(infile,chunk_size=None,sites=None):
+    """
+    Read wind components of an open ERA file one time slab at a time, with a
+    zero displacement height, leaving the wind speed magnitudes to the
+    consumer (see kernel.TiledKernel).
+
+    Args:
+        infile (netCDF4.Dataset): open source file
+        chunk_size (int): number of time steps per slab (all if None or 0),
+            rounded up to whole chunks
+        sites (sites.SiteSelection): sites to read (the whole grid if None)
+
+    Yields:
+        tuple: time slice, h, u10, v10, u100 and v100 arrays
+    """
+    for sl in iter_time_slabs(infile,chunk_size):
+        logger.debug('Reading components for time steps {} to {}.'.format(sl.start,sl.stop))
+        components = tuple(read_variable(infile,key,sl,sites) for key in WIND_KEYS)
+        yield (sl,_zero_height(components[0]))+components
+
+def compute_slab(raw,configs):
+    """
+    Calculate hub height wind speed and wind power output for several
+    configurations from a slab read by iter_raw_slabs, see
+    merra.compute_slab.
+
+    Args:
+        raw (tuple): time slice, h, ws10 and ws100 arrays
+        configs (list): (extrapolation method, hub height, power curve) tuples,
+            methods as keys of EXTRAPOLATORS
+
+    Returns:
+        tuple: time slice, list of (wind speed, wind power output) for each
+            configuration
+    """
+    return merra.compute_slab(raw,configs,PROFILES,EXTRAPOLATORS)
+
+def iter_slabs_multi(infile,configs,chunk_size=None,sites=None):
+    """
+    Calculate hub height wind speed and wind power output for several
+    configurations from one read of an open ERA file, one time slab at a
+    time, see compute_slab.
+
+    Args:
+        infile (netCDF4.Dataset): open source file
+        configs (list): (extrapolation method, hub height, power curve) tuples,
+            methods as keys of EXTRAPOLATORS
+        chunk_size (int): number of time steps per slab (all if None or 0)
+        sites (sites.SiteSelection): sites to compute (the whole grid if None)
+
+    Yields:
+        tuple: time slice, list of (wind speed, wind power output) for each
+            configuration
+    """
+    for raw in iter_raw_slabs(infile,chunk_size,sites):
+        yield compute_slab(raw,configs)
+
+def iter_slabs(infile,powercurve,extrapolate,chunk_size=None,sites=None):
+    """
+    Calculate hub height wind speed and wind power output for an open ERA
+    file, one time slab at a time.
+
+    Args:
+        infile (netCDF4.Dataset): open source file
+        powercurve (function): function to transform wind speed to output
+        extrapolate (function): an extrapolator for ERA data (h, ws10, ws100)
+        chunk_size (int): number of time steps per slab (all if None or 0)
+        sites (sites.SiteSelection): sites to compute (the whole grid if None)
+
+    Yields:
+        tuple: time slice, wind speed (hub height), wind power output
+    """
+    for sl,h,abs_ws10,abs_ws100 in iter_raw_slabs(infile,chunk_size,sites):
+        logger.debug('Running extrapolation function.')
+        abs_ws_z = extrapolate(h,abs_ws10,abs_ws100)
+        del h,abs_ws10,abs_ws100
+
+        logger.debug("Applying power curve '{}'.".format(powercurve.__name__))
+        wp_output = powercurve(abs_ws_z)
+
+        yield sl,abs_ws_z,wp_output
@@ -54,4 +54,129 @@ def power_law(z,h,hv1,hv2):
     alpha = (np.log(v2)-np.log(v1))/(np.log(h2)-np.log(h1))
 
     return v2*((z-h)/h2)**alpha
-    
\ No newline at end of file
+
+
+def log_law_array(z,h,hv1,hv2,out=None):
+    """
+    Array version of log_law operating on whole blocks of displacement heights 
+    and wind speeds (anything that broadcasts together).
+
+    The log law is linear in log(height), so the roughness length never has to 
+    be formed explicitly: v_z = v1 + (v2-v1)*log((z-h)/h1)/log(h2/h1). This 
+    avoids the exp overflow and the division by (v1-v2) in log_law. Cells 
+    where the profile is undefined (non-positive heights or h1 == h2) are 
+    masked explicitly and given the upper reference speed v2 (no shear).
+
+    Args:
+        z (float): height to extrapolate to (above ground)
+        h (array): displacement height
+        hv1 (tuple): first known heights and wind speeds as (h,v)
+        hv2 (tuple): second known heights and wind speeds
+        out (array): optional output array of the broadcast shape
+
+    Returns:
+        numpy.ndarray: extrapolated wind speed at z
+    """
+    return log_law_profile(h,hv1,hv2)(z,out=out)
+
+
+def log_law_profile(h,hv1,hv2):
+    """
+    Log law wind profile through two known heights and wind speeds, as in 
+    log_law_array, for extrapolating to several heights. The slope 
+    (v2-v1)/log(h2/h1) is calculated once.
+
+    Args:
+        h (array): displacement height
+        hv1 (tuple): first known heights and wind speeds as (h,v)
+        hv2 (tuple): second known heights and wind speeds
+
+    Returns:
+        function: profile(z,out=None) giving extrapolated wind speed at z
+    """
+    h1,v1 = hv1
+    h2,v2 = hv2
+    h,h1,h2 = np.asarray(h),np.asarray(h1),np.asarray(h2)
+    v1,v2 = np.asarray(v1),np.asarray(v2)
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        undefined = (h1<=0) | (h2<=0) | (h1==h2)
+        slope = np.subtract(v2,v1)/np.log(h2/h1)
+
+    def profile(z,out=None):
+        zh = z-h
+        with np.errstate(divide='ignore',invalid='ignore'):
+            out = np.multiply(np.log(zh/h1),slope,out=out)
+            np.add(out,v1,out=out)
+            undefined_z = undefined | (zh<=0)
+        _fill_undefined(out,v2,undefined_z,'log law')
+        return out
+    return profile
+
+
+def power_law_array(z,h,hv1,hv2,out=None):
+    """
+    Array version of power_law operating on whole blocks of displacement 
+    heights and wind speeds (anything that broadcasts together).
+
+    Cells where alpha cannot be estimated (zero wind speed at either reference 
+    point, non-positive heights or h1 == h2) or where the result overflows 
+    are masked explicitly and given the upper reference speed v2 (alpha=0).
+
+    Args:
+        z (float): height to extrapolate to (above ground)
+        h (array): displacement height
+        hv1 (tuple): first known heights and wind speeds as (h,v)
+        hv2 (tuple): second known heights and wind speeds
+        out (array): optional output array of the broadcast shape
+
+    Returns:
+        numpy.ndarray: extrapolated wind speed at z
+    """
+    return power_law_profile(h,hv1,hv2)(z,out=out)
+
+
+def power_law_profile(h,hv1,hv2):
+    """
+    Power law wind profile through two known heights and wind speeds, as in 
+    power_law_array, for extrapolating to several heights. The shear exponent 
+    alpha = log(v2/v1)/log(h2/h1) is calculated once.
+
+    Args:
+        h (array): displacement height
+        hv1 (tuple): first known heights and wind speeds as (h,v)
+        hv2 (tuple): second known heights and wind speeds
+
+    Returns:
+        function: profile(z,out=None) giving extrapolated wind speed at z
+    """
+    h1,v1 = hv1
+    h2,v2 = hv2
+    h,h1,h2 = np.asarray(h),np.asarray(h1),np.asarray(h2)
+    v1,v2 = np.asarray(v1),np.asarray(v2)
+
+    # Comparisons with NaN (missing) wind speeds are False, as intended
+    with np.errstate(divide='ignore',invalid='ignore'):
+        undefined = (v1<=0) | (v2<=0) | (h1<=0) | (h2<=0) | (h1==h2)
+        alpha = np.log(np.divide(v2,v1))/np.log(h2/h1)
+
+    def profile(z,out=None):
+        zh = z-h
+        with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+            out = np.multiply(np.log(zh/h2),alpha,out=out)
+            np.exp(out,out=out)
+            np.multiply(out,v2,out=out)
+            mask = undefined | (zh<=0)
+        mask |= ~np.isfinite(out)
+        _fill_undefined(out,v2,mask,'power law')
+        return out
+    return profile
+
+
+def _fill_undefined(out,v,undefined,name):
+    """Replace masked cells in out with the reference wind speed v."""
+    num_undefined = np.count_nonzero(undefined)
+    if num_undefined:
+        logger.debug('{} extrapolation undefined for {} of {} cells.'.format(
+            name.capitalize(),num_undefined,out.size))
+        np.copyto(out,np.broadcast_to(v,out.shape),where=undefined)
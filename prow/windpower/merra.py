@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-from extrapolation import log_law,power_law
+from extrapolation import log_law,power_law,log_law_array,power_law_array,\
+    log_law_profile,power_law_profile
 import logging
 import os
 import glob
@@ -60,57 +61,397 @@ def merra_power_law(z,h,v10,v50):
     """
     return power_law(z,h,(10.0,v10),(50.0-h,v50))
 
+def array_merra_log_law(z):
+    """
+    Create array version of merra_log_law taking whole blocks of h, v10, and 
+    v50 and returning extrapolated wind speed at z. The returned function 
+    accepts an optional output array as fourth argument.
+
+    Args:
+        z (float): height above ground to extrapolate wind speed to
+    """
+    def extrapolate(h,v10,v50,out=None):
+        return log_law_array(z,h,(10.0,v10),(50.0-h,v50),out=out)
+    return extrapolate
+
+def array_merra_power_law(z):
+    """
+    Create array version of merra_power_law taking whole blocks of h, v10, and 
+    v50 and returning extrapolated wind speed at z. The returned function 
+    accepts an optional output array as fourth argument.
+
+    Args:
+        z (float): height above ground to extrapolate wind speed to
+    """
+    def extrapolate(h,v10,v50,out=None):
+        return power_law_array(z,h,(10.0,v10),(50.0-h,v50),out=out)
+    return extrapolate
+
+def merra_log_profile(h,v10,v50):
+    """
+    Log law wind profile for blocks of MERRA data, as in array_merra_log_law, 
+    for extrapolating the same data to several heights.
+
+    Args:
+        h (array): displacement height
+        v10 (array): wind speed 10 m above displacement height
+        v50 (array): wind speed 50 m above surface
+
+    Returns:
+        function: profile(z,out=None) giving extrapolated wind speed at z
+    """
+    return log_law_profile(h,(10.0,v10),(50.0-h,v50))
+
+def merra_power_profile(h,v10,v50):
+    """
+    Power law wind profile for blocks of MERRA data, as in 
+    array_merra_power_law, for extrapolating the same data to several heights.
+
+    Args:
+        h (array): displacement height
+        v10 (array): wind speed 10 m above displacement height
+        v50 (array): wind speed 50 m above surface
+
+    Returns:
+        function: profile(z,out=None) giving extrapolated wind speed at z
+    """
+    return power_law_profile(h,(10.0,v10),(50.0-h,v50))
+
+# Profiles sharing terms between hub heights, for the array engines
+PROFILES = {
+    'loglaw': merra_log_profile,
+    'powerlaw': merra_power_profile
+}
+
+# Array engines are the default, the np.vectorize versions are kept for 
+# reference and benchmarking
 EXTRAPOLATORS = {
-    'loglaw':vectorize_merra_log_law,
-    'powerlaw': vectorize_merra_power_law
+    'loglaw': array_merra_log_law,
+    'powerlaw': array_merra_power_law,
+    'loglaw-vectorize': vectorize_merra_log_law,
+    'powerlaw-vectorize': vectorize_merra_power_law
 }
 
-def production(source,powercurve,extrapolate,**kwargs):
+def source_files(source):
     """
-    Transform MERRA wind speed data into wind power production time series.
+    Find MERRA source files in a folder and extract the year of each file.
 
     Args:
-        source (str): path to source data file
-        powercurve (function): function to transform wind speed to output
-        extrapolate (function): an extrapolator for MERRA data (h, ws10m, ws50m)
+        source (str): path to folder with source data files
 
     Returns:
-        tuple: latitudes, longitudes, time, wind speed (hub height), wind power output
+        list: sorted (year, path) tuples
     """
-    logger.debug('Entering production transformation function for MERRA wind.')
-    import tradewind
-    import h5py
-
-    # Read data
     regex_y = re.compile(r'[^.]+\.(?P<year>\d{4})\.hdf')
     files = sorted(glob.glob(os.path.join(source,'*.hdf')))
     logger.debug('Searching through {} files in {}.'.format(len(files),source))
     if not files:
         logger.warning('No source files found in {}!'.format(source))
+
+    years = []
     for f in files:
         try:
-            year = regex_y.match(f).group('year')
-        except Exeption as e:
+            year = regex_y.match(os.path.basename(f)).group('year')
+        except Exception as e:
             logger.error('Could not extract year from {}.'.format(f))
             raise e
+        years.append((year,f))
+    return years
 
-        logger.debug('Trying to open input file {}.'.format(f))
-        with h5py.File(f,'r') as infile:
-            logger.info('Reading variables from {}.'.format(f))
-            h = np.array(infile['disph'])
-            abs_ws10 = np.sqrt(np.square(infile['u10m'])+np.square(infile['v10m']))
-            abs_ws50 = np.sqrt(np.square(infile['u50m'])+np.square(infile['v50m']))
-            longs = np.array(infile['longitude'])
-            lats = np.array(infile['latitude'])
-            time = np.array(infile['time'])
+def open_file(path):
+    """
+    Open a MERRA source file for reading.
+
+    Args:
+        path (str): path to file
+
+    Returns:
+        h5py.File: the open file
+    """
+    import h5py
+
+    return h5py.File(path,'r')
+
+def read_coordinates(infile):
+    """
+    Read latitudes, longitudes and time from an open MERRA file.
+
+    Args:
+        infile (h5py.File): open source file
+
+    Returns:
+        tuple: latitudes, longitudes, time
+    """
+    lats = np.array(infile['latitude'])
+    longs = np.array(infile['longitude'])
+    time = np.array(infile['time'])
+    return lats,longs,time
+
+def read_time_units(infile):
+    """
+    Units of the time steps of an open MERRA file (e.g. 'minutes since 
+    2001-01-01 00:30:00'), see windio.decode_time.
+
+    Args:
+        infile (h5py.File): open source file
+
+    Returns:
+        str: units, or None if the file does not say
+    """
+    return infile['time'].attrs.get('units')
+
+def read_variable(infile,key,sl=slice(None),sites=None):
+    """
+    Read a time slab of a (time,lat,lon) variable, for selected sites only if 
+    sites is given.
+
+    Args:
+        infile (h5py.File): open source file
+        key (str): key of variable
+        sl (slice): time slab to read
+        sites (sites.SiteSelection): sites to read (all if None)
+
+    Returns:
+        numpy.ndarray: (time,lat,lon) array, or (time,sites) for selected sites
+    """
+    if sites is None:
+        return np.asarray(infile[key][sl])
+    return sites.read(infile[key],sl)
+
+def abs_wind_speed(infile,u_key,v_key,sl=slice(None),sites=None):
+    """
+    Read wind components for a time slab and calculate absolute wind speed, 
+    reusing the array of the first component for the result.
+
+    Args:
+        infile (h5py.File): open source file
+        u_key (str): key of eastward wind component
+        v_key (str): key of northward wind component
+        sl (slice): time slab to read
+        sites (sites.SiteSelection): sites to read (all if None)
+
+    Returns:
+        numpy.ndarray: absolute wind speed for the slab
+    """
+    ws = read_variable(infile,u_key,sl,sites)
+    np.square(ws,out=ws)
+    v = read_variable(infile,v_key,sl,sites)
+    np.square(v,out=v)
+    ws += v
+    del v
+    return np.sqrt(ws,out=ws)
+
+def time_slabs(num_steps,chunk_size=None):
+    """
+    Split a time axis into slabs of at most chunk_size steps.
+
+    Args:
+        num_steps (int): length of time axis
+        chunk_size (int): number of time steps per slab (all if None or 0)
+
+    Returns:
+        list: slices along the time axis
+    """
+    if not chunk_size:
+        chunk_size = max(num_steps,1)
+    return [slice(start,min(start+chunk_size,num_steps))
+                for start in xrange(0,num_steps,chunk_size)]
+
+def read_slab(infile,sl,sites=None):
+    """
+    Read displacement height and absolute wind speeds at 10 and 50 m for a 
+    time slab of an open MERRA file.
+
+    Args:
+        infile (h5py.File): open source file
+        sl (slice): time slab to read
+        sites (sites.SiteSelection): sites to read, as (time,sites) arrays 
+            (the whole grid if None)
+
+    Returns:
+        tuple: h, ws10 and ws50 arrays
+    """
+    logger.debug('Reading variables for time steps {} to {}.'.format(sl.start,sl.stop))
+    h = read_variable(infile,'disph',sl,sites)
+    abs_ws10 = abs_wind_speed(infile,'u10m','v10m',sl,sites)
+    abs_ws50 = abs_wind_speed(infile,'u50m','v50m',sl,sites)
+    return h,abs_ws10,abs_ws50
+
+def iter_raw_slabs(infile,chunk_size=None,sites=None):
+    """
+    Read an open MERRA file one time slab at a time, see read_slab.
+
+    Args:
+        infile (h5py.File): open source file
+        chunk_size (int): number of time steps per slab (all if None or 0)
+        sites (sites.SiteSelection): sites to read (the whole grid if None)
+
+    Yields:
+        tuple: time slice, h, ws10 and ws50 arrays
+    """
+    for sl in time_slabs(infile['u10m'].shape[0],chunk_size):
+        yield (sl,)+read_slab(infile,sl,sites)
+
+def iter_component_slabs(infile,chunk_size=None,sites=None):
+    """
+    Read displacement height and wind components of an open MERRA file one
+    time slab at a time, leaving the wind speed magnitudes to the consumer
+    (see kernel.TiledKernel).
+
+    Args:
+        infile (h5py.File): open source file
+        chunk_size (int): number of time steps per slab (all if None or 0)
+        sites (sites.SiteSelection): sites to read (the whole grid if None)
+
+    Yields:
+        tuple: time slice, h, u10, v10, u50 and v50 arrays
+    """
+    for sl in time_slabs(infile['u10m'].shape[0],chunk_size):
+        logger.debug('Reading components for time steps {} to {}.'.format(sl.start,sl.stop))
+        yield (sl,)+tuple(read_variable(infile,key,sl,sites)
+                          for key in ['disph','u10m','v10m','u50m','v50m'])
+
+def compute_slab(raw,configs,profiles=None,extrapolators=None):
+    """
+    Calculate hub height wind speed and wind power output for several 
+    configurations from a slab read by iter_raw_slabs. Profile terms (see 
+    PROFILES) are calculated once per extrapolation method and hub height 
+    wind speeds once per method and height.
+
+    Args:
+        raw (tuple): time slice, h, ws10 and ws50 arrays
+        configs (list): (extrapolation method, hub height, power curve) tuples, 
+            methods as keys of EXTRAPOLATORS
+        profiles (dict): profiles to use instead of PROFILES (for other data 
+            sources with two reference heights)
+        extrapolators (dict): extrapolators to use instead of EXTRAPOLATORS
+
+    Returns:
+        tuple: time slice, list of (wind speed, wind power output) for each 
+            configuration
+    """
+    sl,h,abs_ws10,abs_ws50 = raw
+    if profiles is None:
+        profiles = PROFILES
+    if extrapolators is None:
+        extrapolators = EXTRAPOLATORS
+    profile = {}
+    ws_z = {}
+    results = []
+    for method,hubheight,powercurve in configs:
+        key = (method,float(hubheight))
+        if key not in ws_z:
+            logger.debug('Extrapolating to {} m with {}.'.format(hubheight,method))
+            if method in profiles:
+                if method not in profile:
+                    profile[method] = profiles[method](h,abs_ws10,abs_ws50)
+                ws_z[key] = profile[method](hubheight)
+            else:
+                ws_z[key] = extrapolators[method](hubheight)(h,abs_ws10,abs_ws50)
+        logger.debug("Applying power curve '{}'.".format(powercurve.__name__))
+        results.append((ws_z[key],powercurve(ws_z[key])))
+    return sl,results
+
+def iter_slabs_multi(infile,configs,chunk_size=None,sites=None):
+    """
+    Calculate hub height wind speed and wind power output for several 
+    configurations from one read of an open MERRA file, one time slab at a 
+    time. Absolute wind speeds are calculated once per slab, see 
+    compute_slab for the rest. Memory use grows with the number of 
+    configurations times the chunk size.
+
+    Args:
+        infile (h5py.File): open source file
+        configs (list): (extrapolation method, hub height, power curve) tuples, 
+            methods as keys of EXTRAPOLATORS
+        chunk_size (int): number of time steps per slab (all if None or 0)
+        sites (sites.SiteSelection): sites to compute (the whole grid if None)
+
+    Yields:
+        tuple: time slice, list of (wind speed, wind power output) for each 
+            configuration
+    """
+    for raw in iter_raw_slabs(infile,chunk_size,sites):
+        yield compute_slab(raw,configs)
+
+def iter_slabs(infile,powercurve,extrapolate,chunk_size=None,sites=None):
+    """
+    Calculate hub height wind speed and wind power output for an open MERRA 
+    file, one time slab at a time.
+
+    Args:
+        infile (h5py.File): open source file
+        powercurve (function): function to transform wind speed to output
+        extrapolate (function): an extrapolator for MERRA data (h, ws10m, ws50m)
+        chunk_size (int): number of time steps per slab (all if None or 0)
+        sites (sites.SiteSelection): sites to compute (the whole grid if None)
+
+    Yields:
+        tuple: time slice, wind speed (hub height), wind power output
+    """
+    for sl in time_slabs(infile['u10m'].shape[0],chunk_size):
+        h,abs_ws10,abs_ws50 = read_slab(infile,sl,sites)
 
-        logger.info("Calculating and extrapolating.")
         # Extrapolate wind speed to hub height
         logger.debug('Running extrapolation function.')
         abs_ws_z = extrapolate(h,abs_ws10,abs_ws50)
+        del h,abs_ws10,abs_ws50
 
         # Apply the selected power curve
-        logger.info("Applying power curve '{}'.".format(powercurve.__name__))
+        logger.debug("Applying power curve '{}'.".format(powercurve.__name__))
         wp_output = powercurve(abs_ws_z)
 
+        yield sl,abs_ws_z,wp_output
+
+def production_chunked(source,powercurve,extrapolate,chunk_size=None,sites=None,**kwargs):
+    """
+    Transform MERRA wind speed data into wind power production time series, 
+    streaming each year in time slabs so that peak memory is bounded by the 
+    chunk size rather than the length of the year.
+
+    The slab iterator of each year reads from the open source file and must be 
+    consumed before advancing to the next year.
+
+    Args:
+        source (str): path to source data folder
+        powercurve (function): function to transform wind speed to output
+        extrapolate (function): an extrapolator for MERRA data (h, ws10m, ws50m)
+        chunk_size (int): number of time steps per slab (all if None or 0)
+        sites (sites.SiteSelection): sites to compute, slabs are (time,sites) 
+            arrays if given (the whole grid if None)
+
+    Yields:
+        tuple: year, latitudes, longitudes, time, iterator over (time slice, 
+            wind speed (hub height), wind power output)
+    """
+    logger.debug('Entering chunked production function for MERRA wind.')
+    import h5py
+
+    for year,f in source_files(source):
+        logger.debug('Trying to open input file {}.'.format(f))
+        with h5py.File(f,'r') as infile:
+            logger.info('Streaming variables from {} in slabs of {} time steps.'.format(
+                f,chunk_size or 'all'))
+            lats,longs,time = read_coordinates(infile)
+            yield year,lats,longs,time,iter_slabs(infile,powercurve,extrapolate,
+                                                  chunk_size,sites)
+
+def production(source,powercurve,extrapolate,sites=None,**kwargs):
+    """
+    Transform MERRA wind speed data into wind power production time series.
+
+    Args:
+        source (str): path to source data file
+        powercurve (function): function to transform wind speed to output
+        extrapolate (function): an extrapolator for MERRA data (h, ws10m, ws50m)
+        sites (sites.SiteSelection): sites to compute (the whole grid if None)
+
+    Returns:
+        tuple: latitudes, longitudes, time, wind speed (hub height), wind power output
+    """
+    logger.debug('Entering production transformation function for MERRA wind.')
+    for year,lats,longs,time,slabs in production_chunked(source,powercurve,extrapolate,
+                                                                sites=sites):
+        logger.info("Calculating and extrapolating.")
+        (_,abs_ws_z,wp_output), = slabs
         yield year,lats,longs,time,abs_ws_z,wp_output
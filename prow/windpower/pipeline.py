@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+import logging
+import multiprocessing
+import traceback
+import os
+import time as timer
+import hashlib
+import merra
+import era
+import prefetch
+
+logger = logging.getLogger(__name__)
+
+# Modules providing source_files, open_file, read_coordinates, read_time_units, 
+# iter_slabs, iter_slabs_multi, iter_raw_slabs, compute_slab, EXTRAPOLATORS 
+# and, for the tiled kernel, iter_component_slabs and PROFILES
+DATASOURCES = {
+    'era': era,
+    'merra': merra,
+    'merra2': merra
+}
+
+# Bump to invalidate outputs of earlier versions in incremental runs
+OUTPUT_VERSION = 1
+
+def source_fingerprint(path,sample_bytes=2**20):
+    """
+    Cheap fingerprint of a source file from its size, modification time and 
+    the contents of its first and last bytes.
+
+    Args:
+        path (str): path to file
+        sample_bytes (int): number of bytes hashed at each end
+
+    Returns:
+        str: hex digest
+    """
+    stat = os.stat(path)
+    fingerprint = hashlib.sha1(repr((stat.st_size,int(stat.st_mtime))))
+    with open(path,'rb') as f:
+        fingerprint.update(f.read(sample_bytes))
+        f.seek(max(stat.st_size-sample_bytes,0))
+        fingerprint.update(f.read(sample_bytes))
+    return fingerprint.hexdigest()
+
+def powercurve_fingerprint(powercurve):
+    """
+    Identity of a power curve from its name and its output sampled at wind 
+    speeds from 0 to 40 m/s, so that changes to the curve are noticed.
+
+    Args:
+        powercurve (function): function to transform wind speed to output
+
+    Returns:
+        str: hex digest
+    """
+    import numpy as np
+
+    samples = np.asarray(powercurve(np.linspace(0.,40.,401)),dtype=np.float64)
+    fingerprint = hashlib.sha1(repr((getattr(powercurve,'__module__',None),
+                                     getattr(powercurve,'__name__',None))))
+    fingerprint.update(samples.tobytes())
+    return fingerprint.hexdigest()
+
+def output_fingerprint(source_fp,datasource,extrap_method,hubheight,curve_fp,
+                       storage,stats,histogram,site_mask=None):
+    """
+    Fingerprint of everything that determines the contents of an output file.
+
+    Args:
+        source_fp (str): fingerprint of source file
+        datasource, extrap_method, hubheight: as in production_jobs
+        curve_fp (str): fingerprint of power curve, see powercurve_fingerprint
+        storage (dict): output storage settings
+        stats (bool): per-site statistics are saved
+        histogram (bool): wind speed histograms are saved
+        site_mask (tuple): fingerprint of sites file and bounding box of a 
+            site mask (None for the whole grid)
+
+    Returns:
+        str: hex digest
+    """
+    settings = (OUTPUT_VERSION,source_fp,datasource,extrap_method,float(hubheight),
+                curve_fp,sorted((storage or {}).items()),bool(stats),bool(histogram))
+    if site_mask is not None:
+        settings += (site_mask,)
+    return hashlib.sha1(repr(settings)).hexdigest()
+
+def is_current(outfile_path,fingerprint):
+    """
+    Check if an output file exists and was completed with the given 
+    fingerprint.
+
+    Args:
+        outfile_path (str): path to output file
+        fingerprint (str): expected fingerprint
+
+    Returns:
+        bool: True if the file is up to date
+    """
+    import h5py
+
+    if not os.path.exists(outfile_path):
+        return False
+    try:
+        with h5py.File(outfile_path,'r') as f:
+            return f.attrs.get('fingerprint') == fingerprint
+    except IOError:
+        logger.warning('Could not read {}, will recreate it.'.format(outfile_path))
+        return False
+
+def pending_jobs(jobs):
+    """
+    Remove outputs that are up to date from jobs, and jobs without any 
+    remaining outputs, for incremental runs.
+
+    Args:
+        jobs (list): jobs as created by production_jobs
+
+    Returns:
+        list: jobs with outputs that need to be (re)calculated
+    """
+    pending = []
+    for job in jobs:
+        outputs = [out for out in job['outputs']
+                       if not is_current(out['outfile_path'],out['fingerprint'])]
+        skipped = len(job['outputs'])-len(outputs)
+        if skipped:
+            logger.info('Year {}: {} of {} outputs are up to date.'.format(
+                job['year'],skipped,len(job['outputs'])))
+        if outputs:
+            pending.append(dict(job,outputs=outputs))
+    logger.info('{} of {} years need processing.'.format(len(pending),len(jobs)))
+    return pending
+
+def hubheight_label(hubheight):
+    """
+    Hub height as used in output file names and wind speed keys (ws_<label>m), 
+    without a trailing .0 for whole metres (e.g. 100 or 100.5).
+
+    Args:
+        hubheight (float): hub height
+
+    Returns:
+        str: label
+    """
+    return '{:g}'.format(float(hubheight))
+
+def output_path(dest,datasource,extrap_method,hubheight,powercurve,year):
+    """
+    Path of the wind production output file for one year and configuration.
+
+    Args:
+        dest (str): output folder
+        datasource (str): name of data source
+        extrap_method (str): name of extrapolation method
+        hubheight (float): hub height
+        powercurve (str): name of power curve
+        year (str): year of data
+
+    Returns:
+        str: path to output file
+    """
+    return os.path.join(dest,'windpower_output.{}.{}.{}m.{}.{}.hdf5'.format(
+        datasource,extrap_method,hubheight_label(hubheight),powercurve,year))
+
+def production_jobs(source,dest,datasource,powercurves,extrap_methods,hubheights,
+                    chunk_size=None,storage=None,stats=True,histogram=False,
+                    prefetch_depth=0,threads=0,tile_size=2**15,sites_file=None,
+                    bbox=None):
+    """
+    Create one job per source year for process_year, each producing output 
+    for every combination of power curve, extrapolation method and hub height.
+
+    Args:
+        source (str): folder with source files
+        dest (str): output folder
+        datasource (str): name of data source (key in DATASOURCES)
+        powercurves (list): (name, function) of power curves, the name is used 
+            in output file names
+        extrap_methods (list): names of extrapolation methods (keys in 
+            EXTRAPOLATORS of the data source)
+        hubheights (list): hub heights, distinct in output names (see 
+            hubheight_label)
+        chunk_size (int): number of time steps per slab (all if None or 0)
+        storage (dict): output storage settings for 
+            windio.create_output_dataset (dtype, layout, compression, 
+            compression_level)
+        stats (bool): cache per-site statistics in output files
+        histogram (bool): save per-site histograms of hub height wind speed, 
+            with bins at the TradeWind power curve wind speeds
+        prefetch_depth (int): read and write in background processes with up 
+            to this many slabs queued on each side (all in one process if 0, 
+            and in worker processes of run)
+        threads (int): evaluate slabs tile by tile with kernel.TiledKernel on 
+            this many threads (whole slabs with compute_slab if 0)
+        tile_size (int): number of grid cells and time steps per tile
+        sites_file (str): compute only the sites in this file, see 
+            sites.sites_from_file, and write outputs in the compact 
+            (time,sites) layout
+        bbox (tuple): compute only the sites in this bounding box (south, 
+            north, west, east), as sites_file
+
+    Returns:
+        list: jobs as dicts, sorted by year
+    """
+    labels = {}
+    for hubheight in hubheights:
+        other = labels.setdefault(hubheight_label(hubheight),hubheight)
+        if other != hubheight:
+            raise ValueError('Hub heights {} and {} would share output files.'.format(
+                other,hubheight))
+
+    jobs = []
+    powercurves = [(name,fcn,powercurve_fingerprint(fcn)) for name,fcn in powercurves]
+    site_mask = None
+    if sites_file is not None or bbox is not None:
+        site_mask = (source_fingerprint(sites_file) if sites_file else None,
+                     tuple(float(b) for b in bbox) if bbox else None)
+    for year,source_path in DATASOURCES[datasource].source_files(source):
+        source_fp = source_fingerprint(source_path)
+        outputs = []
+        for extrap_method in extrap_methods:
+            for hubheight in hubheights:
+                for powercurve_name,powercurve,curve_fp in powercurves:
+                    outputs.append({
+                        'outfile_path': output_path(dest,datasource,extrap_method,
+                                                    hubheight,powercurve_name,year),
+                        'powercurve': powercurve,
+                        'powercurve_name': powercurve_name,
+                        'extrap_method': extrap_method,
+                        'hubheight': hubheight,
+                        'fingerprint': output_fingerprint(source_fp,datasource,
+                            extrap_method,hubheight,curve_fp,storage,stats,histogram,
+                            site_mask)
+                    })
+        jobs.append({
+            'year': year,
+            'source_path': source_path,
+            'datasource': datasource,
+            'outputs': outputs,
+            'chunk_size': chunk_size,
+            'storage': storage or {},
+            'stats': stats,
+            'histogram': histogram,
+            'prefetch_depth': prefetch_depth,
+            'threads': threads,
+            'tile_size': tile_size,
+            'sites_file': sites_file,
+            'bbox': bbox
+        })
+    return jobs
+
+def read_raw_slabs(datasource,source_path,chunk_size,sites=None,components=False):
+    """
+    Open a source file and read it in raw slabs for compute_slab of the data 
+    source, or in wind component slabs for kernel.TiledKernel. A module level 
+    function, so that it can run in a reader process (see prefetch).
+
+    Args:
+        datasource (str): name of data source (key in DATASOURCES)
+        source_path (str): path to source file
+        chunk_size (int): number of time steps per slab (all if None or 0)
+        sites (sites.SiteSelection): sites to read (the whole grid if None)
+        components (bool): read wind components (iter_component_slabs) 
+            instead of absolute wind speeds (iter_raw_slabs)
+
+    Yields:
+        tuple: raw slab
+    """
+    datasource = DATASOURCES[datasource]
+    with datasource.open_file(source_path) as infile:
+        if components:
+            slabs = datasource.iter_component_slabs(infile,chunk_size,sites)
+        else:
+            slabs = datasource.iter_raw_slabs(infile,chunk_size,sites)
+        for slab in slabs:
+            yield slab
+
+def timed_slabs(slabs,stage_timer):
+    """Iterate over slabs, timing the production of each with stage_timer."""
+    slabs = iter(slabs)
+    while True:
+        with stage_timer.busy(count=False):
+            slab = next(slabs,None)
+        if slab is None:
+            return
+        stage_timer.items += 1
+        yield slab
+
+def computed_slabs(compute,raw_slabs,stage_timer):
+    """
+    Compute output slabs from raw slabs with compute, timing the computation 
+    and the waiting for raw slabs with stage_timer.
+    """
+    raw_slabs = iter(raw_slabs)
+    while True:
+        with stage_timer.wait():
+            raw = next(raw_slabs,None)
+        if raw is None:
+            return
+        with stage_timer.busy():
+            slab = compute(raw)
+        del raw
+        yield slab
+
+@contextmanager
+def slab_kernel(datasource,configs,threads,tile_size):
+    """
+    Context manager giving a kernel.TiledKernel for the configurations, or 
+    None if threads is 0 or the tiled kernel cannot evaluate all of them 
+    (extrapolation methods without a profile), in which case whole slabs are 
+    computed with datasource.compute_slab.
+
+    Args:
+        datasource (module): data source module, see DATASOURCES
+        configs (list): (extrapolation method, hub height, power curve) tuples
+        threads (int): number of threads
+        tile_size (int): number of grid cells and time steps per tile
+    """
+    if threads <= 0:
+        yield None
+        return
+    profiles = getattr(datasource,'PROFILES',{})
+    unsupported = sorted(set(method for method,_,_ in configs)-set(profiles))
+    if unsupported:
+        logger.warning('No tiled kernel for extrapolation methods {}, computing whole slabs.'.format(
+            ', '.join(unsupported)))
+        yield None
+        return
+    import kernel
+
+    logger.debug('Evaluating slabs in tiles of {} on {} threads.'.format(tile_size,threads))
+    with kernel.TiledKernel(profiles,configs,threads,tile_size) as tiled:
+        yield tiled
+
+def process_year(job):
+    """
+    Read one year of source data once, calculate wind power production for 
+    each output configuration of the job and write one output file for each. 
+    Files are written under temporary names and renamed when complete, 
+    stamped with their fingerprints, so that an interrupted run never leaves 
+    files that look complete.
+
+    Args:
+        job (dict): job as created by production_jobs
+    """
+    import windio
+    import tradewind
+    import sites
+
+    datasource = DATASOURCES[job['datasource']]
+    outputs = job['outputs']
+    configs = [(out['extrap_method'],out['hubheight'],out['powercurve']) for out in outputs]
+    tmp_paths = [('{}.{}.tmp'.format(out['outfile_path'],os.getpid()),
+                  'ws_{}m'.format(hubheight_label(out['hubheight']))) for out in outputs]
+    attrs = [{'fingerprint': out['fingerprint'],
+              'source_path': os.path.abspath(job['source_path']),
+              'extrap_method': out['extrap_method'],
+              'hubheight': float(out['hubheight']),
+              'powercurve': out.get('powercurve_name',out['powercurve'].__name__)}
+                for out in outputs]
+
+    depth = job.get('prefetch_depth',0)
+    if depth > 0 and multiprocessing.current_process().daemon:
+        logger.warning('Worker processes cannot start reader and writer processes, '
+                       'reading and writing in the worker.')
+        depth = 0
+
+    logger.debug('Trying to open input file {}.'.format(job['source_path']))
+    try:
+        # Closed again before any reader process opens it
+        with datasource.open_file(job['source_path']) as infile:
+            lats,longs,time = datasource.read_coordinates(infile)
+            time_units = datasource.read_time_units(infile)
+        selection = sites.select_sites(lats,longs,job.get('sites_file'),job.get('bbox'))
+        logger.info('Processing {} in slabs of {} time steps for {} configurations.'.format(
+            job['source_path'],job['chunk_size'] or 'all',len(outputs)))
+
+        timers = [prefetch.StageTimer(name) for name in ['read','compute','write']]
+        with slab_kernel(datasource,configs,job.get('threads',0),
+                         job.get('tile_size',2**15)) as compute:
+            read_args = (job['datasource'],job['source_path'],job['chunk_size'],selection,
+                         compute is not None)
+            if compute is None:
+                compute = lambda raw: datasource.compute_slab(raw,configs)
+            start = timer.time()
+            if depth > 0:
+                raw_slabs = prefetch.prefetch(read_raw_slabs,read_args,depth,timers[0])
+            else:
+                raw_slabs = timed_slabs(read_raw_slabs(*read_args),timers[0])
+            slabs = computed_slabs(compute,raw_slabs,timers[1])
+            edges = tradewind.windspeeds if job.get('histogram') else None
+            windio.write_production_files(tmp_paths,lats,longs,time,slabs,
+                                          stats=job['stats'],histogram_edges=edges,
+                                          attrs=attrs,queue_depth=depth,
+                                          stage_timer=timers[2],
+                                          sites=selection.sites if selection else None,
+                                          time_units=time_units,**job['storage'])
+            prefetch.report_utilisation(timers,timer.time()-start)
+    except:
+        for tmp_path,_ in tmp_paths:
+            if os.path.exists(tmp_path):
+                logger.debug('Removing incomplete file {}.'.format(tmp_path))
+                os.remove(tmp_path)
+        raise
+
+    for out,(tmp_path,_) in zip(outputs,tmp_paths):
+        logger.info('Saving to file {}.'.format(out['outfile_path']))
+        if os.path.exists(out['outfile_path']):
+            # Rename does not replace existing files on Windows
+            os.remove(out['outfile_path'])
+        os.rename(tmp_path,out['outfile_path'])
+
+class _RecordCollector(logging.Handler):
+    """Logging handler keeping records in a list to be re-emitted later."""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self,record):
+        # Format message now so that the record can be pickled
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+def _process_year_in_worker(job):
+    """
+    Run process_year in a worker process, collecting log records instead of
+    printing them and returning errors instead of raising them.
+
+    Returns:
+        tuple: job, log records, formatted traceback (None on success),
+            elapsed seconds
+    """
+    root = logging.getLogger()
+    collector = _RecordCollector()
+    collector.setLevel(root.level)
+    orig_handlers = root.handlers[:]
+    root.handlers = [collector]
+
+    start = timer.time()
+    error = None
+    try:
+        process_year(job)
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        root.handlers = orig_handlers
+    return job,collector.records,error,timer.time()-start
+
+def run(jobs,workers=1):
+    """
+    Run process_year for each job, optionally fanned out over a process pool.
+    Log records from workers are re-emitted in job order and a failing job
+    does not stop the others, but all failures are raised at the end.
+
+    Args:
+        jobs (list): jobs as created by production_jobs
+        workers (int): number of worker processes (run in-process if 1)
+
+    Raises:
+        RuntimeError: if any job failed
+    """
+    failed = []
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            start = timer.time()
+            try:
+                process_year(job)
+            except Exception:
+                logger.error('Year {} failed:\n{}'.format(job['year'],
+                                                        traceback.format_exc()))
+                failed.append(job['year'])
+            else:
+                logger.debug('Year {} done in {:.1f} s.'.format(job['year'],
+                                                            timer.time()-start))
+    else:
+        workers = min(workers,len(jobs))
+        logger.info('Processing {} years with {} workers.'.format(len(jobs),workers))
+        pool = multiprocessing.Pool(workers)
+        try:
+            for job,records,error,elapsed in pool.imap(_process_year_in_worker,jobs):
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                if error is not None:
+                    logger.error('Year {} failed:\n{}'.format(job['year'],error))
+                    failed.append(job['year'])
+                else:
+                    logger.debug('Year {} done in {:.1f} s.'.format(job['year'],elapsed))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    if failed:
+        raise RuntimeError('Processing failed for years: {}.'.format(', '.join(failed)))
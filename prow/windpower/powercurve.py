@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+class LookupPowerCurve(object):
+    """
+    Piecewise linear power curve sampled at evenly spaced wind speeds,
+    evaluated by index arithmetic on precomputed tables of values and slopes
+    instead of searching for the interval of each wind speed.
+
+    Wind speeds outside the sampled range (and NaN) give zero output, like
+    interp1d with bounds_error=False and fill_value=0.
+    """
+    def __init__(self,windspeeds,output,name=None):
+        """
+        Args:
+            windspeeds (list): evenly spaced wind speeds of curve samples
+            output (list): normalised output at each wind speed
+            name (str): name of power curve
+        """
+        windspeeds = np.asarray(windspeeds,dtype=float)
+        output = np.asarray(output,dtype=float)
+        if windspeeds.shape != output.shape or windspeeds.size < 2:
+            raise ValueError('Need at least two wind speeds with one output each.')
+        steps = np.diff(windspeeds)
+        if np.any(steps<=0) or np.ptp(steps)>1e-10:
+            raise ValueError('Wind speeds must be evenly spaced and increasing.')
+
+        self.__name__ = name or 'power_curve'
+        self.windspeeds = windspeeds
+        self.output = output
+        self.start = windspeeds[0]
+        self.step = steps.mean()
+        self.last = windspeeds.size-1
+        # Extra node past the end with zero value and slope for outside values
+        self._values = np.append(output,0.)
+        self._slopes = np.append(np.diff(output)/self.step,[0.,0.])
+        self._tables = {}
+
+    def tables(self,dtype):
+        """Value and slope tables in the given dtype (cached)."""
+        dtype = np.dtype(dtype)
+        if dtype not in self._tables:
+            self._tables[dtype] = (self._values.astype(dtype),
+                                   self._slopes.astype(dtype))
+        return self._tables[dtype]
+
+    def __call__(self,ws,out=None):
+        """
+        Evaluate power curve.
+
+        Args:
+            ws (array): wind speeds (float32 or float64)
+            out (array): optional output array of the same shape, may be ws
+                itself to evaluate in place
+
+        Returns:
+            numpy.ndarray: normalised output
+        """
+        ws = np.asarray(ws)
+        if out is None:
+            dtype = ws.dtype if ws.dtype in (np.float32,np.float64) else np.float64
+            out = np.empty(ws.shape,dtype=dtype)
+        values,slopes = self.tables(out.dtype)
+
+        # Position in table, out-of-range and NaN moved to the zero node
+        pos = np.subtract(ws,self.start,out=out)
+        pos *= 1./self.step
+        with np.errstate(invalid='ignore'):
+            outside = ~((pos>=0) & (pos<=self.last))
+        np.copyto(pos,self.last+1,where=outside)
+        del outside
+
+        idx = pos.astype(np.int32)
+        # Fraction of step times slope plus value at lower node
+        pos -= idx
+        pos *= slopes.take(idx)
+        pos += values.take(idx)
+        return out
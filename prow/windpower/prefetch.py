@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Background processes for overlapping reading, computing and writing of time
+slabs.
+
+h5py holds the GIL for the whole of each call into HDF5, so a thread reading
+or writing stalls every other thread of its process, including NumPy work in
+the main thread. Reading and writing therefore run in processes of their
+own, each with its own GIL and HDF5 library, and exchange slabs with the main
+process through bounded queues (pickled, i.e. copied once each way). Functions
+and arguments given to the background processes must be picklable, e.g.
+module level functions.
+"""
+from contextlib import contextmanager
+import multiprocessing
+import Queue
+import logging
+import traceback
+import time as timer
+
+logger = logging.getLogger(__name__)
+
+# Queue markers for the end of the items and for errors in a process
+_DONE = 'done'
+_ERROR = 'error'
+
+class StageTimer(object):
+    """Time spent working and waiting in one stage of a pipeline."""
+    def __init__(self,name):
+        """
+        Args:
+            name (str): name of stage
+        """
+        self.name = name
+        self.busy_time = 0.
+        self.wait_time = 0.
+        self.items = 0
+
+    @contextmanager
+    def busy(self,count=True):
+        """
+        Context manager timing work on one item.
+
+        Args:
+            count (bool): count an item (False if it may turn out that there
+                was none)
+        """
+        start = timer.time()
+        try:
+            yield
+        finally:
+            self.busy_time += timer.time()-start
+            if count:
+                self.items += 1
+
+    @contextmanager
+    def wait(self):
+        """Context manager timing waiting for other stages."""
+        start = timer.time()
+        try:
+            yield
+        finally:
+            self.wait_time += timer.time()-start
+
+    def totals(self):
+        """Busy time, wait time and number of items, e.g. to send to another process."""
+        return self.busy_time,self.wait_time,self.items
+
+    def add(self,totals):
+        """Add totals of the same stage timed in another process."""
+        busy_time,wait_time,items = totals
+        self.busy_time += busy_time
+        self.wait_time += wait_time
+        self.items += items
+
+def report_utilisation(timers,elapsed):
+    """
+    Log the share of wall time each stage was busy. The stage closest to
+    100 % is the bottleneck.
+
+    Stages in background processes (see prefetch and BackgroundWriter) run
+    alongside the main process, so their shares are independent. Stages in
+    the same process run one after another and their shares add up to at
+    most 100 %.
+
+    Args:
+        timers (list): StageTimer of each stage
+        elapsed (float): wall time of the pipeline in seconds
+    """
+    elapsed = max(elapsed,1e-9)
+    logger.info('Stage utilisation over {:.1f} s: {}.'.format(elapsed,', '.join(
+        '{} {:.0f} % ({:.1f} s busy, {:.1f} s waiting, {} slabs)'.format(
+            t.name,100.*t.busy_time/elapsed,t.busy_time,t.wait_time,t.items)
+        for t in timers)))
+
+def _put(q,item,stop):
+    """Put item on queue, giving up if stop is set. Returns False if stopped."""
+    while not stop.is_set():
+        try:
+            q.put(item,timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def _get(q,process):
+    """Get item from queue, raising an error if process ended without one."""
+    while True:
+        try:
+            return q.get(timeout=0.1)
+        except Queue.Empty:
+            if not process.is_alive():
+                try:
+                    return q.get(timeout=0.1)
+                except Queue.Empty:
+                    raise RuntimeError('{} exited with code {}.'.format(
+                        process.name,process.exitcode))
+
+def _join(q,process):
+    """Wait for process to end, discarding what it still puts on queue."""
+    while process.is_alive():
+        try:
+            q.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+    process.join()
+
+def _produce(fcn,args,q,stop,name):
+    """Put the items of fcn(*args) on queue q, in a background process."""
+    stage_timer = StageTimer(name)
+    try:
+        items = iter(fcn(*args))
+        while True:
+            with stage_timer.busy(count=False):
+                item = next(items,_DONE)
+            if item is _DONE:
+                break
+            stage_timer.items += 1
+            with stage_timer.wait():
+                if not _put(q,(None,item),stop):
+                    # Consumer gone, do not wait for queued items on exit
+                    q.cancel_join_thread()
+                    return
+        _put(q,(_DONE,stage_timer.totals()),stop)
+    except BaseException:
+        if not _put(q,(_ERROR,traceback.format_exc()),stop):
+            q.cancel_join_thread()
+
+def prefetch(fcn,args=(),depth=2,stage_timer=None):
+    """
+    Iterate over the items of fcn(*args), produced in a background process
+    that runs at most depth items ahead. The process is started right away.
+    Errors in the process are raised in the consumer as RuntimeError with
+    the traceback of the process.
+
+    Args:
+        fcn (function): picklable function returning an iterable
+        args (tuple): arguments of fcn
+        depth (int): number of items queued ahead
+        stage_timer (StageTimer): timer for producing items
+
+    Returns:
+        generator: items of fcn(*args)
+    """
+    stage_timer = stage_timer or StageTimer('prefetch')
+    q = multiprocessing.Queue(maxsize=max(depth,1))
+    stop = multiprocessing.Event()
+    process = multiprocessing.Process(target=_produce,args=(fcn,args,q,stop,stage_timer.name),
+                                      name='{}-process'.format(stage_timer.name))
+    process.daemon = True
+    process.start()
+
+    def consume():
+        try:
+            while True:
+                marker,item = _get(q,process)
+                if marker == _DONE:
+                    stage_timer.add(item)
+                    break
+                if marker == _ERROR:
+                    raise RuntimeError('Error in {}:\n{}'.format(process.name,item))
+                yield item
+        finally:
+            stop.set()
+            _join(q,process)
+    return consume()
+
+def _consume(fcn,args,kwargs,q,result_q,stop,name):
+    """Call fcn with the items on queue q, in a background process."""
+    stage_timer = StageTimer(name)
+
+    def items():
+        while True:
+            with stage_timer.wait():
+                entry = None
+                while entry is None:
+                    if stop.is_set():
+                        raise RuntimeError('Stopped before the last item.')
+                    try:
+                        entry = q.get(timeout=0.1)
+                    except Queue.Empty:
+                        pass
+            marker,item = entry
+            if marker == _DONE:
+                return
+            stage_timer.items += 1
+            yield item
+
+    start = timer.time()
+    try:
+        fcn(items(),*args,**kwargs)
+        stage_timer.busy_time = timer.time()-start-stage_timer.wait_time
+        result_q.put((_DONE,stage_timer.totals()))
+    except BaseException:
+        stop.set()
+        result_q.put((_ERROR,traceback.format_exc()))
+
+class BackgroundWriter(object):
+    """
+    Calls fcn(items,*args,**kwargs) in a background process, with the items
+    fed through a queue of at most depth items by put. Errors in the process
+    are raised by put or close as RuntimeError with the traceback of the
+    process.
+    """
+    def __init__(self,fcn,args=(),kwargs=None,depth=2,stage_timer=None):
+        """
+        Args:
+            fcn (function): picklable function consuming an iterable of items
+            args (tuple): further arguments of fcn
+            kwargs (dict): keyword arguments of fcn
+            depth (int): number of items queued
+            stage_timer (StageTimer): timer for fcn, busy while not waiting
+                for items
+        """
+        self.stage_timer = stage_timer or StageTimer('write')
+        self.queue = multiprocessing.Queue(maxsize=max(depth,1))
+        self.result_queue = multiprocessing.Queue()
+        self.stop = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=_consume,
+            args=(fcn,args,kwargs or {},self.queue,self.result_queue,self.stop,
+                  self.stage_timer.name),
+            name='{}-process'.format(self.stage_timer.name))
+        self.process.daemon = True
+        self.process.start()
+        self.finished = False
+
+    def _finish(self):
+        """Wait for the process and raise its error, if any."""
+        if self.finished:
+            return
+        self.finished = True
+        try:
+            marker,result = _get(self.result_queue,self.process)
+        finally:
+            self.stop.set()
+            _join(self.queue,self.process)
+            # Items the process did not take are not sent on exit
+            self.queue.cancel_join_thread()
+        if marker == _ERROR:
+            raise RuntimeError('Error in {}:\n{}'.format(self.process.name,result))
+        self.stage_timer.add(result)
+
+    def put(self,item):
+        """Queue an item, blocking while the queue is full."""
+        if not _put(self.queue,(None,item),self.stop):
+            self._finish()
+            raise RuntimeError('{} stopped early.'.format(self.process.name))
+
+    def close(self,wait=True):
+        """
+        Stop the process after the queued items (if wait) and raise any error.
+
+        Args:
+            wait (bool): process queued items before stopping
+        """
+        if wait:
+            _put(self.queue,(_DONE,None),self.stop)
+        else:
+            self.stop.set()
+        self._finish()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import logging
+import windio
+
+logger = logging.getLogger(__name__)
+
+def read_fractions(source):
+    """
+    Read sparse site fractions from a file written by either
+    write_areas_to_file (calc-areas) or write_classes_to_file
+    (create-classes).
+
+    Args:
+        source (str): path to areas or classes hdf5 file
+
+    Returns:
+        classes.SiteFractions: sparse site fractions (classes is None for
+            area fractions)
+    """
+    import h5py
+
+    with h5py.File(source,'r') as f:
+        has_classes = 'site_fractions' in f
+    if has_classes:
+        return windio.read_site_fractions(source)
+    return windio.read_area_fractions(source)
+
+def cell_weights(fractions,num_cells):
+    """
+    Weights for aggregating flattened (lat,lon) grid cells to regions (and
+    classes). Site ids index the flattened grid, as in classes.class_areas.
+
+    Args:
+        fractions (classes.SiteFractions): sparse site fractions
+        num_cells (int): number of cells in the grid
+
+    Returns:
+        tuple: sorted grid cells used, CSR matrix of weights with one row
+            per region (and class) and one column per used cell
+    """
+    matrix = fractions.matrix.tocsr()
+    used = np.flatnonzero(np.diff(matrix.indptr))
+    cells = np.asarray(fractions.sites)[used]
+    if len(cells) and (cells.min()<0 or cells.max()>=num_cells):
+        raise ValueError('Site ids outside grid with {} cells.'.format(num_cells))
+    logger.debug('{} of {} grid cells contribute to regions.'.format(len(cells),num_cells))
+    return cells,matrix[used].T.tocsr()
+
+def region_production(sources,fractions,dest,key='wp_output',chunk_size=720):
+    """
+    Aggregate wind production per site to regions (and classes) by
+    multiplying time slabs with the sparse site fraction matrix. Memory use is
+    bounded by the chunk size. Files with the compact (time,sites) layout
+    must have the same sites, covering all cells with non-zero fractions.
+
+    Args:
+        sources (list): wind production hdf5 files, concatenated in time
+        fractions (classes.SiteFractions): sparse site fractions
+        dest (str): path to output hdf5 file
+        key (str): key of dataset to aggregate
+        chunk_size (int): number of time steps per slab
+    """
+    import h5py
+
+    sources = sorted(sources)
+    shapes = []
+    site_index = []
+    for source in sources:
+        with h5py.File(source,'r') as f:
+            shapes.append(f[key].shape)
+            site_index.append(windio.read_sites(f,key))
+            grid = windio.grid_shape(f)
+            time_dtype = f['time'].dtype
+    if len(set(shape[1:] for shape in shapes)) > 1 or \
+            any(not np.array_equal(s,site_index[0]) for s in site_index[1:]):
+        raise ValueError('Grids differ between source files.')
+    num_t = sum(shape[0] for shape in shapes)
+    num_cells = grid[0]*grid[1]
+
+    cells,weights = cell_weights(fractions,num_cells)
+    columns = cells
+    if site_index[0] is not None:
+        # Columns of the used cells in the (time,sites) datasets
+        sites = site_index[0]
+        columns = np.searchsorted(sites,cells)
+        missing = (columns==len(sites)) | (sites[np.minimum(columns,len(sites)-1)]!=cells)
+        if missing.any():
+            raise ValueError('{} cells with non-zero fractions are not in the sites of {}.'.format(
+                np.count_nonzero(missing),sources[0]))
+    num_regions = len(fractions.regions)
+    if fractions.classes is None:
+        out_shape = (num_regions,num_t)
+    else:
+        out_shape = (num_regions,len(fractions.classes),num_t)
+
+    logger.info('Aggregating {} time steps to {} regions.'.format(num_t,num_regions))
+    with h5py.File(dest,'w') as outfile:
+        outfile['regions'] = np.array(fractions.regions,dtype=str)
+        if fractions.classes is not None:
+            outfile['classes'] = np.array(fractions.classes,dtype=float)
+        time_ds = outfile.create_dataset('time',shape=(num_t,),dtype=time_dtype)
+        prod_ds = outfile.create_dataset(key,shape=out_shape,dtype=float,
+            chunks=True,shuffle=True,compression='gzip',compression_opts=4)
+        prod_ds.attrs['dim1'] = 'regions'
+        if fractions.classes is not None:
+            prod_ds.attrs['dim2'] = 'classes'
+        prod_ds.attrs['dim{}'.format(len(out_shape))] = 'time'
+
+        offset = 0
+        for source in sources:
+            logger.debug('Aggregating {} from {}.'.format(key,source))
+            with h5py.File(source,'r') as f:
+                ds = f[key]
+                time_ds[offset:offset+ds.shape[0]] = f['time'][:]
+                for start in xrange(0,ds.shape[0],chunk_size):
+                    stop = min(start+chunk_size,ds.shape[0])
+                    slab = windio.read_dataset(ds,slice(start,stop))
+                    # Used cells as rows, time as columns
+                    site_series = np.ascontiguousarray(
+                        slab.reshape(stop-start,-1)[:,columns].T,dtype=np.float64)
+                    del slab
+                    regional = weights.dot(site_series)
+                    prod_ds[...,offset+start:offset+stop] = regional.reshape(
+                        out_shape[:-1]+(stop-start,))
+                offset += ds.shape[0]
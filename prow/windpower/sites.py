@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Site masks restricting wind production to the grid cells that are used, e.g.
+those intersecting the regions of a study. Sites are flattened (lat,lon) grid
+indices, as in classes.class_areas.
+"""
+import numpy as np
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+class SiteSelection(object):
+    """
+    Sorted subset of the cells of a (lat,lon) grid. Data is read as the
+    smallest hyperslab containing all selected cells, from which the cells
+    are taken. Longitudes are cyclic, so a selection across the edge of the
+    grid (e.g. Greenwich on a 0..360 grid) is read as two hyperslabs joined
+    at the edge.
+    """
+    def __init__(self,sites,grid_shape):
+        """
+        Args:
+            sites (array): flattened grid indices of selected cells
+            grid_shape (tuple): shape of the grid (lat,lon)
+        """
+        self.grid_shape = tuple(int(n) for n in grid_shape)
+        self.sites = np.unique(np.asarray(sites,dtype=np.int64))
+        num_cells = self.grid_shape[0]*self.grid_shape[1]
+        if not len(self.sites):
+            raise ValueError('No sites selected.')
+        if self.sites[0] < 0 or self.sites[-1] >= num_cells:
+            raise ValueError('Site ids outside grid with {} cells.'.format(num_cells))
+
+        rows,cols = np.unravel_index(self.sites,self.grid_shape)
+        self.lat_slice = slice(int(rows.min()),int(rows.max())+1)
+
+        # Columns start after the largest gap between used columns, which may
+        # be inside the grid rather than across its edge
+        num_lon = self.grid_shape[1]
+        used = np.unique(cols)
+        gaps = np.diff(np.r_[used,used[0]+num_lon])
+        last = len(used)-1 if gaps[-1] == gaps.max() else int(np.argmax(gaps))
+        lon_start = int(used[(last+1)%len(used)])
+        width = int((used[last]-lon_start)%num_lon)+1
+        self.lon_slices = [slice(lon_start,min(lon_start+width,num_lon))]
+        if lon_start+width > num_lon:
+            self.lon_slices.append(slice(0,lon_start+width-num_lon))
+
+        slab_shape = (self.lat_slice.stop-self.lat_slice.start,width)
+        # Index of each site in the flattened hyperslab
+        self.local = np.ravel_multi_index((rows-self.lat_slice.start,
+                                           (cols-lon_start)%num_lon),slab_shape)
+        logger.debug('{} of {} cells selected, read as {} by {} hyperslab.'.format(
+            len(self.sites),num_cells,*slab_shape))
+
+    def __len__(self):
+        return len(self.sites)
+
+    def read(self,ds,sl=slice(None)):
+        """
+        Read the selected sites of a (time,lat,lon) dataset.
+
+        Args:
+            ds (h5py.Dataset): dataset to read from
+            sl (slice): time slab to read
+
+        Returns:
+            numpy.ndarray: (time,sites) array
+        """
+        block = np.concatenate([np.asarray(ds[sl,self.lat_slice,lon_slice])
+                                for lon_slice in self.lon_slices],axis=2)
+        return block.reshape(block.shape[0],-1).take(self.local,axis=1)
+
+    def to_grid(self,values,fill=np.nan):
+        """
+        Scatter per-site values to the full grid.
+
+        Args:
+            values (array): values with sites as last axis
+            fill: value of cells that are not selected
+
+        Returns:
+            numpy.ndarray: values with (lat,lon) as last axes
+        """
+        return to_grid(values,self.sites,self.grid_shape,fill)
+
+    def fingerprint(self):
+        """Hex digest of the grid shape and selected sites."""
+        fingerprint = hashlib.sha1(repr(self.grid_shape))
+        fingerprint.update(self.sites.tobytes())
+        return fingerprint.hexdigest()
+
+def to_grid(values,sites,grid_shape,fill=np.nan):
+    """
+    Scatter values of sites (flattened grid indices) to a (lat,lon) grid.
+
+    Args:
+        values (array): values with sites as last axis
+        sites (array): flattened grid indices
+        grid_shape (tuple): shape of the grid (lat,lon)
+        fill: value of cells without a site
+
+    Returns:
+        numpy.ndarray: values with (lat,lon) as last axes
+    """
+    values = np.asarray(values)
+    dtype = np.result_type(values.dtype,np.asarray(fill).dtype)
+    grid = np.full(values.shape[:-1]+(grid_shape[0]*grid_shape[1],),fill,dtype=dtype)
+    grid[...,sites] = values
+    return grid.reshape(values.shape[:-1]+tuple(grid_shape))
+
+def sites_from_file(path,grid_shape):
+    """
+    Read used sites from a file: the sites with non-zero fractions in a file
+    from calc-areas or create-classes (i.e. the grid cells intersecting the
+    regions), the cells set in a boolean (lat,lon) dataset 'mask', or a
+    'sites' dataset of flattened grid indices.
+
+    Args:
+        path (str): path to hdf5 file
+        grid_shape (tuple): shape of the grid (lat,lon)
+
+    Returns:
+        numpy.ndarray: flattened grid indices
+    """
+    import h5py
+
+    with h5py.File(path,'r') as f:
+        has_fractions = 'site_fractions' in f or 'fractions' in f
+        if not has_fractions:
+            if 'mask' in f:
+                mask = np.asarray(f['mask'][...],dtype=bool)
+                if mask.shape != tuple(grid_shape):
+                    raise ValueError('Mask in {} is {}, expected {}.'.format(
+                        path,mask.shape,tuple(grid_shape)))
+                return np.flatnonzero(mask)
+            if 'sites' in f:
+                return f['sites'][:]
+            raise ValueError('No site fractions, mask or sites in {}.'.format(path))
+
+    import regions
+    fractions = regions.read_fractions(path)
+    used = np.flatnonzero(np.diff(fractions.matrix.tocsr().indptr))
+    return np.asarray(fractions.sites)[used]
+
+def sites_in_bbox(lats,longs,bbox):
+    """
+    Sites with cell centres inside a bounding box. Longitudes are compared
+    modulo 360 degrees, so the box selects the same cells on -180..180 and
+    0..360 grids, extends eastwards from west to east, and crosses the date
+    line if the western bound is larger than the eastern. A box 360 degrees
+    wide or more selects all longitudes.
+
+    Args:
+        lats (array): latitudes of the grid
+        longs (array): longitudes of the grid
+        bbox (tuple): south, north, west and east bounds in degrees
+
+    Returns:
+        numpy.ndarray: flattened grid indices
+    """
+    south,north,west,east = bbox
+    in_lat = (lats>=south) & (lats<=north)
+    longs = np.asarray(longs,dtype=np.float64)
+    if east-west >= 360:
+        in_lon = np.ones(longs.shape,dtype=bool)
+    else:
+        in_lon = (longs-west)%360 <= (east-west)%360
+    return np.flatnonzero(np.outer(in_lat,in_lon))
+
+def select_sites(lats,longs,sites_file=None,bbox=None):
+    """
+    Site selection for a grid from a sites file and/or a bounding box (the
+    cells in both if both are given).
+
+    Args:
+        lats (array): latitudes of the grid
+        longs (array): longitudes of the grid
+        sites_file (str): file for sites_from_file
+        bbox (tuple): bounds for sites_in_bbox
+
+    Returns:
+        SiteSelection: the selection, or None if neither is given
+    """
+    grid_shape = (len(lats),len(longs))
+    sites = None
+    if sites_file is not None:
+        sites = sites_from_file(sites_file,grid_shape)
+    if bbox is not None:
+        in_bbox = sites_in_bbox(lats,longs,bbox)
+        sites = in_bbox if sites is None else np.intersect1d(sites,in_bbox)
+    if sites is None:
+        return None
+    selection = SiteSelection(sites,grid_shape)
+    logger.info('Computing {} of {} sites ({:.1f} %).'.format(len(selection),
+        grid_shape[0]*grid_shape[1],100.*len(selection)/(grid_shape[0]*grid_shape[1])))
+    return selection
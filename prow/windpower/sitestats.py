@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+class SiteStats(object):
+    """
+    Per-site summary statistics of (time,lat,lon) data, accumulated one time
+    slab at a time. Means and variances are merged with Chan's parallel
+    algorithm so that slabs (or files) can be combined in any order.
+    """
+    def __init__(self,shape):
+        """
+        Args:
+            shape (tuple): shape of one time step (lat,lon)
+        """
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape,np.inf)
+        self.max = np.full(shape,-np.inf)
+        self.zero_count = np.zeros(shape,dtype=np.int64)
+
+    @property
+    def var(self):
+        """Population variance per site."""
+        return self.m2/max(self.count,1)
+
+    @property
+    def total(self):
+        """Sum over time per site (full-load hours for hourly output)."""
+        return self.mean*self.count
+
+    def update(self,data):
+        """
+        Add a time slab of data.
+
+        Args:
+            data (numpy.ndarray): time slab with shape (time,lat,lon)
+        """
+        if data.shape[0] == 0:
+            return
+        slab = SiteStats(data.shape[1:])
+        slab.count = data.shape[0]
+        slab.mean = data.mean(axis=0,dtype=np.float64)
+        slab.m2 = data.var(axis=0,dtype=np.float64)*slab.count
+        slab.min = data.min(axis=0).astype(np.float64)
+        slab.max = data.max(axis=0).astype(np.float64)
+        slab.zero_count = (data==0).sum(axis=0)
+        self.merge(slab)
+
+    def merge(self,other):
+        """
+        Merge statistics of another slab or file into these.
+
+        Args:
+            other (SiteStats): statistics to merge
+        """
+        if other.count == 0:
+            return
+        if other.mean.shape != self.mean.shape:
+            raise ValueError('Cannot merge statistics for {} and {} grids.'.format(
+                other.mean.shape,self.mean.shape))
+        count = self.count+other.count
+        delta = other.mean-self.mean
+        self.mean += delta*(float(other.count)/count)
+        self.m2 += other.m2+np.square(delta)*(float(self.count)*other.count/count)
+        self.count = count
+        np.minimum(self.min,other.min,out=self.min)
+        np.maximum(self.max,other.max,out=self.max)
+        self.zero_count += other.zero_count
+
+    def write(self,group,fingerprint=None):
+        """
+        Write statistics to an hdf5 group.
+
+        Args:
+            group (h5py.Group): group to write to
+            fingerprint (str): fingerprint of the data the statistics describe
+        """
+        for key,values in [('mean',self.mean),('var',self.var),('min',self.min),
+                           ('max',self.max),('zero_count',self.zero_count)]:
+            group[key] = values
+        group.attrs['count'] = self.count
+        if fingerprint is not None:
+            group.attrs['fingerprint'] = fingerprint
+
+    @classmethod
+    def read(cls,group):
+        """
+        Read statistics written by write.
+
+        Args:
+            group (h5py.Group): group to read from
+
+        Returns:
+            SiteStats: the statistics
+        """
+        stats = cls(group['mean'].shape)
+        stats.count = int(group.attrs['count'])
+        stats.mean = group['mean'][:]
+        stats.m2 = group['var'][:]*stats.count
+        stats.min = group['min'][:]
+        stats.max = group['max'][:]
+        stats.zero_count = group['zero_count'][:]
+        return stats
+
+class SiteHistogram(object):
+    """
+    Per-site histogram of (time,lat,lon) wind speeds with bins between fixed 
+    edges and an overflow bin above the last edge, keeping both the count and 
+    the sum of wind speeds in each bin. For a power curve that is linear 
+    between the edges (such as the TradeWind curves with edges at their wind 
+    speeds), the mean output then follows exactly, see mean_output.
+
+    Values below the first edge and NaN are not counted, like a power curve 
+    giving zero output for them.
+    """
+    def __init__(self,shape,edges):
+        """
+        Args:
+            shape (tuple): shape of one time step (lat,lon)
+            edges (list): increasing bin edges
+        """
+        self.shape = tuple(shape)
+        self.edges = np.asarray(edges,dtype=float)
+        if self.edges.ndim != 1 or len(self.edges) < 2 or np.any(np.diff(self.edges)<=0):
+            raise ValueError('Need at least two increasing bin edges.')
+        self.count = 0
+        self.counts = np.zeros((len(self.edges),)+self.shape,dtype=np.int64)
+        self.sums = np.zeros((len(self.edges),)+self.shape)
+
+    def update(self,data,block_size=2**22):
+        """
+        Add a time slab of data.
+
+        Args:
+            data (numpy.ndarray): time slab with shape (time,lat,lon)
+            block_size (int): approximate number of values binned at a time
+        """
+        num_bins = len(self.edges)
+        num_cells = int(np.prod(self.shape))
+        flat = np.asarray(data).reshape(data.shape[0],num_cells)
+        counts = self.counts.reshape(num_bins*num_cells)
+        sums = self.sums.reshape(num_bins*num_cells)
+        cells = np.arange(num_cells)
+        step = max(block_size//max(num_cells,1),1)
+        for start in xrange(0,flat.shape[0],step):
+            block = flat[start:start+step]
+            # Last regular bin is closed, values above last edge overflow
+            bins = np.searchsorted(self.edges[1:-1],block,'right')
+            bins[block>self.edges[-1]] = num_bins-1
+            valid = block>=self.edges[0]
+            idx = (bins*num_cells+cells)[valid]
+            counts += np.bincount(idx,minlength=num_bins*num_cells)
+            sums += np.bincount(idx,weights=block[valid],minlength=num_bins*num_cells)
+        self.count += flat.shape[0]
+
+    def merge(self,other):
+        """
+        Merge histogram of another slab or file into this.
+
+        Args:
+            other (SiteHistogram): histogram to merge
+        """
+        if other.shape != self.shape or not np.array_equal(other.edges,self.edges):
+            raise ValueError('Cannot merge histograms with different grids or bins.')
+        self.count += other.count
+        self.counts += other.counts
+        self.sums += other.sums
+
+    def mean_output(self,powercurve):
+        """
+        Mean output per site for a power curve, exact if the curve is linear 
+        between the bin edges. The overflow bin is evaluated at its mean wind 
+        speed.
+
+        Args:
+            powercurve (function): function to transform wind speed to output
+
+        Returns:
+            numpy.ndarray: mean output per site (lat,lon)
+        """
+        num_regular = len(self.edges)-1
+        values = np.asarray(powercurve(self.edges.copy()),dtype=float)
+        slopes = np.diff(values)/np.diff(self.edges)
+        intercepts = values[:-1]-slopes*self.edges[:-1]
+        total = np.tensordot(intercepts,self.counts[:num_regular],axes=1)
+        total += np.tensordot(slopes,self.sums[:num_regular],axes=1)
+
+        over_counts = self.counts[num_regular]
+        over = over_counts>0
+        if over.any():
+            over_mean = self.sums[num_regular][over]/over_counts[over]
+            total[over] += over_counts[over]*np.asarray(powercurve(over_mean),dtype=float)
+        return total/max(self.count,1)
+
+    def quantiles(self,levels):
+        """
+        Approximate quantiles per site, interpolating linearly within bins, so
+        the error is at most the width of a bin. Quantiles in the overflow
+        bin are given as its mean. Only counted values are included (see the
+        class description).
+
+        Args:
+            levels (list): quantile levels between 0 and 1
+
+        Returns:
+            numpy.ndarray: quantiles per level and site (level,lat,lon), NaN
+                for sites without values
+        """
+        num_regular = len(self.edges)-1
+        counts = self.counts.reshape(len(self.edges),-1)
+        cumulative = np.cumsum(counts,axis=0)
+        total = cumulative[-1]
+        cells = np.arange(counts.shape[1])
+        with np.errstate(divide='ignore',invalid='ignore'):
+            over_mean = self.sums.reshape(counts.shape)[num_regular]/counts[num_regular]
+
+        result = np.full((len(levels),counts.shape[1]),np.nan)
+        for k,level in enumerate(levels):
+            target = level*total
+            # First bin where the cumulative count reaches the target
+            bins = np.minimum((cumulative<target).sum(axis=0),num_regular)
+            below = np.where(bins>0,cumulative[np.maximum(bins-1,0),cells],0)
+            in_bin = counts[bins,cells]
+            with np.errstate(divide='ignore',invalid='ignore'):
+                fraction = np.clip((target-below)/in_bin,0,1)
+            regular = bins<num_regular
+            lo = self.edges[np.minimum(bins,num_regular-1)]
+            width = np.diff(self.edges)[np.minimum(bins,num_regular-1)]
+            result[k] = np.where(regular,lo+np.nan_to_num(fraction)*width,over_mean)
+            result[k,total==0] = np.nan
+        return result.reshape((len(levels),)+self.shape)
+
+    def write(self,group,fingerprint=None):
+        """
+        Write histogram to an hdf5 group.
+
+        Args:
+            group (h5py.Group): group to write to
+            fingerprint (str): fingerprint of the data the histogram describes
+        """
+        group.create_dataset('counts',data=self.counts.astype(np.int32),
+                             shuffle=True,compression='gzip',compression_opts=4)
+        group.create_dataset('sums',data=self.sums,
+                             shuffle=True,compression='gzip',compression_opts=4)
+        group.attrs['edges'] = self.edges
+        group.attrs['count'] = self.count
+        if fingerprint is not None:
+            group.attrs['fingerprint'] = fingerprint
+
+    @classmethod
+    def read(cls,group):
+        """
+        Read histogram written by write.
+
+        Args:
+            group (h5py.Group): group to read from
+
+        Returns:
+            SiteHistogram: the histogram
+        """
+        hist = cls(group['counts'].shape[1:],group.attrs['edges'])
+        hist.count = int(group.attrs['count'])
+        hist.counts = group['counts'][:].astype(np.int64)
+        hist.sums = group['sums'][:]
+        return hist
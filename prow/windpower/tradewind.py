@@ -2,6 +2,7 @@
 from scipy.interpolate import interp1d
 import numpy as np
 import logging
+from powercurve import LookupPowerCurve
 
 logger = logging.getLogger(__name__)
 logger.debug('Entering TradeWind module.')
@@ -15,22 +16,34 @@ output_percent = {
     'lowland': [0, 0, 1, 2, 4, 8, 14, 22, 33, 48, 62, 75, 85, 92, 94, 94, 94, 94, 94, 94, 94, 94, 94, 94, 90, 83, 72, 56, 38, 23, 11, 4, 0, 0, 0, 0],
     'upland': [0, 1, 2, 5, 8, 13, 20, 29, 39, 49, 59, 68, 77, 84, 89, 93, 94, 94, 94, 94, 94, 94, 92, 88, 82, 73, 63, 52, 42, 31, 21, 13, 6, 2, 0, 0]
 }
-# Create interpolating functions
+# Create interpolating functions (kept for reference and benchmarking)
 interp_args = {'kind': 'linear','bounds_error': False, 'fill_value': 0}
 output_fcn = {key: interp1d(windspeeds,np.array(output_vals)/100.0,**interp_args) for key,output_vals in output_percent.iteritems()}
+# Lookup table power curves, used by power()
+lookup_fcn = {key: LookupPowerCurve(windspeeds,np.array(output_vals)/100.0,name=key) for key,output_vals in output_percent.iteritems()}
 
-def power(ws,key):
-    logger.debug("Getting and applying TradeWind power curve with key '{}'.".format(key))
-    return output_fcn[key](ws)
+def power(ws,key,out=None):
+    """
+    Apply TradeWind power curve to wind speeds.
 
-def lowland_future(ws):
+    Args:
+        ws (array): wind speeds
+        key (str): power curve key in output_percent
+        out (array): optional output array (may be ws to evaluate in place)
+
+    Returns:
+        numpy.ndarray: normalised output
+    """
+    return lookup_fcn[key](ws,out=out)
+
+def lowland_future(ws,out=None):
     """Regional power curve function for future lowland wind power."""
-    return power(ws,'lowland')
+    return power(ws,'lowland',out=out)
 
-def upland_future(ws):
+def upland_future(ws,out=None):
     """Regional power curve function for future upland wind power."""
-    return power(ws,'upland')
+    return power(ws,'upland',out=out)
 
-def offshore_future(ws):
+def offshore_future(ws,out=None):
     """Regional power curve function for future offshore wind power."""
-    return power(ws,'offshore')
+    return power(ws,'offshore',out=out)
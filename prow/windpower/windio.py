@@ -1,6 +1,12 @@
 import h5py
 import numpy as np
 import logging
+import hashlib
+import os
+import re
+import itertools
+from sitestats import SiteStats,SiteHistogram
+from sites import to_grid
 
 logger = logging.getLogger(__name__)
 
@@ -13,14 +19,14 @@ def write_classes_to_file(outfile_path,class_areas,class_utils,site_fractions):
         class_areas (pandas.DataFrame): areas in each class for each region
         class_utils (pandas.DataFrame): utilization factor for each class in 
             each region
-        site_fractions (pandas.Panel): fraction of each site's contribution to
-            each class in each region
+        site_fractions (classes.SiteFractions): sparse fraction of each site's 
+            contribution to each class in each region
     """
     with h5py.File(outfile_path,'w') as outfile:
         logger.debug('Saving indices.')
         outfile['regions'] = np.array(class_areas.index,dtype=str)
         outfile['classes'] = np.array(class_areas.columns,dtype=float)
-        outfile['sites'] = np.array(site_fractions.major_axis,dtype=int)
+        outfile['sites'] = np.array(site_fractions.sites,dtype=int)
 
         logger.debug('Saving data.')
         util_ds = outfile.create_dataset('utilization',dtype=float,
@@ -37,13 +43,45 @@ def write_classes_to_file(outfile_path,class_areas,class_utils,site_fractions):
         area_ds.attrs['dim1'] = 'regions'
         area_ds.attrs['dim2'] = 'classes'
 
-        site_fraction_ds = outfile.create_dataset('site_fractions',dtype=float,
-            shape=site_fractions.shape,fillvalue=float('nan'),compression='gzip',
-            compression_opts=9)
-        site_fraction_ds[:] = site_fractions
-        site_fraction_ds.attrs['dim1'] = 'regions'
-        site_fraction_ds.attrs['dim2'] = 'sites'
-        site_fraction_ds.attrs['dim3'] = 'classes'
+        # Site fractions in coordinate format, indices refer to sites, regions 
+        # and classes datasets
+        num_classes = len(site_fractions.classes)
+        entries = site_fractions.matrix.tocoo()
+        fraction_grp = outfile.create_group('site_fractions')
+        for key,values in [('site',entries.row),
+                           ('region',entries.col//num_classes),
+                           ('class',entries.col%num_classes),
+                           ('fraction',entries.data)]:
+            fraction_grp.create_dataset(key,data=values,compression='gzip',
+                                        compression_opts=9)
+        fraction_grp.attrs['shape'] = (len(site_fractions.sites),
+                                       len(site_fractions.regions),num_classes)
+        fraction_grp.attrs['dim1'] = 'sites'
+        fraction_grp.attrs['dim2'] = 'regions'
+        fraction_grp.attrs['dim3'] = 'classes'
+
+
+def read_site_fractions(source):
+    """
+    Read sparse site fractions written by write_classes_to_file.
+
+    Args:
+        source (str): path to wind classes hdf5 file
+
+    Returns:
+        classes.SiteFractions: sparse site fractions
+    """
+    import scipy.sparse as sp
+    from classes import SiteFractions
+
+    with h5py.File(source,'r') as f:
+        grp = f['site_fractions']
+        num_sites,num_regions,num_classes = grp.attrs['shape']
+        matrix = sp.csr_matrix((grp['fraction'][:],
+                                (grp['site'][:],grp['region'][:]*num_classes+grp['class'][:])),
+                               shape=(num_sites,num_regions*num_classes))
+        return SiteFractions(matrix,f['sites'][:],list(f['regions'][:]),
+                             list(f['classes'][:]))
 
 
 def write_areas_to_file(outfile_path,site_areas,site_fractions):
@@ -82,27 +120,1279 @@ def write_areas_to_file(outfile_path,site_areas,site_fractions):
         fractions_ds.attrs['dim2'] = 'regions'
 
 
-def get_flat_mean_output(source,key):
+def read_area_fractions(source,block_rows=2**14):
+    """
+    Read site fractions written by write_areas_to_file as a sparse matrix, 
+    converting the dense dataset a block of sites at a time.
+
+    Args:
+        source (str): path to areas hdf5 file
+        block_rows (int): number of sites to convert at a time
+
+    Returns:
+        classes.SiteFractions: sparse site fractions with classes set to None
+    """
+    import scipy.sparse as sp
+    from classes import SiteFractions
+
+    with h5py.File(source,'r') as f:
+        ds = f['fractions']
+        blocks = []
+        for start in xrange(0,ds.shape[0],block_rows):
+            block = ds[start:start+block_rows]
+            block[np.isnan(block)] = 0
+            blocks.append(sp.csr_matrix(block))
+        matrix = sp.vstack(blocks,format='csr') if blocks else sp.csr_matrix(ds.shape)
+        return SiteFractions(matrix,f['sites'][:],list(f['regions'][:]),None)
+
+
+# Storage data types for wind production output. Scaled int16 datasets store 
+# round((x-add_offset)/scale_factor) with NaN as missing_value, values outside 
+# the int16 range are clipped (wind speed to 327 m/s).
+OUTPUT_DTYPES = ['float64','float32','float16','int16']
+INT16_SCALING = {
+    'wp_output': (1e-4,0.),
+    'ws': (1e-2,0.)
+}
+INT16_MISSING = np.iinfo(np.int16).min
+# Chunk layouts for wind production output, optimised for reading whole time 
+# steps ('time') or long series of few sites ('site')
+OUTPUT_LAYOUTS = ['contiguous','time','site']
+OUTPUT_COMPRESSION = ['none','lzf','gzip']
+# Approximate size of blocks read at a time when reducing over time
+BLOCK_BYTES = 2**26
+# Group for cached per-site statistics of output datasets
+STATS_GROUP = 'stats'
+# Group for per-site wind speed histograms
+HISTOGRAM_GROUP = 'histogram'
+# Index of sites (flattened grid cells) in files with the compact (time,sites) 
+# layout written for site masks
+SITES_KEY = 'sites'
+
+def chunk_shape(shape,itemsize,layout,target_bytes=2**20):
+    """
+    Chunk shape of a (time,lat,lon) or (time,sites) dataset for a given 
+    layout.
+
+    Args:
+        shape (tuple): shape of dataset
+        itemsize (int): bytes per element
+        layout (str): one of OUTPUT_LAYOUTS
+        target_bytes (int): approximate size of a chunk
+
+    Returns:
+        tuple: chunk shape (None for contiguous storage)
+    """
+    target = max(target_bytes//itemsize,1)
+    if layout == 'contiguous':
+        return None
+    if len(shape) == 2:
+        num_t,num_sites = shape
+        if layout == 'time':
+            return (min(max(target//num_sites,1),num_t),min(num_sites,target))
+        elif layout == 'site':
+            return (min(num_t,target),min(max(target//max(num_t,1),1),num_sites))
+        raise ValueError("Unknown output layout '{}'.".format(layout))
+
+    num_t,num_lat,num_lon = shape
+    if layout == 'time':
+        if num_lat*num_lon <= target:
+            return (min(max(target//(num_lat*num_lon),1),num_t),num_lat,num_lon)
+        return (1,min(max(target//num_lon,1),num_lat),num_lon)
+    elif layout == 'site':
+        side = int(np.sqrt(max(target//max(num_t,1),1)))
+        return (num_t,min(side,num_lat),min(side,num_lon))
+    raise ValueError("Unknown output layout '{}'.".format(layout))
+
+def create_output_dataset(outfile,key,shape,dtype='float64',layout='contiguous',
+                          compression='none',compression_level=4,scaling=None):
+    """
+    Create a (time,lat,lon) or (time,sites) output dataset with the given 
+    storage settings.
+
+    Args:
+        outfile (h5py.File): open output file
+        key (str): dataset key
+        shape (tuple): shape of dataset
+        dtype (str): one of OUTPUT_DTYPES
+        layout (str): one of OUTPUT_LAYOUTS
+        compression (str): one of OUTPUT_COMPRESSION
+        compression_level (int): gzip compression level (0-9)
+        scaling (tuple): scale factor and offset if dtype is 'int16'
+
+    Returns:
+        h5py.Dataset: the created dataset
+    """
+    if dtype not in OUTPUT_DTYPES:
+        raise ValueError("Unknown output dtype '{}'.".format(dtype))
+    if compression not in OUTPUT_COMPRESSION:
+        raise ValueError("Unknown compression '{}'.".format(compression))
+
+    dtype = np.dtype(dtype)
+    kwargs = {'chunks': chunk_shape(shape,dtype.itemsize,layout)}
+    if compression != 'none':
+        if kwargs['chunks'] is None:
+            kwargs['chunks'] = chunk_shape(shape,dtype.itemsize,'time')
+        kwargs['shuffle'] = True
+        kwargs['compression'] = compression
+        if compression == 'gzip':
+            kwargs['compression_opts'] = compression_level
+    if dtype == np.int16:
+        kwargs['fillvalue'] = INT16_MISSING
+
+    logger.debug('Creating dataset {} as {} with {}.'.format(key,dtype.name,kwargs))
+    ds = outfile.create_dataset(key,shape=shape,dtype=dtype,**kwargs)
+    if dtype == np.int16:
+        scale_factor,add_offset = scaling
+        ds.attrs['scale_factor'] = scale_factor
+        ds.attrs['add_offset'] = add_offset
+        ds.attrs['missing_value'] = INT16_MISSING
+    return ds
+
+def create_production_datasets(outfile,lats,longs,time,ws_key,sites=None,
+                               time_units=None,**storage):
+    """
+    Write coordinates to a wind production file and create empty datasets for 
+    hub height wind speed and wind power output, to be filled in time slabs.
+
+    Args:
+        outfile (h5py.File): open output file
+        lats (numpy.ndarray): latitudes
+        longs (numpy.ndarray): longitudes
+        time (numpy.ndarray): time steps
+        ws_key (str): key for hub height wind speed dataset (e.g. 'ws_100m')
+        sites (numpy.ndarray): flattened grid indices of computed sites, for 
+            compact (time,sites) datasets with a sites index (the whole grid 
+            if None)
+        time_units (str): units of time steps, see decode_time
+        storage: dtype, layout, compression and compression_level as in 
+            create_output_dataset
+
+    Returns:
+        tuple: wind speed and wind power output datasets
+    """
+    outfile['longitude'] = longs
+    outfile['latitude'] = lats
+    outfile['time'] = time
+    if time_units is not None:
+        outfile['time'].attrs['units'] = time_units
+
+    if sites is None:
+        shape = (len(time),len(lats),len(longs))
+        logger.debug('Creating {} by {} by {} output datasets.'.format(*shape))
+    else:
+        outfile[SITES_KEY] = np.asarray(sites,dtype=np.int64)
+        outfile[SITES_KEY].attrs['grid_shape'] = (len(lats),len(longs))
+        shape = (len(time),len(sites))
+        logger.debug('Creating {} by {} output datasets for sites.'.format(*shape))
+    ws_ds = create_output_dataset(outfile,ws_key,shape,
+                                  scaling=INT16_SCALING['ws'],**storage)
+    wp_ds = create_output_dataset(outfile,'wp_output',shape,
+                                  scaling=INT16_SCALING['wp_output'],**storage)
+    if sites is not None:
+        for ds in [ws_ds,wp_ds]:
+            ds.attrs['dim1'] = 'time'
+            ds.attrs['dim2'] = SITES_KEY
+    return ws_ds,wp_ds
+
+
+def read_sites(f,key='wp_output'):
+    """
+    Sites of a wind production file with the compact (time,sites) layout.
+
+    Args:
+        f (h5py.File): open wind production file
+        key (str): key of a production dataset
+
+    Returns:
+        numpy.ndarray: flattened grid indices of sites, or None if the file 
+            covers the whole grid
+    """
+    if SITES_KEY in f and f[key].ndim == 2:
+        return f[SITES_KEY][:]
+    return None
+
+
+def grid_shape(f):
+    """Shape (lat,lon) of the grid of a wind production file."""
+    return (len(f['latitude']),len(f['longitude']))
+
+
+def encode(ds,data):
+    """
+    Convert data to the storage type of a dataset, as scaled integers if the 
+    dataset has a scale factor.
+
+    Args:
+        ds (h5py.Dataset): dataset the data is for
+        data (numpy.ndarray): data to convert
+
+    Returns:
+        numpy.ndarray: data as stored
+    """
+    if 'scale_factor' in ds.attrs:
+        info = np.iinfo(ds.dtype)
+        scaled = np.subtract(data,ds.attrs['add_offset'],dtype=float)
+        scaled /= ds.attrs['scale_factor']
+        missing = np.isnan(scaled)
+        np.clip(scaled,info.min+1,info.max,out=scaled)
+        np.rint(scaled,out=scaled)
+        data = scaled.astype(ds.dtype)
+        data[missing] = ds.attrs['missing_value']
+    elif data.dtype != ds.dtype:
+        # Convert in numpy, HDF5 conversion to float16 is slow and inexact
+        data = data.astype(ds.dtype)
+    return data
+
+
+def decode(ds,data):
+    """
+    Convert stored data of a dataset to values, decoding scaled integers (to 
+    float32 with NaN for missing values) and half precision floats (to 
+    float32).
+
+    Args:
+        ds (h5py.Dataset): dataset the data is from
+        data (numpy.ndarray): data as stored
+
+    Returns:
+        numpy.ndarray: decoded data
+    """
+    if 'scale_factor' in ds.attrs:
+        decoded = data.astype(np.float32)
+        decoded *= ds.attrs['scale_factor']
+        decoded += ds.attrs['add_offset']
+        decoded[data==ds.attrs['missing_value']] = np.nan
+        return decoded
+    elif data.dtype == np.float16:
+        return data.astype(np.float32)
+    return data
+
+
+def write_dataset(ds,sl,data):
+    """
+    Write (part of) a dataset, encoding to scaled integers if needed.
+
+    Args:
+        ds (h5py.Dataset): dataset to write to
+        sl: index/slice to write
+        data (numpy.ndarray): data to write
+
+    Returns:
+        numpy.ndarray: data as stored
+    """
+    data = encode(ds,data)
+    ds[sl] = data
+    return data
+
+
+def read_dataset(ds,sl=Ellipsis):
+    """
+    Read (part of) a dataset, decoding scaled integers (to float32 with NaN 
+    for missing values) and half precision floats (to float32).
+
+    Args:
+        ds (h5py.Dataset): dataset to read from
+        sl: index/slice to read
+
+    Returns:
+        numpy.ndarray: decoded data
+    """
+    return decode(ds,ds[sl])
+
+
+# Seconds per unit of CF-style time units ('hours since 1980-01-01 00:30:00')
+TIME_UNIT_SECONDS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400
+}
+# Units of time steps stored by encode_time
+EPOCH_UNITS = 'seconds since 1970-01-01 00:00:00'
+
+def decode_time(values,units=None):
+    """
+    Decode time steps to datetime64 (in seconds) all at once. Numeric time 
+    steps need CF-style units ('<unit> since <date> [<time>]', with unit one 
+    of seconds, minutes, hours or days). Date strings ('2001-01-01 00:30') 
+    and datetime64 values are converted as they are.
+
+    Args:
+        values (array): time steps
+        units (str): units of numeric time steps
+
+    Returns:
+        numpy.ndarray: datetime64[s] array
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[s]')
+    if values.dtype.kind in 'SU':
+        return np.char.replace(np.char.strip(values),' ','T').astype('datetime64[s]')
+    if units is None:
+        raise ValueError('Need units to decode numeric time steps.')
+
+    match = re.match(r'\s*(\w+?)s?\s+since\s+(\d+)-(\d+)-(\d+)'
+                     r'(?:[ T](\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?',units)
+    if match is None or match.group(1).lower() not in TIME_UNIT_SECONDS:
+        raise ValueError("Unknown time units '{}'.".format(units))
+    year,month,day,hour,minute = [int(g or 0) for g in match.groups()[1:6]]
+    second = float(match.group(7) or 0)
+    base = np.datetime64('{:04d}-{:02d}-{:02d}T{:02d}:{:02d}'.format(
+        year,month,day,hour,minute),'s')+np.timedelta64(int(round(second)),'s')
+    seconds = np.rint(values.astype(np.float64)*TIME_UNIT_SECONDS[match.group(1).lower()])
+    return base+seconds.astype(np.int64).astype('timedelta64[s]')
+
+
+def encode_time(times):
+    """
+    Encode datetime64 time steps as integer seconds since 1970.
+
+    Args:
+        times (array): datetime64 time steps
+
+    Returns:
+        tuple: encoded time steps and their units (EPOCH_UNITS)
+    """
+    return np.asarray(times).astype('datetime64[s]').astype(np.int64),EPOCH_UNITS
+
+
+def read_time(f,units=None):
+    """
+    Read and decode the time steps of a file, with the units of its time 
+    dataset if units is None.
+
+    Args:
+        f (h5py.File): open file
+        units (str): units of numeric time steps, overriding the file
+
+    Returns:
+        numpy.ndarray: datetime64[s] array
+    """
+    return decode_time(f['time'][:],units or f['time'].attrs.get('units'))
+
+
+def concat_time(files):
+    """
+    Concatenate the time steps of several files, e.g. one per year. If their 
+    units differ (such as hours since the start of each year), the time 
+    steps are decoded and stored with encode_time.
+
+    Args:
+        files (list): open files
+
+    Returns:
+        tuple: time steps and their units (None if unknown)
+    """
+    units = set(f['time'].attrs.get('units') for f in files)
+    if len(units) == 1:
+        return np.concatenate([f['time'][:] for f in files]),units.pop()
+    return encode_time(np.concatenate([read_time(f) for f in files]))
+
+
+def dataset_fingerprint(ds,samples=64):
+    """
+    Fingerprint of a (time,lat,lon) dataset from its shape, storage type and 
+    attributes, and the contents of up to samples chunks (or time steps if 
+    not chunked) evenly spread over the whole dataset, including the first 
+    and last. Cheap to compute, so it can be checked on every read. Time 
+    slabs rewritten anywhere in the series change it as long as there are 
+    no more chunks along time than samples; beyond that, it is a sample. 
+    Virtual datasets (see stitch_production) are fingerprinted by their 
+    source datasets.
+
+    Args:
+        ds (h5py.Dataset): dataset to fingerprint
+        samples (int): maximum number of chunks or time steps to hash
+
+    Returns:
+        str: hex digest
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update(repr((ds.shape,ds.dtype.str,ds.chunks,
+        sorted((k,repr(v)) for k,v in ds.attrs.items()))))
+    if getattr(ds,'is_virtual',False):
+        for vmap in ds.virtual_sources():
+            with h5py.File(_source_path(ds.file.filename,vmap.file_name),'r') as f:
+                fingerprint.update(dataset_fingerprint(f[vmap.dset_name]))
+        return fingerprint.hexdigest()
+    if ds.size:
+        chunks = ds.chunks or (1,)+ds.shape[1:]
+        grid = tuple(-(-n//c) for n,c in zip(ds.shape,chunks))
+        num_chunks = int(np.prod(grid))
+        for i in np.unique(np.linspace(0,num_chunks-1,min(samples,num_chunks)).astype(np.int64)):
+            start = [j*c for j,c in zip(np.unravel_index(i,grid),chunks)]
+            probe = tuple(slice(a,min(a+c,n)) for a,c,n in zip(start,chunks,ds.shape))
+            fingerprint.update(np.ascontiguousarray(ds[probe]).tobytes())
+    return fingerprint.hexdigest()
+
+
+def write_site_stats(f,key,stats):
+    """
+    Cache per-site statistics of a dataset in the same file, together with a 
+    fingerprint of the dataset.
+
+    Args:
+        f (h5py.File): open file containing dataset key
+        key (str): key of dataset the statistics describe
+        stats (sitestats.SiteStats): the statistics
+    """
+    name = '{}/{}'.format(STATS_GROUP,key)
+    if name in f:
+        del f[name]
+    group = f.create_group(name)
+    stats.write(group,dataset_fingerprint(f[key]))
+    if key == 'wp_output':
+        # Sum of normalised hourly output
+        group['full_load_hours'] = stats.total
+
+
+def read_site_stats(f,key):
+    """
+    Read cached per-site statistics of a dataset, if present and up to date.
+
+    Args:
+        f (h5py.File): open file containing dataset key
+        key (str): key of dataset
+
+    Returns:
+        sitestats.SiteStats: the statistics, or None if missing or stale
+    """
+    name = '{}/{}'.format(STATS_GROUP,key)
+    if name not in f:
+        return None
+    group = f[name]
+    if group.attrs.get('fingerprint') != dataset_fingerprint(f[key]):
+        logger.warning('Cached statistics for {} in {} are stale, ignoring.'.format(
+            key,f.filename))
+        return None
+    logger.debug('Using cached statistics for {} in {}.'.format(key,f.filename))
+    return SiteStats.read(group)
+
+
+class ProductionWriter(object):
+    """
+    Writes wind production data to an hdf5 file one time slab at a time, 
+    accumulating per-site statistics. Use as a context manager; statistics 
+    are only saved if the block completes without error.
+    """
+    def __init__(self,outfile_path,lats,longs,time,ws_key,stats=True,
+                 histogram_edges=None,attrs=None,sites=None,time_units=None,
+                 **storage):
+        """
+        Args:
+            outfile_path (str): path to hdf5 output file
+            lats (numpy.ndarray): latitudes
+            longs (numpy.ndarray): longitudes
+            time (numpy.ndarray): time steps
+            ws_key (str): key for hub height wind speed dataset (e.g. 'ws_100m')
+            stats (bool): accumulate per-site statistics while writing and 
+                cache them in the file
+            histogram_edges (list): bin edges for a per-site histogram of hub 
+                height wind speed (no histogram if None)
+            attrs (dict): attributes of the file, set when complete
+            sites (numpy.ndarray): flattened grid indices of computed sites, 
+                see create_production_datasets (the whole grid if None)
+            time_units (str): units of time steps, see decode_time
+            storage: dtype, layout, compression and compression_level as in 
+                create_output_dataset
+        """
+        logger.debug('Trying to open h5 file {}.'.format(outfile_path))
+        self.ws_key = ws_key
+        self.stats = stats
+        self.attrs = attrs or {}
+        self.outfile = h5py.File(outfile_path,'w')
+        try:
+            self.ws_ds,self.wp_ds = create_production_datasets(self.outfile,lats,longs,
+                                                               time,ws_key,sites,
+                                                               time_units,**storage)
+        except:
+            self.outfile.close()
+            raise
+        self.ws_stats = SiteStats(self.ws_ds.shape[1:])
+        self.wp_stats = SiteStats(self.wp_ds.shape[1:])
+        self.ws_hist = None
+        if histogram_edges is not None:
+            self.ws_hist = SiteHistogram(self.ws_ds.shape[1:],histogram_edges)
+
+    def write(self,sl,ws_z,wp_output):
+        """
+        Write a time slab.
+
+        Args:
+            sl (slice): time slice of slab
+            ws_z (numpy.ndarray): hub height wind speed
+            wp_output (numpy.ndarray): wind power output
+        """
+        ws_stored = write_dataset(self.ws_ds,sl,ws_z)
+        wp_stored = write_dataset(self.wp_ds,sl,wp_output)
+        if self.stats:
+            # Statistics of values as stored, i.e. as readers will see them
+            self.ws_stats.update(decode(self.ws_ds,ws_stored))
+            self.wp_stats.update(decode(self.wp_ds,wp_stored))
+        if self.ws_hist is not None:
+            # Histogram of wind speeds as calculated, to reproduce the output
+            self.ws_hist.update(ws_z)
+
+    def close(self,complete=True):
+        """
+        Save statistics (if complete) and close the file.
+
+        Args:
+            complete (bool): all slabs were written
+        """
+        try:
+            if self.stats and complete:
+                logger.debug('Saving site statistics.')
+                write_site_stats(self.outfile,self.ws_key,self.ws_stats)
+                write_site_stats(self.outfile,'wp_output',self.wp_stats)
+            if self.ws_hist is not None and complete:
+                logger.debug('Saving wind speed histogram.')
+                write_site_histogram(self.outfile,self.ws_key,self.ws_hist)
+            if complete:
+                self.outfile.attrs.update(self.attrs)
+        finally:
+            self.outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,tb):
+        self.close(complete=exc_type is None)
+
+
+def write_site_histogram(f,key,hist):
+    """
+    Save a per-site histogram of a dataset in the same file, together with a 
+    fingerprint of the dataset.
+
+    Args:
+        f (h5py.File): open file containing dataset key
+        key (str): key of dataset the histogram describes
+        hist (sitestats.SiteHistogram): the histogram
+    """
+    name = '{}/{}'.format(HISTOGRAM_GROUP,key)
+    if name in f:
+        del f[name]
+    hist.write(f.create_group(name),dataset_fingerprint(f[key]))
+
+
+def read_site_histogram(f,key=None):
+    """
+    Read a per-site histogram of a dataset, if present and up to date.
+
+    Args:
+        f (h5py.File): open file containing dataset key
+        key (str): key of dataset (the only histogram in the file if None)
+
+    Returns:
+        sitestats.SiteHistogram: the histogram, or None if missing or stale
+    """
+    if HISTOGRAM_GROUP not in f:
+        return None
+    if key is None:
+        keys = list(f[HISTOGRAM_GROUP].keys())
+        if len(keys) != 1:
+            raise ValueError('Found histograms for {} in {}, need a key.'.format(
+                ', '.join(keys),f.filename))
+        key = keys[0]
+    name = '{}/{}'.format(HISTOGRAM_GROUP,key)
+    if name not in f:
+        return None
+    group = f[name]
+    if key in f and group.attrs.get('fingerprint') != dataset_fingerprint(f[key]):
+        logger.warning('Histogram for {} in {} is stale, ignoring.'.format(key,f.filename))
+        return None
+    return SiteHistogram.read(group)
+
+
+def write_production_file(outfile_path,lats,longs,time,ws_key,slabs,stats=True,
+                          **storage):
+    """
+    Write wind production data to hdf5 file, one time slab at a time.
+
+    Args:
+        outfile_path (str): path to hdf5 output file
+        lats (numpy.ndarray): latitudes
+        longs (numpy.ndarray): longitudes
+        time (numpy.ndarray): time steps
+        ws_key (str): key for hub height wind speed dataset (e.g. 'ws_100m')
+        slabs (iterable): (time slice, wind speed, wind power output) tuples
+        stats (bool): accumulate per-site statistics while writing and cache 
+            them in the file
+        storage: dtype, layout, compression and compression_level as in 
+            create_output_dataset
+    """
+    with ProductionWriter(outfile_path,lats,longs,time,ws_key,stats,**storage) as writer:
+        for sl,ws_z,wp_output in slabs:
+            writer.write(sl,ws_z,wp_output)
+
+
+def write_production_files(outputs,lats,longs,time,slabs,stats=True,
+                           histogram_edges=None,attrs=None,queue_depth=0,
+                           stage_timer=None,sites=None,time_units=None,**storage):
+    """
+    Write wind production data for several configurations to one hdf5 file 
+    each, one time slab at a time.
+
+    Args:
+        outputs (list): (output path, wind speed key) for each configuration
+        lats (numpy.ndarray): latitudes
+        longs (numpy.ndarray): longitudes
+        time (numpy.ndarray): time steps
+        slabs (iterable): (time slice, list of (wind speed, wind power output) 
+            in the order of outputs) tuples
+        stats (bool): accumulate and cache per-site statistics
+        histogram_edges (list): bin edges for per-site wind speed histograms 
+            (no histograms if None)
+        attrs (list): attributes of each file (dict), set when complete
+        queue_depth (int): write in a background process fed with up to this 
+            many slabs, see prefetch.BackgroundWriter (in the calling process 
+            if 0)
+        stage_timer (prefetch.StageTimer): timer for writing slabs
+        sites (numpy.ndarray): flattened grid indices of computed sites, see 
+            create_production_datasets (the whole grid if None)
+        time_units (str): units of time steps, see decode_time
+        storage: dtype, layout, compression and compression_level as in 
+            create_output_dataset
+    """
+    import prefetch
+
+    stage_timer = stage_timer or prefetch.StageTimer('write')
+    if queue_depth > 0:
+        # The files are only opened in the background process
+        background = prefetch.BackgroundWriter(_write_production_slabs,
+            (outputs,lats,longs,time),
+            dict(stats=stats,histogram_edges=histogram_edges,attrs=attrs,sites=sites,
+                 time_units=time_units,**storage),queue_depth,stage_timer)
+        try:
+            for slab in slabs:
+                background.put(slab)
+        except:
+            try:
+                background.close(wait=False)
+            except Exception:
+                # Keep the original error
+                logger.debug('Error in writer process after failure:', exc_info=True)
+            raise
+        background.close()
+        return
+
+    writers = []
+    complete = False
+    try:
+        for k,(outfile_path,ws_key) in enumerate(outputs):
+            writers.append(ProductionWriter(outfile_path,lats,longs,time,ws_key,
+                                            stats,histogram_edges,
+                                            attrs[k] if attrs else None,sites,
+                                            time_units,**storage))
+        for sl,results in slabs:
+            with stage_timer.busy():
+                for writer,(ws_z,wp_output) in zip(writers,results):
+                    writer.write(sl,ws_z,wp_output)
+        complete = True
+    finally:
+        for writer in writers:
+            writer.close(complete)
+
+
+def _write_production_slabs(slabs,outputs,lats,longs,time,**kwargs):
+    """Write slabs with write_production_files, in a background process."""
+    write_production_files(outputs,lats,longs,time,slabs,**kwargs)
+
+
+def iter_time_blocks(ds,block_bytes=BLOCK_BYTES):
+    """
+    Split a (time,lat,lon) or (time,sites) dataset into blocks of about 
+    block_bytes for reducing over time. Blocks follow the chunking of the 
+    dataset: time slabs of whole time steps, or rows of sites with the full 
+    time series if the dataset is chunked per site.
+
+    Args:
+        ds (h5py.Dataset): dataset to split
+        block_bytes (int): approximate size of a block in memory
+
+    Yields:
+        tuple: time slice and latitude (or sites) slice of each block
+    """
+    num_t,num_lat = ds.shape[:2]
+    num_lon = int(np.prod(ds.shape[2:]))
+    itemsize = max(ds.dtype.itemsize,4)
+    if ds.chunks is not None and ds.chunks[0] == num_t:
+        step = max(block_bytes//(num_t*num_lon*itemsize),1)
+        step = max(step//ds.chunks[1],1)*ds.chunks[1]
+        for start in xrange(0,num_lat,step):
+            yield slice(None),slice(start,min(start+step,num_lat))
+    else:
+        step = max(block_bytes//(num_lat*num_lon*itemsize),1)
+        if ds.chunks is not None:
+            step = max(step//ds.chunks[0],1)*ds.chunks[0]
+        for start in xrange(0,num_t,step):
+            yield slice(start,min(start+step,num_t)),slice(None)
+
+
+def _block_sums(f,key,block_bytes):
     """
-    Read and flatten mean wind power production from hdf5 file.
+    Sums over time of a dataset in blocks of sites, from cached statistics 
+    if present and up to date, otherwise by reading the data in blocks.
+
+    Yields:
+        tuple: latitude slice and sum over time for the block
+    """
+    cached = read_site_stats(f,key)
+    if cached is not None:
+        yield slice(None),cached.total
+        return
+
+    logger.debug('Reading {} from {} in blocks.'.format(key,f.filename))
+    ds = f[key]
+    for t_sl,lat_sl in iter_time_blocks(ds,block_bytes):
+        yield lat_sl,read_dataset(ds,(t_sl,lat_sl)).sum(axis=0,dtype=np.float64)
+
+
+def time_mean(sources,key,block_bytes=BLOCK_BYTES):
+    """
+    Mean over time of a (time,lat,lon) dataset in one or several files (e.g. 
+    one per year), read in blocks so that memory use does not depend on the 
+    length of the time series. Block sums are accumulated in float64 with 
+    Kahan compensation. Cached statistics are used instead of reading the 
+    data for files that have them. Files with the compact (time,sites) layout 
+    must all have the same sites.
+
+    Args:
+        sources (str/list): path(s) to source hdf5 file(s)
+        key (str): key to dataset to read
+        block_bytes (int): approximate size of a block in memory
+
+    Returns:
+        numpy.ndarray: lat by lon matrix with mean values (NaN outside the 
+            sites of files with the sites layout)
+    """
+    if isinstance(sources,basestring):
+        sources = [sources]
+
+    total = compensation = None
+    count = 0
+    for source in sources:
+        with h5py.File(source,'r') as f:
+            shape = f[key].shape
+            file_sites = read_sites(f,key)
+            if total is None:
+                total = np.zeros(shape[1:])
+                compensation = np.zeros(shape[1:])
+                sites,grid = file_sites,grid_shape(f)
+            elif total.shape != shape[1:]:
+                raise ValueError('Grid of {} in {} is {}, expected {}.'.format(
+                    key,source,shape[1:],total.shape))
+            elif sites is not None and not np.array_equal(sites,file_sites):
+                raise ValueError('Sites of {} in {} differ from {}.'.format(
+                    key,source,sources[0]))
+
+            for lat_sl,block_sum in _block_sums(f,key,block_bytes):
+                # Kahan summation of block sums
+                block_sum -= compensation[lat_sl]
+                new_total = total[lat_sl]+block_sum
+                compensation[lat_sl] = (new_total-total[lat_sl])-block_sum
+                total[lat_sl] = new_total
+            count += shape[0]
+
+    if total is None:
+        raise ValueError('No source files given.')
+    if sites is not None:
+        return to_grid(total/count,sites,grid)
+    return total/count
+
+
+def get_flat_mean_output(source,key,block_bytes=BLOCK_BYTES):
+    """
+    Read and flatten mean wind power production from hdf5 file(s).
 
     Args:
-        source (str): path to source hdf5 file
+        source (str/list): path(s) to source hdf5 file(s), the mean is taken 
+            over all time steps in all files
         key (str): key to dataset to read
+        block_bytes (int): approximate size of blocks read at a time
 
     Returns:
         numpy.ndarray: 1d vector with average site utilization
     """
-    with h5py.File(source,'r') as f:
-        site_matrix = np.mean(f[key],axis=0)
-        site_utilization = site_matrix.flatten()
-        logger.debug('Sites is a {} by {} matrix.'.format(*site_matrix.shape))
-
-        row = site_matrix[0,:]
-        flattened_start = site_utilization[:site_matrix.shape[1]]
-        del site_matrix
-        if not np.count_nonzero(flattened_start-row)==0:
-            logger.error('First elements of flattened not equal to matrix row.')
-            raise ValueError('Flattened:\n{}\nRow:\n{}'.format(
-                            flattened_start,row))
-    return site_utilization
\ No newline at end of file
+    site_matrix = time_mean(source,key,block_bytes)
+    site_utilization = site_matrix.flatten()
+    logger.debug('Sites is a {} by {} matrix.'.format(*site_matrix.shape))
+
+    row = site_matrix[0,:]
+    flattened_start = site_utilization[:site_matrix.shape[1]]
+    del site_matrix
+    if not np.count_nonzero(flattened_start-row)==0:
+        logger.error('First elements of flattened not equal to matrix row.')
+        raise ValueError('Flattened:\n{}\nRow:\n{}'.format(
+                        flattened_start,row))
+    return site_utilization
+
+
+def mean_output_from_histograms(sources,powercurves,key=None):
+    """
+    Mean output per site for several power curves from the wind speed 
+    histograms in wind production files, without reading hourly data.
+
+    Args:
+        sources (str/list): path(s) to wind production hdf5 file(s) with 
+            histograms, the mean is taken over all files
+        powercurves (dict): power curve functions by name
+        key (str): key of wind speed dataset (the only histogram if None)
+
+    Returns:
+        tuple: latitudes, longitudes and dict of mean output (lat,lon) by 
+            power curve name (NaN outside the sites of files with the sites 
+            layout)
+    """
+    if isinstance(sources,basestring):
+        sources = [sources]
+    hist = None
+    for source in sources:
+        with h5py.File(source,'r') as f:
+            file_hist = read_site_histogram(f,key)
+            if file_hist is None:
+                raise ValueError('No valid wind speed histogram in {}.'.format(source))
+            if hist is None:
+                lats,longs = f['latitude'][:],f['longitude'][:]
+                sites = read_sites(f)
+                hist = file_hist
+            else:
+                file_sites = read_sites(f)
+                if (sites is None) != (file_sites is None) or \
+                        (sites is not None and not np.array_equal(sites,file_sites)):
+                    raise ValueError('Sites of {} differ from {}.'.format(source,sources[0]))
+                hist.merge(file_hist)
+    if hist is None:
+        raise ValueError('No source files given.')
+    logger.debug('Histograms of {} time steps from {} files.'.format(hist.count,len(sources)))
+    means = {name: hist.mean_output(powercurve) for name,powercurve in powercurves.iteritems()}
+    if sites is not None:
+        means = {name: to_grid(mean,sites,(len(lats),len(longs)))
+                     for name,mean in means.iteritems()}
+    return lats,longs,means
+
+
+# Chunks of site-major stores written by transpose_production span this many 
+# time steps, for as many sites as fit in SERIES_CHUNK_BYTES
+SERIES_CHUNK_STEPS = 2**15
+SERIES_CHUNK_BYTES = 2**18
+
+def series_chunk_shape(num_sites,num_t,itemsize,chunk_steps=SERIES_CHUNK_STEPS,
+                       chunk_bytes=SERIES_CHUNK_BYTES):
+    """
+    Chunk shape of a site-major (sites,time) dataset, so that the series of 
+    one site is read from few chunks.
+
+    Args:
+        num_sites (int): number of sites
+        num_t (int): number of time steps
+        itemsize (int): bytes per element
+        chunk_steps (int): time steps per chunk
+        chunk_bytes (int): approximate size of a chunk
+
+    Returns:
+        tuple: chunk shape
+    """
+    steps = max(min(chunk_steps,num_t),1)
+    return (max(min(chunk_bytes//(steps*itemsize),num_sites),1),steps)
+
+
+def production_keys(f):
+    """Keys of wind power output and hub height wind speeds in a file."""
+    return ['wp_output']+sorted(k for k in f if k.startswith('ws_'))
+
+
+def common_sites(files,key):
+    """
+    Check that wind production files have the same grid and sites.
+
+    Args:
+        files (list): open wind production files
+        key (str): key of a production dataset
+
+    Returns:
+        numpy.ndarray: sites of files with the sites layout (None if the 
+            files cover the whole grid)
+    """
+    first = files[0]
+    sites = read_sites(first,key)
+    for f in files[1:]:
+        file_sites = read_sites(f,key)
+        if grid_shape(f) != grid_shape(first) or f[key].shape[1:] != first[key].shape[1:] or \
+                (sites is not None and not np.array_equal(file_sites,sites)):
+            raise ValueError('Grids differ between {} and {}.'.format(
+                f.filename,first.filename))
+    return sites
+
+
+def cell_blocks(shape,num_steps,itemsize,block_bytes):
+    """
+    Split the cells of a (time,lat,lon) or (time,sites) dataset into 
+    hyperslabs of about block_bytes for num_steps time steps.
+
+    Yields:
+        tuple: index of the block after the time axis, first and last+1 
+            flattened cell
+    """
+    cells = max(block_bytes//(num_steps*itemsize),1)
+    if len(shape) == 2:
+        for start in xrange(0,shape[1],cells):
+            stop = min(start+cells,shape[1])
+            yield (slice(start,stop),),start,stop
+        return
+
+    num_lat,num_lon = shape[1:]
+    if cells >= num_lon:
+        rows = cells//num_lon
+        for start in xrange(0,num_lat,rows):
+            stop = min(start+rows,num_lat)
+            yield (slice(start,stop),slice(None)),start*num_lon,stop*num_lon
+    else:
+        for row in xrange(num_lat):
+            for start in xrange(0,num_lon,cells):
+                stop = min(start+cells,num_lon)
+                yield (slice(row,row+1),slice(start,stop)),row*num_lon+start,row*num_lon+stop
+
+
+def chunk_aligned_blocks(shape,chunks,itemsize,block_bytes):
+    """
+    Split a dataset into hyperslabs of whole chunks of about block_bytes (at 
+    least one chunk), growing blocks along the last axes first, so that each 
+    chunk is read (and decompressed) once.
+
+    Args:
+        shape (tuple): shape of dataset
+        chunks (tuple): chunk shape of dataset
+        itemsize (int): bytes per element
+        block_bytes (int): approximate size of a block
+
+    Yields:
+        tuple: index of the block
+    """
+    counts = [1]*len(shape)
+    size = int(np.prod(chunks))*itemsize
+    for axis in reversed(range(len(shape))):
+        num_chunks = -(-shape[axis]//chunks[axis])
+        counts[axis] = int(max(min(num_chunks,block_bytes//size),1))
+        size *= counts[axis]
+        if counts[axis] < num_chunks:
+            break
+    steps = [c*n for c,n in zip(chunks,counts)]
+    for start in itertools.product(*[xrange(0,n,s) for n,s in zip(shape,steps)]):
+        yield tuple(slice(a,min(a+s,n)) for a,s,n in zip(start,steps,shape))
+
+
+def stage_sources(src,offsets,stage,block_bytes):
+    """
+    Copy (time,...) source datasets to an uncompressed (...,time) staging 
+    dataset, reading whole source chunks once each.
+    """
+    for ds,offset in zip(src,offsets):
+        for index in chunk_aligned_blocks(ds.shape,ds.chunks,ds.dtype.itemsize,block_bytes):
+            t_sl = index[0]
+            block = np.moveaxis(ds[index],0,-1)
+            stage[index[1:]+(slice(offset+t_sl.start,offset+t_sl.stop),)] = block
+        logger.debug('Staged {} of {}.'.format(ds.name,ds.file.filename))
+
+
+def transpose_production(sources,dest,keys=None,compression='none',
+                         compression_level=4,block_bytes=BLOCK_BYTES):
+    """
+    Build a site-major store of wind production datasets from time-major 
+    files (e.g. one per year), with the series of all files concatenated as 
+    (sites,time) datasets chunked for reading few sites at a time (see 
+    get_site_series). Values are copied as stored (including int16 scaling). 
+    Blocks of sites are transposed one chunk of time steps at a time, so that 
+    memory use is bounded by block_bytes and each chunk is written once.
+
+    Compressed sources are first copied to an uncompressed (lat,lon,time) 
+    staging file next to dest in blocks of whole chunks, since their chunks 
+    (e.g. of the 'time' layout) would otherwise be decompressed again for 
+    every block of sites. This needs temporary disk space for the 
+    uncompressed data of one key.
+
+    Args:
+        sources (list): wind production hdf5 files, concatenated in time
+        dest (str): path to output hdf5 file
+        keys (list): datasets to include (wp_output and hub height wind 
+            speeds if None)
+        compression (str): one of OUTPUT_COMPRESSION
+        compression_level (int): gzip compression level (0-9)
+        block_bytes (int): approximate size of blocks in memory
+    """
+    sources = sorted(sources)
+    if not sources:
+        raise ValueError('No source files given.')
+    if compression not in OUTPUT_COMPRESSION:
+        raise ValueError("Unknown compression '{}'.".format(compression))
+
+    files = [h5py.File(source,'r') for source in sources]
+    try:
+        first = files[0]
+        if keys is None:
+            keys = production_keys(first)
+        sites = common_sites(files,keys[0])
+        grid = grid_shape(first)
+        if sites is None:
+            sites = np.arange(grid[0]*grid[1])
+        offsets = np.cumsum([0]+[f[keys[0]].shape[0] for f in files])
+        num_t = int(offsets[-1])
+        logger.info('Transposing {} time steps for {} sites from {} files.'.format(
+            num_t,len(sites),len(files)))
+
+        with h5py.File(dest,'w') as outfile:
+            outfile['latitude'] = first['latitude'][:]
+            outfile['longitude'] = first['longitude'][:]
+            time,time_units = concat_time(files)
+            outfile['time'] = time
+            if time_units is not None:
+                outfile['time'].attrs['units'] = time_units
+            outfile[SITES_KEY] = np.asarray(sites,dtype=np.int64)
+            outfile[SITES_KEY].attrs['grid_shape'] = grid
+
+            for key in keys:
+                src = [f[key] for f in files]
+                dtype = src[0].dtype
+                attrs = dict(src[0].attrs)
+                if any(ds.dtype != dtype or ds.shape[1:] != src[0].shape[1:] for ds in src):
+                    raise ValueError('Storage of {} differs between source files.'.format(key))
+                chunks = series_chunk_shape(len(sites),num_t,dtype.itemsize)
+                kwargs = {}
+                if compression != 'none':
+                    kwargs['shuffle'] = True
+                    kwargs['compression'] = compression
+                    if compression == 'gzip':
+                        kwargs['compression_opts'] = compression_level
+                if 'missing_value' in attrs:
+                    kwargs['fillvalue'] = attrs['missing_value']
+                logger.debug('Creating {} as {} in chunks of {}.'.format(key,dtype.name,chunks))
+                out_ds = outfile.create_dataset(key,shape=(len(sites),num_t),dtype=dtype,
+                                                chunks=chunks,**kwargs)
+                for name in ['scale_factor','add_offset','missing_value']:
+                    if name in attrs:
+                        out_ds.attrs[name] = attrs[name]
+                out_ds.attrs['dim1'] = SITES_KEY
+                out_ds.attrs['dim2'] = 'time'
+
+                stage_file = None
+                if any(ds.compression is not None for ds in src):
+                    stage_path = '{}.{}.stage.tmp'.format(dest,os.getpid())
+                    logger.info('Staging compressed {} uncompressed in {}.'.format(key,stage_path))
+                    stage_file = h5py.File(stage_path,'w')
+                try:
+                    if stage_file is not None:
+                        stage = stage_file.create_dataset(key,shape=src[0].shape[1:]+(num_t,),
+                                                          dtype=dtype)
+                        stage_sources(src,offsets,stage,block_bytes)
+
+                    # Time blocks of whole chunks, cell blocks within memory bounds
+                    steps = chunks[1]
+                    for t_start in xrange(0,num_t,steps):
+                        t_stop = min(t_start+steps,num_t)
+                        for index,c_start,c_stop in cell_blocks(src[0].shape,t_stop-t_start,
+                                                                 dtype.itemsize,block_bytes):
+                            if stage_file is not None:
+                                block = stage[index+(slice(t_start,t_stop),)]
+                                out_ds[c_start:c_stop,t_start:t_stop] = block.reshape(c_stop-c_start,-1)
+                                continue
+                            block = np.empty((t_stop-t_start,c_stop-c_start),dtype=dtype)
+                            for ds,offset in zip(src,offsets):
+                                lo = max(t_start,offset)
+                                hi = min(t_stop,offset+ds.shape[0])
+                                if lo < hi:
+                                    block[lo-t_start:hi-t_start] = ds[(slice(lo-offset,hi-offset),)+index].reshape(hi-lo,-1)
+                            out_ds[c_start:c_stop,t_start:t_stop] = block.T
+                        logger.debug('Transposed {} up to time step {}.'.format(key,t_stop))
+                finally:
+                    if stage_file is not None:
+                        stage_file.close()
+                        os.remove(stage_path)
+    finally:
+        for f in files:
+            f.close()
+
+
+def _series_rows(f,sites):
+    """Rows of sites (flattened grid indices) in a site-major store."""
+    index = f[SITES_KEY][:]
+    sites = np.atleast_1d(np.asarray(sites,dtype=np.int64))
+    rows = np.searchsorted(index,sites)
+    missing = (rows==len(index)) | (index[np.minimum(rows,len(index)-1)]!=sites)
+    if missing.any():
+        raise ValueError('Sites {} not in {}.'.format(sites[missing].tolist(),f.filename))
+    return rows
+
+
+def _read_rows(ds,rows,t_sl):
+    """Read rows of a (sites,time) dataset, one hyperslab per run of rows."""
+    unique_rows,inverse = np.unique(rows,return_inverse=True)
+    runs = np.split(unique_rows,np.flatnonzero(np.diff(unique_rows)>1)+1)
+    data = np.concatenate([read_dataset(ds,(slice(run[0],run[-1]+1),t_sl)) for run in runs])
+    return data[inverse]
+
+
+def get_site_series(store,sites,start=None,end=None,key='wp_output'):
+    """
+    Time series of a few sites from a site-major store written by 
+    transpose_production, reading only the chunks holding them.
+
+    Args:
+        store (str): path to site-major hdf5 file
+        sites (int/list): flattened grid indices (lat*num_lon+lon) of sites
+        start (int): first time step (from the beginning if None)
+        end (int): last time step + 1 (to the end if None)
+        key (str): dataset to read
+
+    Returns:
+        tuple: time steps and (sites,time) array of values
+    """
+    t_sl = slice(start,end)
+    with h5py.File(store,'r') as f:
+        ds = f[key]
+        if ds.attrs.get('dim1') != SITES_KEY:
+            raise ValueError('{} in {} is not site-major, see transpose_production.'.format(
+                key,store))
+        rows = _series_rows(f,sites)
+        return f['time'][t_sl],_read_rows(ds,rows,t_sl)
+
+
+def get_region_series(store,fractions,region,start=None,end=None,key='wp_output'):
+    """
+    Time series of a region from a site-major store written by 
+    transpose_production, weighting its sites with the fractions from 
+    calc-areas or create-classes (as region_production in regions).
+
+    Args:
+        store (str): path to site-major hdf5 file
+        fractions (str): path to areas or classes hdf5 file
+        region (str): region id
+        start (int): first time step (from the beginning if None)
+        end (int): last time step + 1 (to the end if None)
+        key (str): dataset to read
+
+    Returns:
+        tuple: time steps and series of the region, (classes,time) for 
+            fractions of classes
+    """
+    import regions
+
+    site_fractions = regions.read_fractions(fractions)
+    if region not in site_fractions.regions:
+        raise ValueError("Region '{}' not in {}.".format(region,fractions))
+    num_classes = 1 if site_fractions.classes is None else len(site_fractions.classes)
+    first = site_fractions.regions.index(region)*num_classes
+    weights = site_fractions.matrix.tocsc()[:,first:first+num_classes].tocsr()
+    used = np.flatnonzero(np.diff(weights.indptr))
+    logger.debug('Region {} has {} sites.'.format(region,len(used)))
+    time,series = get_site_series(store,np.asarray(site_fractions.sites)[used],start,end,key)
+    series = weights[used].T.dot(np.asarray(series,dtype=np.float64))
+    if site_fractions.classes is None:
+        series = series[0]
+    return time,series
+
+
+def _source_path(vds_path,file_name):
+    """Path of a source file of a virtual dataset, relative to its file."""
+    return os.path.join(os.path.dirname(os.path.abspath(vds_path)),file_name)
+
+
+def stitch_production(sources,dest,keys=None):
+    """
+    Stitch wind production files (e.g. one per year) into one file of HDF5 
+    virtual datasets, concatenating time, wind power output and hub height 
+    wind speeds without copying data, so that readers can treat the series 
+    as one file. Source paths are stored relative to dest, so the files can 
+    be moved together. Cached statistics and histograms present in all 
+    sources are merged into dest; they go stale if any source changes.
+
+    Missing sources read as NaN (or as missing values for int16 storage).
+
+    Args:
+        sources (list): wind production hdf5 files, concatenated in time
+        dest (str): path to output hdf5 file
+        keys (list): datasets to include (wp_output and hub height wind 
+            speeds if None)
+    """
+    sources = sorted(sources)
+    if not sources:
+        raise ValueError('No source files given.')
+    dest_dir = os.path.dirname(os.path.abspath(dest))
+
+    files = [h5py.File(source,'r') for source in sources]
+    try:
+        first = files[0]
+        if keys is None:
+            keys = production_keys(first)
+        sites = common_sites(files,keys[0])
+        num_t = sum(f[keys[0]].shape[0] for f in files)
+        logger.info('Stitching {} time steps from {} files.'.format(num_t,len(files)))
+
+        with h5py.File(dest,'w') as outfile:
+            outfile['latitude'] = first['latitude'][:]
+            outfile['longitude'] = first['longitude'][:]
+            if sites is not None:
+                outfile[SITES_KEY] = sites
+                outfile[SITES_KEY].attrs['grid_shape'] = grid_shape(first)
+
+            virtual = ['time']+keys
+            if len(set(f['time'].attrs.get('units') for f in files)) > 1:
+                # Time steps relative to each file, store them decoded
+                time,time_units = concat_time(files)
+                outfile['time'] = time
+                outfile['time'].attrs['units'] = time_units
+                virtual = keys
+            for key in virtual:
+                src = [f[key] for f in files]
+                attrs = dict(src[0].attrs)
+                for ds in src[1:]:
+                    if ds.dtype != src[0].dtype or ds.shape[1:] != src[0].shape[1:] or \
+                            sorted((k,repr(v)) for k,v in ds.attrs.items()) != \
+                            sorted((k,repr(v)) for k,v in attrs.items()):
+                        raise ValueError('Storage of {} differs between {} and {}.'.format(
+                            key,ds.file.filename,first.filename))
+                layout = h5py.VirtualLayout(shape=(num_t,)+src[0].shape[1:],dtype=src[0].dtype)
+                offset = 0
+                for ds in src:
+                    path = os.path.relpath(os.path.abspath(ds.file.filename),dest_dir)
+                    layout[offset:offset+ds.shape[0]] = h5py.VirtualSource(path,key,shape=ds.shape)
+                    offset += ds.shape[0]
+                if 'missing_value' in attrs:
+                    fillvalue = attrs['missing_value']
+                elif src[0].dtype.kind == 'f':
+                    fillvalue = np.nan
+                else:
+                    fillvalue = None
+                vds = outfile.create_virtual_dataset(key,layout,fillvalue=fillvalue)
+                vds.attrs.update(attrs)
+
+            for key in keys:
+                merge_cached(files,key,outfile)
+    finally:
+        for f in files:
+            f.close()
+
+
+def merge_cached(files,key,outfile):
+    """
+    Merge cached statistics and histograms of a dataset in several files into 
+    another file, if all files have them up to date.
+
+    Args:
+        files (list): open wind production files
+        key (str): key of dataset
+        outfile (h5py.File): file to save to, with dataset key
+    """
+    for read,write,name in [(read_site_stats,write_site_stats,'statistics'),
+                            (read_site_histogram,write_site_histogram,'histogram')]:
+        parts = [read(f,key) for f in files]
+        if any(part is None for part in parts):
+            logger.debug('Not all files have {} of {}.'.format(name,key))
+            continue
+        merged = parts[0]
+        for part in parts[1:]:
+            merged.merge(part)
+        logger.debug('Saving merged {} of {}.'.format(name,key))
+        write(outfile,key,merged)